@@ -1,49 +1,121 @@
 import os
 import configparser
 import csv
+import cv_char_tables as tables
+import cv_char_profiling as profiling
 
-def main():
-    config = configparser.RawConfigParser()
-    config.read('config.ini')
-    directory_name = config['Paths']['data_dir']
-    dir = '{0}\Analysis'.format(directory_name)
-    if not os.path.isdir(dir):
-         os.makedirs(dir)
+LINE_PARAMS_HEADER = list(tables.LINE_PARAMS_DTYPE.names)
 
-    input_csv_name = 'generated_line_params.csv'
 
-    data_dict = {'1000': None, '10000': None, '100000': None}
-
-    with open(os.path.join(dir, input_csv_name), 'r') as csvfile:
+def read_line_params(dir, frequency):
+    # rows of the {frequency}_line_params.csv table as [temperature, forward slope, y intercept, x intercept,
+    # reverse slope, y intercept, x intercept], from line_params.npy unless the csv is newer
+    table = tables.read_table(dir, tables.LINE_PARAMS, frequency)
+    if table is not None:
+        return tables.line_params_rows(table)
+    with open(os.path.join(dir, '{0}_line_params.csv'.format(frequency)), 'r') as csvfile:
         reader = csv.reader(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
         next(reader, None)
-        generated_line_params = [tuple(line) for line in csv.reader(csvfile)]
+        return [[int(line[0])] + [float(value) for value in line[1:]] for line in reader if line]
 
-    for freq_factor in range(3, 6):
-        frequency = 10 ** freq_factor
 
-        with open(os.path.join(dir, '{0}_line_params.csv'.format(frequency)), 'r') as csvfile:
-            reader = csv.reader(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-            next(reader, None)
-            data_dict['{0}'.format(frequency)] = [tuple(line) for line in csv.reader(csvfile)]
+def _write_line_params_file(path, rows):
+    with profiling.timer('write_tables'), open(path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(LINE_PARAMS_HEADER)
+        for row in rows:
+            writer.writerow(row)
+
+
+def write_all_line_params(dir, freq_line_params):
+    # Writes {freq}_line_params.csv for every {freq: rows} in freq_line_params, then their binary copy in
+    # line_params.npy. Each table is written in full under a temporary name before any of them replaces
+    # its old file, so a crash part way never leaves a half-written table behind.
+    temporaries = []
+    try:
+        for frequency, rows in freq_line_params.items():
+            path = os.path.join(dir, '{0}_line_params.csv'.format(frequency))
+            temporary = '{0}.{1}.tmp'.format(path, os.getpid())
+            temporaries.append((temporary, path))
+            _write_line_params_file(temporary, rows)
+        for temporary, path in temporaries:
+            os.replace(temporary, path)
+        tables.write_tables(dir, tables.LINE_PARAMS, {frequency: tables.line_params_table(rows)
+                                                      for frequency, rows in freq_line_params.items()})
+    finally:
+        for temporary, _ in temporaries:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+
+def read_generated_line_params(dir):
+    # rows of generated_line_params.csv, (frequency, temperature, forward line, reverse line)
+    with open(os.path.join(dir, 'generated_line_params.csv'), 'r') as csvfile:
+        reader = csv.reader(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+        next(reader, None)
+        return [(int(line[0]), int(line[1])) + tuple(float(value) for value in line[2:]) for line in reader if line]
+
 
+def apply_overrides(data_dict, generated_line_params):
+    # Replaces the rows of {frequency: line params rows} that have a manual fit in generated_line_params,
+    # in one pass over each. Returns the generated rows that match no row, which are left out.
+    index = {(freq, int(row[0])): position for freq, rows in data_dict.items() for position, row in enumerate(rows)}
+    unmatched = []
     for data_tuple in generated_line_params:
-        freq = data_tuple[0]
-        temperature = data_tuple[1]
-        i = [temp[0] for temp in data_dict[freq]].index(temperature)
-        data_dict[freq][i] = data_tuple[1:]
+        freq = int(data_tuple[0])
+        temperature = int(data_tuple[1])
+        position = index.get((freq, temperature))
+        if position is None:
+            unmatched.append(data_tuple)
+            continue
+        data_dict[freq][position] = list(data_tuple[1:])
+    return unmatched
+
+
+def merge_overrides(device_line_params, device_generated_line_params):
+    # apply_overrides for several devices, {device: {frequency: line params rows}} and {device: generated
+    # rows}, with one (device, frequency, temperature) index. Returns the unmatched (device, generated row)
+    # pairs.
+    index = {(device, freq, int(row[0])): position for device, freq_line_params in device_line_params.items()
+             for freq, rows in freq_line_params.items() for position, row in enumerate(rows)}
+    unmatched = []
+    for device, generated_line_params in device_generated_line_params.items():
+        for data_tuple in generated_line_params:
+            freq = int(data_tuple[0])
+            position = index.get((device, freq, int(data_tuple[1])))
+            if position is None:
+                unmatched.append((device, data_tuple))
+                continue
+            device_line_params[device][freq][position] = list(data_tuple[1:])
+    return unmatched
+
 
+def report_unmatched(unmatched):
+    for (directory_name, device_num), data_tuple in unmatched:
+        print('No fitted line for the manual fit of device {0} at {1}K, {2}Hz in {3}; it was not applied'.format(
+            device_num, int(data_tuple[1]), int(data_tuple[0]), directory_name))
+
+
+def main():
+    config = configparser.RawConfigParser()
+    config.read('config.ini')
+    directory_name = config['Paths']['data_dir']
+    device_num = config['Paths']['device_num']
+    dir = '{0}\\Analysis'.format(directory_name)
+    if not os.path.isdir(dir):
+         os.makedirs(dir)
+
+    generated_line_params = read_generated_line_params(dir)
+
+    data_dict = {}
     for freq_factor in range(3, 6):
         frequency = 10 ** freq_factor
+        data_dict[frequency] = read_line_params(dir, frequency)
+
+    report_unmatched([((directory_name, device_num), data_tuple)
+                      for data_tuple in apply_overrides(data_dict, generated_line_params)])
 
-        with open(os.path.join(dir, '{0}_line_params.csv'.format(frequency)), 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-            writer.writerow(
-                ['Temperature'] + ['Ideal Forward Slope'] + ['Ideal Forward Y Intercept'] +
-                ['Ideal Forward X Intercept'] + ['Ideal Reverse Slope'] + ['Ideal Reverse Y Intercept'] +
-                ['Ideal Reverse X Intercept'])
-            for row in data_dict['{0}'.format(frequency)]:
-                writer.writerow(row)
+    write_all_line_params(dir, data_dict)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,76 @@
+import os
+import collections
+import multiprocessing
+import cv_char_profiling as profiling
+
+
+def frequencies():
+    return [10 ** frequency for frequency in range(3, 6)]
+
+
+def temperatures(config):
+    min_temp = int(config['Temp Bounds']['min_temp'])
+    max_temp = int(config['Temp Bounds']['max_temp'])
+    return list(range(min_temp, max_temp+5, 5))
+
+
+def analysis_dir(directory_name):
+    return '{0}\\Analysis'.format(directory_name)
+
+
+def get_processes(config):
+    # [Batch] processes: 0 (or no setting) uses every core, 1 runs in this process without a pool
+    return config.getint('Batch', 'processes', fallback=0) or os.cpu_count() or 1
+
+
+def make_pool(processes):
+    # a pool to share between several run_tasks calls, or None when running in-process
+    if processes <= 1:
+        return None
+    return multiprocessing.Pool(processes)
+
+
+def run_tasks(function, tasks, processes, pool=None):
+    # Calls function(*task) for every task and returns the results in task order, whatever order the
+    # workers finish in, so the tables written from them are deterministic. Uses pool when given,
+    # otherwise a pool of processes workers that lasts for this call.
+    tasks = list(tasks)
+    if pool is None and (processes <= 1 or len(tasks) <= 1):
+        return [function(*task) for task in tasks]
+    if pool is not None:
+        results = pool.starmap(profiling.pool_function(function), tasks, chunksize=1)
+    else:
+        with multiprocessing.Pool(min(processes, len(tasks))) as pool:
+            results = pool.starmap(profiling.pool_function(function), tasks, chunksize=1)
+    return [profiling.pool_result(result) for result in results]
+
+
+def iter_tasks(function, tasks, processes, pool=None, window=None):
+    # Like run_tasks, but reads tasks lazily and yields each result in task order as soon as it is ready,
+    # with at most window tasks (by default four per process) handed to the workers at a time. Neither
+    # the tasks nor the results are ever all held in memory.
+    if pool is None and processes <= 1:
+        for task in tasks:
+            yield function(*task)
+        return
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(processes)
+    window = window or 4*processes
+    pending = collections.deque()
+    pool_function = profiling.pool_function(function)
+    try:
+        for task in tasks:
+            pending.append(pool.apply_async(pool_function, task))
+            if len(pending) >= window:
+                yield profiling.pool_result(pending.popleft().get())
+        while pending:
+            yield profiling.pool_result(pending.popleft().get())
+    finally:
+        if own_pool:
+            # a consumer that stops early leaves tasks in flight, which are not worth finishing
+            if pending:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import configparser
+import collections
+import numpy as np
+import matplotlib
+import cv_char_batch as batch
+import cv_char_loader as loader
+import cv_char_physics as physics
+import cv_char_plotting as plotting
+import cv_char_segments as segments
+import cv_char_store as store
+import cv_char_gen_figures as gen_figures
+import csv_replacer
+from cv_char_find_linear_fits import fit_settings, fit_sweep
+
+# the device number of the synthetic sweep files
+DEVICE_NUM = 1
+
+# stages timed for every run, in the order they are run
+BENCHMARK_STAGES = ('parse', 'fit', 'physics', 'plot', 'csv_write')
+
+# sweep lengths run with --sweep-files files each, and grid sizes run with --grid-points points per sweep
+DEFAULT_POINTS = (100, 1000, 10000)
+DEFAULT_FILES = (10, 100, 1000, 10000)
+
+
+def synthetic_sweep(points, rng, noise=2e-4, hysteresis=.02, nonlinearity=.2, carrier_density=1e22,
+                    built_in_voltage=.6, area=1.1e-5, epsilon=8.8541878e-12*11.1, elementary_charge=1.60217657e-19):
+    # (voltage, capacitance) rows of an LCR meter sweep, points//2 forward from -1 V to 1 V then back again.
+    # 1/C^2 follows the Mott-Schottky line of carrier_density through built_in_voltage, flattened close to
+    # it and bent by nonlinearity (as a fraction of the slope, per V^2) above .2 V, so the fit has to pick
+    # its linear region. The reverse half's 1/C^2 is scaled by 1 + hysteresis and every capacitance gets
+    # relative gaussian noise.
+    voltage = np.linspace(-1, 1, points//2)
+    slope = 2/(elementary_charge*epsilon*area**2*carrier_density)
+    inverse_square = slope*np.maximum(built_in_voltage - voltage, .05) + \
+        nonlinearity*slope*np.maximum(voltage - .2, 0)**2
+    forward = np.reciprocal(np.sqrt(inverse_square))
+    reverse = np.reciprocal(np.sqrt(inverse_square*(1 + hysteresis)))[::-1]
+    capacitance = np.concatenate((forward, reverse))
+    capacitance *= 1 + noise*rng.standard_normal(len(capacitance))
+    return np.column_stack((np.concatenate((voltage, voltage[::-1])), capacitance))
+
+
+def synthetic_temperatures(files):
+    # temperatures, 5 K apart from 200 K, giving at least files sweeps over the three frequencies
+    return list(range(200, 200 + 5*-(-files // len(batch.frequencies())), 5))
+
+
+def write_synthetic_device(directory_name, files, points, seed=0, **sweep_options):
+    # Writes files synthetic sweep files of DEVICE_NUM into directory_name, filling each frequency's
+    # temperatures in turn like the LCR meter does. Returns their (temperature, frequency) pairs.
+    if not os.path.isdir(directory_name):
+        os.makedirs(directory_name)
+    rng = np.random.default_rng(seed)
+    temps_freqs = [(temp, freq) for temp in synthetic_temperatures(files) for freq in batch.frequencies()][:files]
+    for temp, freq in temps_freqs:
+        cv_raw = synthetic_sweep(points, rng, **sweep_options)
+        np.savetxt(store.sweep_filename(directory_name, DEVICE_NUM, temp, freq),
+                   np.column_stack((cv_raw, np.zeros(len(cv_raw)))), fmt=('%.6f', '%.8e', '%.1f'), delimiter=',',
+                   header='Voltage,Capacitance,Loss', comments='')
+    return temps_freqs
+
+
+def _timing(start, count):
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds, 'count': count, 'per_item': seconds/count if count else None}
+
+
+def benchmark_run(config, directory_name, files, points, plot_limit=50, seed=0, **sweep_options):
+    # Writes a synthetic grid of files sweeps of points points into directory_name and times each of
+    # BENCHMARK_STAGES over it, in this process: parsing the text files, fitting them, the physics, plotting
+    # the first plot_limit sweeps and writing the csv tables. Returns {stage: timing}.
+    temps_freqs = write_synthetic_device(directory_name, files, points, seed, **sweep_options)
+    fit_mode, diff_threshold_fractions, energy_bandgap = fit_settings(config)
+    params = physics.load_params(config)
+    dir = batch.analysis_dir(directory_name)
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+    timings = collections.OrderedDict()
+
+    start = time.perf_counter()
+    sweeps = [loader.parse_cv_text(store.sweep_filename(directory_name, DEVICE_NUM, temp, freq))
+              for temp, freq in temps_freqs]
+    timings['parse'] = _timing(start, len(sweeps))
+
+    start = time.perf_counter()
+    fitted = []
+    for (temp, freq), cv_raw in zip(temps_freqs, sweeps):
+        forward_segments, reverse_segments = segments.sweep_directions(cv_raw)
+        line_params, _ = fit_sweep(forward_segments, reverse_segments, temp, energy_bandgap, diff_threshold_fractions,
+                                   fit_mode)
+        halves = (segments.join_segments(forward_segments), segments.join_segments(reverse_segments))
+        fitted.append((freq, list(line_params), halves))
+    freq_line_params = {freq: [line_params for line_freq, line_params, _ in fitted if line_freq == freq]
+                        for freq in batch.frequencies()}
+    timings['fit'] = _timing(start, len(sweeps))
+
+    start = time.perf_counter()
+    freq_data = {freq: physics.compute_table(rows, params) for freq, rows in freq_line_params.items()}
+    timings['physics'] = _timing(start, len(sweeps))
+
+    start = time.perf_counter()
+    for freq, line_params, halves in fitted[:plot_limit]:
+        plotting.plot_sweep_halves(dir, freq, line_params, halves)
+    timings['plot'] = _timing(start, len(fitted[:plot_limit]))
+
+    start = time.perf_counter()
+    csv_replacer.write_all_line_params(dir, freq_line_params)
+    gen_figures.write_all_data(dir, freq_data)
+    timings['csv_write'] = _timing(start, len(sweeps))
+    return timings
+
+
+def run_benchmarks(config, runs, work_dir, plot_limit=50, seed=0, **sweep_options):
+    # benchmark_run for each (files, points) of runs, each in its own folder of work_dir; returns the
+    # results document saved by main
+    results = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': platform.python_version(), 'numpy': np.__version__, 'matplotlib': matplotlib.__version__,
+               'platform': platform.platform(), 'fit_mode': fit_settings(config)[0], 'plot_limit': plot_limit,
+               'seed': seed, 'sweep_options': sweep_options, 'runs': []}
+    for files, points in runs:
+        print('Benchmarking {0} sweeps of {1} points'.format(files, points))
+        directory_name = os.path.join(work_dir, '{0}files_{1}points'.format(files, points), '')
+        timings = benchmark_run(config, directory_name, files, points, plot_limit, seed, **sweep_options)
+        results['runs'].append({'files': files, 'points': points, 'stages': timings})
+        shutil.rmtree(directory_name, ignore_errors=True)
+    return results
+
+
+def compare_results(results, baseline):
+    # Rows of (files, points, stage, baseline seconds, seconds, ratio) for the runs in both results
+    # documents; a ratio below 1 is a speed-up.
+    baseline_runs = {(run['files'], run['points']): run['stages'] for run in baseline['runs']}
+    rows = []
+    for run in results['runs']:
+        baseline_stages = baseline_runs.get((run['files'], run['points']))
+        if baseline_stages is None:
+            continue
+        for stage in BENCHMARK_STAGES:
+            if stage not in run['stages'] or stage not in baseline_stages:
+                continue
+            old_seconds = baseline_stages[stage]['seconds']
+            new_seconds = run['stages'][stage]['seconds']
+            rows.append((run['files'], run['points'], stage, old_seconds, new_seconds,
+                         new_seconds/old_seconds if old_seconds else None))
+    return rows
+
+
+def print_results(results):
+    print('{0:>7} {1:>7} {2:>10} {3:>12} {4:>14}'.format('files', 'points', 'stage', 'seconds', 'per item (ms)'))
+    for run in results['runs']:
+        for stage, timing in run['stages'].items():
+            per_item = '' if timing['per_item'] is None else '{0:.3f}'.format(1000*timing['per_item'])
+            print('{0:>7} {1:>7} {2:>10} {3:>12.4f} {4:>14}'.format(run['files'], run['points'], stage,
+                                                                  timing['seconds'], per_item))
+
+
+def main():
+    config = configparser.RawConfigParser()
+    config.read('config.ini')
+
+    parser = argparse.ArgumentParser(description='Time the parse, fit, physics, plot and csv stages on synthetic '
+                                                 'C-V sweeps and save the timings as JSON.')
+    parser.add_argument('--points', type=int, nargs='+', default=list(DEFAULT_POINTS),
+                        help='sweep lengths to time, each over --sweep-files files')
+    parser.add_argument('--sweep-files', type=int, default=3,
+                        help='files in each of the --points runs')
+    parser.add_argument('--files', type=int, nargs='+', default=list(DEFAULT_FILES),
+                        help='grid sizes to time, each of --grid-points point sweeps')
+    parser.add_argument('--grid-points', type=int, default=100,
+                        help='points per sweep in each of the --files runs')
+    parser.add_argument('--noise', type=float, default=2e-4, help='relative capacitance noise')
+    parser.add_argument('--hysteresis', type=float, default=.02,
+                        help='fractional 1/C^2 offset of the reverse sweep')
+    parser.add_argument('--nonlinearity', type=float, default=.2,
+                        help='strength of the bend above .2 V, as a fraction of the slope per V^2')
+    parser.add_argument('--plot-limit', type=int, default=50, help='most sweeps plotted per run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', help='folder for the synthetic files, by default a temporary one')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file the results are saved to')
+    parser.add_argument('--compare', help='results JSON of an earlier build to compare against')
+    args = parser.parse_args()
+
+    runs = []
+    for run in [(args.sweep_files, points) for points in args.points] + \
+               [(files, args.grid_points) for files in args.files]:
+        if run not in runs:
+            runs.append(run)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='cv_char_benchmark_')
+    try:
+        results = run_benchmarks(config, runs, work_dir, args.plot_limit, args.seed, noise=args.noise,
+                                 hysteresis=args.hysteresis, nonlinearity=args.nonlinearity)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as jsonfile:
+        json.dump(results, jsonfile, indent=2)
+    print_results(results)
+
+    if args.compare:
+        with open(args.compare, 'r') as jsonfile:
+            baseline = json.load(jsonfile)
+        print('\nCompared with {0} ({1})'.format(args.compare, baseline.get('created')))
+        print('{0:>7} {1:>7} {2:>10} {3:>12} {4:>12} {5:>8}'.format('files', 'points', 'stage', 'before', 'after',
+                                                                    'ratio'))
+        for files, points, stage, old_seconds, new_seconds, ratio in compare_results(results, baseline):
+            ratio_text = '' if ratio is None else '{0:.2f}x'.format(ratio)
+            print('{0:>7} {1:>7} {2:>10} {3:>12.4f} {4:>12.4f} {5:>8}'.format(files, points, stage, old_seconds,
+                                                                            new_seconds, ratio_text))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+import os
+import argparse
+import configparser
+import csv
+import numpy as np
+import cv_char_batch as batch
+import cv_char_physics as physics
+import cv_char_profiling as profiling
+import cv_char_segments as segments
+import cv_char_store as store
+import cv_char_streak_search as streak_search
+from cv_char_find_linear_fits import direction_fits, fit_settings
+from cv_char_fit_cache import fit_key, open_fit_cache
+from cv_char_manual_fit import MANUAL_BOUNDS, has_lines, manual_points
+
+DEFAULT_RESAMPLES = 2000
+DEFAULT_CONFIDENCE = .95
+
+# quantities given confidence intervals in {freq}_bootstrap.csv: the fitted lines' slopes and x
+# intercepts, then the data table columns derived from them
+LINE_QUANTITIES = ('Forward Slope', 'Forward X Intercept', 'Reverse Slope', 'Reverse X Intercept')
+DATA_QUANTITIES = ('Carrier Density', 'Depletion Width', 'Fermi Energy', 'Averaged Vbi')
+
+# each quantity's value from the fitted points, then the bounds of its confidence interval
+BOOTSTRAP_HEADER = ['Temperature', 'Resamples'] + [column for name in LINE_QUANTITIES + DATA_QUANTITIES
+                                                   for column in (name, name + ' Low', name + ' High')]
+
+
+def fit_windows(forward_segments, reverse_segments, energy_bandgap, diff_threshold_fractions):
+    # The (pass index, start, end) of the points the forward and reverse lines were fitted to, picked at
+    # the same threshold fraction and pass as find_ideal_cv_lines picks the lines; a direction without a
+    # line gets None.
+    forward_fits = direction_fits(forward_segments, energy_bandgap, diff_threshold_fractions)
+    reverse_fits = direction_fits(reverse_segments, energy_bandgap, diff_threshold_fractions)
+    for forward_fit, reverse_fit in zip(forward_fits, reverse_fits):
+        if forward_fit[1].slope != 0 and reverse_fit[1].slope != 0:
+            break
+    return [None if fit.start_index is None else (segment_index, fit.start_index, fit.end_index)
+            for segment_index, fit in (forward_fit, reverse_fit)]
+
+
+def cached_fit_windows(forward_segments, reverse_segments, energy_bandgap, diff_threshold_fractions,
+                       fit_cache=None):
+    # fit_windows, kept in the fit cache next to the sweep's line fit so a campaign's windows are only
+    # searched for once
+    if fit_cache is None:
+        return fit_windows(forward_segments, reverse_segments, energy_bandgap, diff_threshold_fractions)
+    key = fit_key(forward_segments, reverse_segments, energy_bandgap, diff_threshold_fractions, 'windows')
+    windows = fit_cache.get(key)
+    if windows is None:
+        windows = fit_windows(forward_segments, reverse_segments, energy_bandgap, diff_threshold_fractions)
+        fit_cache.put(key, windows)
+    return [None if window is None else tuple(window) for window in windows]
+
+
+def bootstrap_lines(points, resamples, rng, tile_elements=streak_search.DEFAULT_TILE_ELEMENTS):
+    # (slopes, y intercepts) of least squares lines through resamples resamplings, with replacement, of
+    # the (voltage, 1/C^2) points. The resamples are drawn as a (resamples, points) index matrix and
+    # fitted together, in tiles of at most tile_elements points. A resample whose voltages are all equal
+    # has no line and gets nan.
+    count = points.shape[0]
+    slopes = np.empty(resamples)
+    y_intercepts = np.empty(resamples)
+    tile = max(1, tile_elements // max(count, 1))
+    for start in range(0, resamples, tile):
+        indices = rng.integers(0, count, (min(tile, resamples - start), count))
+        x = points[indices, 0]
+        y = points[indices, 1]
+        # about each resample's means, as in streak_search.window_sums, for the ~1e18 scale of 1/C^2
+        x_mean = x.mean(axis=1)
+        y_mean = y.mean(axis=1)
+        x = x - x_mean[:, None]
+        y = y - y_mean[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tile_slopes = np.einsum('ij,ij->i', x, y) / np.einsum('ij,ij->i', x, x)
+        slopes[start:start + len(indices)] = tile_slopes
+        y_intercepts[start:start + len(indices)] = y_mean - tile_slopes*x_mean
+    return slopes, y_intercepts
+
+
+def fitted_points(cv_raw, windows=None, bounds=None, segmentation=None):
+    # The forward and reverse (voltage, 1/C^2) points each line is fitted to: those of
+    # cv_char_manual_fit.manual_points for the bounds of a manual_line_params.csv row when given, and
+    # otherwise the (pass index, start, end) windows of fit_windows in the sweep's passes. A direction
+    # without a line gets None.
+    if bounds is not None:
+        points = manual_points(cv_raw, bounds, segmentation)
+    else:
+        points = [None if window is None else direction_segments[window[0]][window[1]:window[2], :]
+                  for direction_segments, window in zip(segments.sweep_directions(cv_raw, segmentation), windows)]
+    return [None if direction_points is None or direction_points.shape[0] < 2 else direction_points
+            for direction_points in points]
+
+
+def bootstrap_sweep(forward_points, reverse_points, temp, params, resamples, confidence, rng):
+    # {freq}_bootstrap.csv row of one sweep: for each quantity its value from the fitted points and the
+    # bounds of the central confidence interval over the resampled lines. The forward and reverse
+    # resamples are paired in order to give resampled line params rows, whose physics is worked out as one
+    # table by physics.compute_table. A half without points leaves every interval that needs it nan.
+    line_params = np.full((resamples + 1, 7), np.nan)
+    line_params[:, 0] = temp
+    for points, column in ((forward_points, 1), (reverse_points, 4)):
+        if points is None:
+            continue
+        fitted = streak_search.window_line(streak_search.window_sums(points), 0, points.shape[0])
+        slopes, y_intercepts = bootstrap_lines(points, resamples, rng)
+        line_params[:, column] = np.concatenate(([fitted[0]], slopes))
+        line_params[:, column + 1] = np.concatenate(([fitted[1]], y_intercepts))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            line_params[:, column + 2] = -1*line_params[:, column + 1]/line_params[:, column]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        table = physics.compute_table(line_params, params)
+    values = [line_params[:, 1], line_params[:, 3], line_params[:, 4], line_params[:, 6]] + \
+        [table[name] for name in DATA_QUANTITIES]
+
+    row = [temp, resamples]
+    tail = (1 - confidence)/2
+    for value in values:
+        resampled = value[1:][np.isfinite(value[1:])]
+        if len(resampled):
+            low, high = np.quantile(resampled, [tail, 1 - tail])
+        else:
+            low, high = np.nan, np.nan
+        row += [value[0], low, high]
+    return row
+
+
+def bootstrap_sweep_file(directory_name, device_num, temp, freq, energy_bandgap, diff_threshold_fractions, params,
+                         resamples, confidence, seed, use_cache=True, use_store=True, fit_cache=None, bounds=None,
+                         segmentation=None):
+    # One (temperature, frequency) file's bootstrap row, or None when the file cannot be read, with bounds
+    # the sweep's manual_line_params.csv voltage bounds when it has a row there. A row that
+    # cv_char_manual_fit does not apply, its bounds leaving a direction without a line, is ignored like
+    # there, and the automatic fit's windows resampled instead. Each sweep
+    # draws from its own generator, seeded by seed, temperature and frequency, so the intervals do not
+    # depend on how the sweeps are shared out between processes.
+    with profiling.file_timer('bootstrap', directory_name, temp, freq):
+        try:
+            cv_raw = store.load_sweep(directory_name, device_num, temp, freq, use_cache, use_store)
+        except IOError:
+            profiling.count('files_skipped')
+            return None
+        windows = None
+        if bounds is not None and not has_lines(manual_points(cv_raw, bounds, segmentation)):
+            bounds = None
+        if bounds is None:
+            windows = cached_fit_windows(*segments.sweep_directions(cv_raw, segmentation), energy_bandgap,
+                                         diff_threshold_fractions, fit_cache)
+        forward_points, reverse_points = fitted_points(cv_raw, windows, bounds, segmentation)
+        rng = np.random.default_rng([seed, int(temp), int(freq)])
+        return bootstrap_sweep(forward_points, reverse_points, temp, params, resamples, confidence, rng)
+
+
+def bootstrap_settings(config):
+    # (resamples, confidence, seed) from [Bootstrap]
+    return (config.getint('Bootstrap', 'resamples', fallback=DEFAULT_RESAMPLES),
+            config.getfloat('Bootstrap', 'confidence', fallback=DEFAULT_CONFIDENCE),
+            config.getint('Bootstrap', 'seed', fallback=0))
+
+
+def manual_bounds(dir):
+    # {(temperature, frequency): bounds} of the rows of the device's manual_line_params.csv, in the
+    # order of MANUAL_BOUNDS
+    try:
+        with open(os.path.join(dir, 'manual_line_params.csv'), 'r') as csvfile:
+            reader = csv.DictReader(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+            return {(int(row['Temperature']), int(row['Frequency'])): tuple(float(row[name]) for name in MANUAL_BOUNDS)
+                    for row in reader}
+    except IOError:
+        return {}
+
+
+def write_bootstrap(dir, freq, rows):
+    with profiling.timer('write_tables'), \
+            open(os.path.join(dir, '{0}_bootstrap.csv'.format(freq)), 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(BOOTSTRAP_HEADER)
+        for row in rows:
+            writer.writerow(row)
+
+
+def bootstrap_devices(devices, config, pool=None):
+    # Bootstraps every (temperature, frequency) sweep of each (directory_name, device_num) in devices as
+    # one batch and writes each device's {freq}_bootstrap.csv. Sweeps with a manual_line_params.csv row
+    # are resampled between its bounds, like the lines that replace their fits. Returns
+    # {device: {freq: rows}}.
+    _, diff_threshold_fractions, energy_bandgap = fit_settings(config)
+    resamples, confidence, seed = bootstrap_settings(config)
+    params = physics.load_params(config)
+    use_cache = config.getboolean('Loader', 'cache', fallback=True)
+    use_store = config.getboolean('Loader', 'store', fallback=True)
+    fit_cache = open_fit_cache(config)
+    segmentation = segments.segmentation(config)
+
+    device_bounds = {(directory_name, device_num): manual_bounds(batch.analysis_dir(directory_name))
+                     for directory_name, device_num in devices}
+
+    tasks = [(directory_name, device_num, temp, freq, energy_bandgap, diff_threshold_fractions, params, resamples,
+              confidence, seed, use_cache, use_store, fit_cache,
+              device_bounds[(directory_name, device_num)].get((temp, freq)), segmentation)
+             for directory_name, device_num in devices
+             for freq in batch.frequencies() for temp in batch.temperatures(config)]
+    results = batch.run_tasks(bootstrap_sweep_file, tasks, batch.get_processes(config), pool)
+    if fit_cache is not None:
+        fit_cache.prune()
+
+    device_rows = {}
+    for directory_name, device_num in devices:
+        dir = batch.analysis_dir(directory_name)
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        device_rows[(directory_name, device_num)] = {}
+        for freq in batch.frequencies():
+            rows = [result for task, result in zip(tasks, results)
+                    if task[:2] == (directory_name, device_num) and task[3] == freq and result is not None]
+            write_bootstrap(dir, freq, rows)
+            device_rows[(directory_name, device_num)][freq] = rows
+    return device_rows
+
+
+def main():
+    config = configparser.RawConfigParser()
+    config.read('config.ini')
+
+    parser = argparse.ArgumentParser(description='Bootstrap confidence intervals for the fitted lines of the '
+                                                 '[Paths] device, or of the devices given, and their physics.')
+    parser.add_argument('data_dirs', nargs='*', help='device data directories or glob patterns, as for '
+                                                     'cv_char_campaign; defaults to the [Paths] device')
+    parser.add_argument('--device-nums', nargs='+', help='device numbers in the order of the sorted directories')
+    parser.add_argument('--resamples', type=int, help='resamples per sweep, overrides [Bootstrap] resamples')
+    parser.add_argument('--confidence', type=float, help='interval confidence, overrides [Bootstrap] confidence')
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    if not config.has_section('Bootstrap'):
+        config.add_section('Bootstrap')
+    if args.resamples is not None:
+        config.set('Bootstrap', 'resamples', str(args.resamples))
+    if args.confidence is not None:
+        config.set('Bootstrap', 'confidence', str(args.confidence))
+    profiling.apply_arguments(config, args)
+
+    if args.data_dirs:
+        from cv_char_campaign import find_devices
+        devices = find_devices(args.data_dirs, args.device_nums)
+    else:
+        devices = [(config['Paths']['data_dir'], config['Paths']['device_num'])]
+    profiling.start(config)
+    bootstrap_devices(devices, config)
+    profiling.finish([batch.analysis_dir(directory_name) for directory_name, _ in devices])
+
+
+if __name__ == '__main__':
+    main()
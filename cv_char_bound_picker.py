@@ -0,0 +1,339 @@
+import os
+import csv
+import json
+import argparse
+import configparser
+import numpy as np
+import cv_char_batch as batch
+import cv_char_segments as segments
+import cv_char_store as store
+import cv_char_streak_search as streak_search
+from cv_char_manual_fit import MANUAL_BOUNDS, manual_points
+
+MANUAL_HEADER = ['Temperature', 'Frequency'] + list(MANUAL_BOUNDS)
+
+DIRECTIONS = ('Forward', 'Reverse')
+
+
+class WindowFitter:
+    # Least squares lines through the points of one sweep direction that lie strictly between two
+    # voltages, as cv_char_manual_fit selects them. The points are sorted by voltage once, so any pair of
+    # bounds is a window of them, two searchsorted lookups away, and its line comes from the window sums
+    # of streak_search in O(1).
+
+    def __init__(self, points):
+        self.points = points[np.argsort(points[:, 0], kind='stable'), :]
+        self.sums = streak_search.window_sums(self.points)
+
+    def window(self, left_bound, right_bound):
+        return (int(np.searchsorted(self.points[:, 0], left_bound, 'right')),
+                int(np.searchsorted(self.points[:, 0], right_bound, 'left')))
+
+    def fit(self, left_bound, right_bound):
+        # (slope, y intercept, x intercept, points fitted); nan lines for fewer than two points
+        start_index, end_index = self.window(left_bound, right_bound)
+        if end_index - start_index < 2:
+            return np.nan, np.nan, np.nan, max(end_index - start_index, 0)
+        slope, y_intercept = streak_search.window_line(self.sums, start_index, end_index)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_intercept = -1*y_intercept/slope
+        return slope, y_intercept, x_intercept, end_index - start_index
+
+
+def load_fitters(directory_name, device_num, temp, freq, segmentation=None, use_cache=True, use_store=True):
+    # forward and reverse WindowFitters of one sweep's points, or None when the raw file cannot be read
+    try:
+        cv_raw = store.load_sweep(directory_name, device_num, temp, freq, use_cache, use_store)
+    except IOError:
+        return None
+    # bounds past either end of the sweep take every point of a direction
+    bounds = [-np.inf, np.inf] * 2
+    return [WindowFitter(points) for points in manual_points(cv_raw, bounds, segmentation)]
+
+
+def read_manual_rows(dir):
+    # the rows of manual_line_params.csv, or none when the device has no such table yet
+    try:
+        with open(os.path.join(dir, 'manual_line_params.csv'), 'r') as csvfile:
+            reader = csv.DictReader(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+            return list(reader)
+    except IOError:
+        return []
+
+
+def initial_bounds(dir, temp, freq, fitters):
+    # the sweep's bounds from manual_line_params.csv, or each direction's full voltage range when it has
+    # no row there, nan for a direction without points
+    for row in read_manual_rows(dir):
+        if (int(row['Temperature']), int(row['Frequency'])) == (int(temp), int(freq)):
+            return [float(row[name]) for name in MANUAL_BOUNDS]
+    bounds = []
+    for fitter in fitters:
+        voltages = fitter.points[:, 0]
+        if not len(voltages):
+            bounds += [np.nan, np.nan]
+            continue
+        # just outside the end points, since the bounds exclude points lying on them
+        margin = (voltages[-1] - voltages[0])*1e-3 or 1e-3
+        bounds += [voltages[0] - margin, voltages[-1] + margin]
+    return bounds
+
+
+def write_bounds(dir, temp, freq, bounds):
+    # Puts the sweep's bounds into manual_line_params.csv, replacing its row when it has one and keeping
+    # every other row as it is.
+    rows = [[row[name] for name in MANUAL_HEADER] for row in read_manual_rows(dir)]
+    new_row = [int(temp), int(freq)] + [float(bound) for bound in bounds]
+    for index, row in enumerate(rows):
+        if (int(row[0]), int(row[1])) == (int(temp), int(freq)):
+            rows[index] = new_row
+            break
+    else:
+        rows.append(new_row)
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+    path = os.path.join(dir, 'manual_line_params.csv')
+    # written under a temporary name first so a run reading the table never sees half of it
+    temporary = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(temporary, 'w') as csvfile:
+        writer = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(MANUAL_HEADER)
+        for row in rows:
+            writer.writerow(row)
+    os.replace(temporary, path)
+
+
+def fit_summary(fits):
+    # one line per direction of the (slope, y intercept, x intercept, points) of fits
+    return '\n'.join('{0}: slope {1:.4g}, Vbi {2:.4f} V from {3} points'.format(direction, fit[0], fit[2], fit[3])
+                     for direction, fit in zip(DIRECTIONS, fits))
+
+
+class BoundPicker:
+    # One sweep with a range slider per direction under it. Moving a slider refits that direction's line
+    # between its bounds and redraws the line, slope and Vbi; the Write Bounds button puts the bounds in
+    # manual_line_params.csv. A direction without points gets no slider and nan bounds.
+
+    def __init__(self, dir, temp, freq, fitters, bounds):
+        # pyplot only here, so the batch scripts never need an interactive backend
+        import matplotlib.pyplot as plt
+        from matplotlib.widgets import Button, RangeSlider
+        self.plt = plt
+        self.dir = dir
+        self.temp = temp
+        self.freq = freq
+        self.fitters = fitters
+        self.fig = plt.figure(figsize=(10, 8))
+        self.ax = self.fig.add_axes([.12, .38, .83, .54])
+        self.points = []
+        self.lines = []
+        for direction, fitter in zip(DIRECTIONS, fitters):
+            self.points.append(self.ax.plot(fitter.points[:, 0], fitter.points[:, 1], '.', markersize=6,
+                                            label='{0} Sweep'.format(direction))[0])
+            self.lines.append(self.ax.plot([], [], '-', label='{0} Sweep Ideal Line'.format(direction))[0])
+        y_values = np.concatenate([fitter.points[:, 1] for fitter in fitters])
+        self.ax.set_ylim([.99*np.min(y_values), 1.01*np.max(y_values)])
+        self.ax.set_ylabel(r'Inverse Square Capacitance, $C^{-2}(F^{-2})$')
+        self.ax.set_xlabel('Voltage, V (Volts)')
+        self.ax.set_title('Inverse Square Capacitance vs. Voltage-{0}K at {1}Hz'.format(temp, freq))
+        self.ax.legend(loc='upper right', fontsize=8)
+        self.text = self.fig.text(.12, .12, '', fontsize=10, family='monospace')
+
+        self.sliders = []
+        for index, (direction, fitter) in enumerate(zip(DIRECTIONS, fitters)):
+            voltages = fitter.points[:, 0]
+            if not len(voltages):
+                self.sliders.append(None)
+                continue
+            low = min(voltages[0], bounds[2*index])
+            high = max(voltages[-1], bounds[2*index + 1])
+            slider = RangeSlider(self.fig.add_axes([.2, .29 - .05*index, .6, .03]), direction, low, high,
+                                 valinit=bounds[2*index:2*index + 2])
+            slider.on_changed(self.update)
+            self.sliders.append(slider)
+        self.button = Button(self.fig.add_axes([.75, .05, .2, .06]), 'Write Bounds')
+        self.button.on_clicked(self.write)
+        self.update()
+
+    def bounds(self):
+        return [float(bound) for slider in self.sliders
+                for bound in (slider.val if slider is not None else (np.nan, np.nan))]
+
+    def fits(self):
+        bounds = self.bounds()
+        return [fitter.fit(bounds[2*index], bounds[2*index + 1]) for index, fitter in enumerate(self.fitters)]
+
+    def update(self, _=None):
+        fits = self.fits()
+        for line, fitter, fit in zip(self.lines, self.fitters, fits):
+            x_values = fitter.points[:, 0]
+            line.set_data(x_values, fit[0]*x_values + fit[1])
+        self.text.set_text(fit_summary(fits))
+        self.fig.canvas.draw_idle()
+
+    def write(self, _=None):
+        write_bounds(self.dir, self.temp, self.freq, self.bounds())
+        self.text.set_text(fit_summary(self.fits()) + '\nwritten to manual_line_params.csv')
+        self.fig.canvas.draw_idle()
+
+    def show(self):
+        self.plt.show()
+
+
+HTML_TEMPLATE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Bounds for {temp}K at {freq}Hz</title>
+<style>
+body {{ font-family: sans-serif; margin: 20px; }}
+canvas {{ border: 1px solid #ccc; }}
+td {{ padding: 2px 8px; }}
+pre {{ background: #f4f4f4; padding: 6px; }}
+</style>
+</head>
+<body>
+<h3>Inverse Square Capacitance vs. Voltage-{temp}K at {freq}Hz</h3>
+<canvas id="plot" width="900" height="500"></canvas>
+<table id="controls"></table>
+<p>manual_line_params.csv row:</p>
+<pre id="row"></pre>
+<button id="download">Download row</button>
+<script>
+var DATA = {data};
+var COLOURS = [['#1f77b4', '#2ca02c'], ['#ff7f0e', '#d62728']];
+// prefix sums about the means, as streak_search.window_sums, so every refit is O(1)
+DATA.directions.forEach(function (d) {{
+  var n = d.x.length, xm = 0, ym = 0;
+  for (var i = 0; i < n; i++) {{ xm += d.x[i] / n; ym += d.y[i] / n; }}
+  d.xm = xm; d.ym = ym; d.sx = [0]; d.sy = [0]; d.sxy = [0]; d.sxx = [0];
+  for (var i = 0; i < n; i++) {{
+    var x = d.x[i] - xm, y = d.y[i] - ym;
+    d.sx.push(d.sx[i] + x); d.sy.push(d.sy[i] + y); d.sxy.push(d.sxy[i] + x * y); d.sxx.push(d.sxx[i] + x * x);
+  }}
+}});
+function bisect(values, value, right) {{
+  var low = 0, high = values.length;
+  while (low < high) {{
+    var mid = (low + high) >> 1;
+    if (values[mid] < value || (right && values[mid] === value)) low = mid + 1; else high = mid;
+  }}
+  return low;
+}}
+function fit(d, left, right) {{
+  var i = bisect(d.x, left, true), j = bisect(d.x, right, false), n = j - i;
+  if (n < 2) return {{slope: NaN, intercept: NaN, vbi: NaN, n: Math.max(n, 0)}};
+  var sx = d.sx[j] - d.sx[i], sy = d.sy[j] - d.sy[i], sxy = d.sxy[j] - d.sxy[i], sxx = d.sxx[j] - d.sxx[i];
+  var slope = (sxy - sx * sy / n) / (sxx - sx * sx / n);
+  var intercept = (sy - slope * sx) / n + d.ym - slope * d.xm;
+  return {{slope: slope, intercept: intercept, vbi: -intercept / slope, n: n}};
+}}
+var controls = document.getElementById('controls');
+var inputs = [];
+DATA.directions.forEach(function (d, k) {{
+  var row = controls.insertRow();
+  row.insertCell().textContent = d.name;
+  [0, 1].forEach(function (side) {{
+    var input = document.createElement('input');
+    input.type = 'range'; input.min = DATA.low; input.max = DATA.high; input.step = (DATA.high - DATA.low) / 1000;
+    input.value = DATA.bounds[2 * k + side]; input.oninput = draw; input.disabled = !d.x.length;
+    row.insertCell().appendChild(input);
+    inputs.push(input);
+  }});
+  d.label = row.insertCell();
+}});
+function draw() {{
+  var canvas = document.getElementById('plot'), ctx = canvas.getContext('2d');
+  var w = canvas.width, h = canvas.height, pad = 50;
+  ctx.clearRect(0, 0, w, h);
+  function px(x) {{ return pad + (x - DATA.low) / (DATA.high - DATA.low) * (w - 2 * pad); }}
+  function py(y) {{ return h - pad - (y - DATA.ymin) / (DATA.ymax - DATA.ymin) * (h - 2 * pad); }}
+  var bounds = inputs.map(function (input) {{ return parseFloat(input.value); }});
+  DATA.directions.forEach(function (d, k) {{
+    if (!d.x.length) {{
+      d.label.textContent = 'no points';
+      bounds[2 * k] = NaN; bounds[2 * k + 1] = NaN;
+      return;
+    }}
+    var left = Math.min(bounds[2 * k], bounds[2 * k + 1]), right = Math.max(bounds[2 * k], bounds[2 * k + 1]);
+    ctx.fillStyle = COLOURS[k][0];
+    for (var i = 0; i < d.x.length; i++) ctx.fillRect(px(d.x[i]) - 2, py(d.y[i]) - 2, 4, 4);
+    ctx.globalAlpha = 0.15; ctx.fillRect(px(left), pad, px(right) - px(left), h - 2 * pad); ctx.globalAlpha = 1;
+    var f = fit(d, left, right);
+    ctx.strokeStyle = COLOURS[k][1]; ctx.beginPath();
+    ctx.moveTo(px(d.x[0]), py(f.slope * d.x[0] + f.intercept));
+    ctx.lineTo(px(d.x[d.x.length - 1]), py(f.slope * d.x[d.x.length - 1] + f.intercept)); ctx.stroke();
+    d.label.textContent = 'slope ' + f.slope.toPrecision(4) + ', Vbi ' + f.vbi.toFixed(4) + ' V from ' + f.n + ' points';
+    bounds[2 * k] = left; bounds[2 * k + 1] = right;
+  }});
+  ctx.strokeStyle = '#000'; ctx.strokeRect(pad, pad, w - 2 * pad, h - 2 * pad);
+  ctx.fillStyle = '#000'; ctx.fillText(DATA.low.toFixed(2) + ' V', pad, h - pad + 15);
+  ctx.fillText(DATA.high.toFixed(2) + ' V', w - pad - 30, h - pad + 15);
+  document.getElementById('row').textContent = [DATA.temp, DATA.freq].concat(bounds).join(',');
+}}
+document.getElementById('download').onclick = function () {{
+  var text = DATA.header.join(',') + '\\n' + document.getElementById('row').textContent + '\\n';
+  var link = document.createElement('a');
+  link.href = URL.createObjectURL(new Blob([text], {{type: 'text/csv'}}));
+  link.download = 'manual_line_params_' + DATA.temp + 'K_' + DATA.freq + 'Hz.csv';
+  link.click();
+}};
+draw();
+</script>
+</body>
+</html>
+'''
+
+
+def write_html(path, temp, freq, fitters, bounds):
+    # A standalone page with the same sliders and live refit as BoundPicker, for machines without an
+    # interactive backend. A page cannot write the table itself, so it shows the manual_line_params.csv row
+    # for the chosen bounds and offers it as a download.
+    voltages = np.concatenate([fitter.points[:, 0] for fitter in fitters] + [np.asarray(bounds)])
+    # nan bounds of a direction without points are left out of the range
+    y_values = np.concatenate([fitter.points[:, 1] for fitter in fitters])
+    data = {'temp': int(temp), 'freq': int(freq), 'header': MANUAL_HEADER, 'bounds': [float(bound) for bound in bounds],
+            'low': float(np.nanmin(voltages)), 'high': float(np.nanmax(voltages)),
+            'ymin': float(.99*np.min(y_values)), 'ymax': float(1.01*np.max(y_values)),
+            'directions': [{'name': direction, 'x': fitter.points[:, 0].tolist(), 'y': fitter.points[:, 1].tolist()}
+                           for direction, fitter in zip(DIRECTIONS, fitters)]}
+    with open(path, 'w') as htmlfile:
+        htmlfile.write(HTML_TEMPLATE.format(temp=temp, freq=freq, data=json.dumps(data)))
+
+
+def main():
+    config = configparser.RawConfigParser()
+    config.read('config.ini')
+
+    parser = argparse.ArgumentParser(description='Pick the manual fit bounds of one sweep of the [Paths] device '
+                                                 'with a live refit.')
+    parser.add_argument('temp', type=int, help='sweep temperature, K')
+    parser.add_argument('freq', type=int, help='sweep frequency, Hz')
+    parser.add_argument('--html', metavar='PATH', help='write a standalone page to pick the bounds in instead')
+    parser.add_argument('--bounds', nargs=4, type=float, metavar=('FL', 'FR', 'RL', 'RR'),
+                        help='write these forward and reverse bounds and print their fit, without a window')
+    args = parser.parse_args()
+
+    directory_name = config['Paths']['data_dir']
+    device_num = config['Paths']['device_num']
+    dir = batch.analysis_dir(directory_name)
+    fitters = load_fitters(directory_name, device_num, args.temp, args.freq, segments.segmentation(config),
+                           config.getboolean('Loader', 'cache', fallback=True),
+                           config.getboolean('Loader', 'store', fallback=True))
+    if fitters is None or not any(len(fitter.points) for fitter in fitters):
+        parser.error('no sweep of device {0} at {1}K, {2}Hz in {3}'.format(device_num, args.temp, args.freq,
+                                                                           directory_name))
+    if args.bounds:
+        write_bounds(dir, args.temp, args.freq, args.bounds)
+        print(fit_summary([fitter.fit(args.bounds[2*index], args.bounds[2*index + 1])
+                           for index, fitter in enumerate(fitters)]))
+        return
+    bounds = initial_bounds(dir, args.temp, args.freq, fitters)
+    if args.html:
+        write_html(args.html, args.temp, args.freq, fitters, bounds)
+        return
+    BoundPicker(dir, args.temp, args.freq, fitters, bounds).show()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+import os
+import re
+import glob
+import argparse
+import configparser
+import csv
+import cv_char_batch as batch
+import cv_char_physics as physics
+import cv_char_profiling as profiling
+from cv_char_manifest import set_incremental
+from cv_char_pipeline import STAGES, run_pipeline
+from cv_char_stream import stream_devices
+
+
+def find_devices(patterns, device_nums=None):
+    # Expands glob patterns of device data directories into sorted (directory_name, device_num) pairs.
+    # Device numbers are taken from device_nums, in the order of the sorted directories, when given,
+    # and otherwise from the last 'dev<N>' in each directory path.
+    directories = []
+    for pattern in patterns:
+        for match in sorted(glob.glob(pattern)):
+            # the raw file names are appended straight onto data_dir, so it keeps its trailing separator
+            directory_name = os.path.join(match, '')
+            if os.path.isdir(directory_name) and directory_name not in directories:
+                directories.append(directory_name)
+    directories.sort()
+
+    if device_nums:
+        if len(device_nums) != len(directories):
+            raise ValueError('{0} device numbers given for {1} data directories'.format(len(device_nums),
+                                                                                      len(directories)))
+        return list(zip(directories, [str(device_num) for device_num in device_nums]))
+
+    devices = []
+    for directory_name in directories:
+        found = re.findall(r'dev(\d+)', directory_name)
+        if not found:
+            raise ValueError('Cannot tell the device number of {0}, give it in device_nums'.format(directory_name))
+        devices.append((directory_name, found[-1]))
+    return devices
+
+
+def write_summary(summary_path, device_data):
+    with open(summary_path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(['Data Directory'] + ['Device'] + ['Frequency'] + list(physics.DATA_COLUMNS))
+        for (directory_name, device_num), freq_data in device_data.items():
+            for freq in batch.frequencies():
+                for row in physics.table_rows(freq_data[freq]):
+                    writer.writerow([directory_name, device_num, freq] + list(row))
+
+
+def run_campaign(devices, config, summary_path, stages=STAGES, stream=False):
+    pool = batch.make_pool(batch.get_processes(config))
+    try:
+        if stream:
+            device_data = stream_devices(devices, config, pool)
+        else:
+            device_data = run_pipeline(devices, config, stages, pool)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    write_summary(summary_path, device_data)
+    return device_data
+
+
+def main():
+    config = configparser.RawConfigParser()
+    config.read('config.ini')
+
+    parser = argparse.ArgumentParser(description='Fit and analyse several devices in one run.')
+    parser.add_argument('data_dirs', nargs='*',
+                        help='device data directories or glob patterns, defaults to [Campaign] data_dirs')
+    parser.add_argument('--device-nums', nargs='+',
+                        help='device numbers in the order of the sorted directories, defaults to the dev<N> in '
+                             'each path')
+    parser.add_argument('--summary-dir', help='where campaign_summary.csv is written')
+    parser.add_argument('--processes', type=int, help='worker processes, overrides [Batch] processes')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES),
+                        help='pipeline stages to run, by default all of them in order')
+    parser.add_argument('--full', action='store_true',
+                        help='recompute every sweep, ignoring the Analysis manifests')
+    parser.add_argument('--stream', action='store_true',
+                        help='run every stage one sweep at a time, for very large sweep sets')
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+
+    # one directory or pattern per line in config.ini, since lab paths can contain spaces
+    patterns = args.data_dirs or [line.strip() for line in config.get('Campaign', 'data_dirs', fallback='').splitlines()
+                                  if line.strip()]
+    device_nums = args.device_nums or config.get('Campaign', 'device_nums', fallback='').replace(',', ' ').split()
+    summary_dir = args.summary_dir or config.get('Campaign', 'summary_dir', fallback='.')
+    if args.processes is not None:
+        if not config.has_section('Batch'):
+            config.add_section('Batch')
+        config.set('Batch', 'processes', str(args.processes))
+    if args.full:
+        set_incremental(config, False)
+    profiling.apply_arguments(config, args)
+
+    devices = find_devices(patterns, device_nums)
+    if not devices:
+        parser.error('no device data directories found')
+    for directory_name, device_num in devices:
+        print('Device {0}: {1}'.format(device_num, directory_name))
+    profiling.start(config)
+    run_campaign(devices, config, os.path.join(summary_dir, 'campaign_summary.csv'),
+                 [stage for stage in STAGES if stage in args.stages], args.stream)
+    profiling.finish([batch.analysis_dir(directory_name) for directory_name, _ in devices])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,30 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import sys
-import scipy as sp
 from scipy import stats
 import os
 import configparser
 import csv
+import cv_char_streak_search as streak_search
+import cv_char_batch as batch
+import cv_char_store as store
+import cv_char_manifest as manifest
+import cv_char_profiling as profiling
+import cv_char_segments as segments
+import csv_replacer
+from cv_char_fit_cache import fit_key, open_fit_cache
+from cv_char_gen_figures import generate_figures
+
+FIT_MODES = ('vectorized', 'prefix_sum', 'reference')
+
+THRESHOLD_TABLE_HEADER = ['Temperature', 'Threshold Fraction', 'Forward Slope', 'Forward X Intercept',
+                          'Forward Y Intercept', 'Reverse Slope', 'Reverse X Intercept', 'Reverse Y Intercept']
 
 
 def find_streak(cap_vs_volt, start_index, diff_threshold):
     slope, y_intercept, r_value, streak_size = 0,0,0,0
     for end_index in range(start_index+3, cap_vs_volt.shape[0]):
-        slope, y_intercept, r_value, _, _ = sp.stats.linregress(cap_vs_volt[start_index:end_index, :])
+        profiling.count('linregress_calls')
+        slope, y_intercept, r_value, _, _ = stats.linregress(cap_vs_volt[start_index:end_index, 0],
+                                                             cap_vs_volt[start_index:end_index, 1])
         pred = slope * cap_vs_volt[start_index:end_index, 0] + y_intercept
         diff = np.max(np.abs(pred - cap_vs_volt[start_index:end_index, 1]))
         if diff > diff_threshold:
@@ -25,14 +38,35 @@ def find_streak(cap_vs_volt, start_index, diff_threshold):
     return streak_size, streak_dist, slope, x_intercept, y_intercept
 
 
-def find_ideal_cv_line(cap_vs_volt, energy_bandgap, diff_threshold_fraction):
+def find_ideal_cv_line(cap_vs_volt, energy_bandgap, diff_threshold_fraction, mode='vectorized'):
+    return find_ideal_cv_streak(cap_vs_volt, energy_bandgap, diff_threshold_fraction, mode)[:3]
+
+
+def find_ideal_cv_streak(cap_vs_volt, energy_bandgap, diff_threshold_fraction, mode='vectorized'):
+    # find_ideal_cv_line's (slope, x intercept, y intercept) and the distance its streak covers, which
+    # picks between the lines of several passes in the same direction
+    if mode not in FIT_MODES:
+        raise ValueError('Unknown fit mode {0}, expected one of {1}'.format(mode, FIT_MODES))
+    if mode == 'vectorized':
+        fit = streak_search.fit_thresholds(cap_vs_volt, energy_bandgap, [diff_threshold_fraction])[0]
+        return fit.slope, fit.x_intercept, fit.y_intercept, fit.streak_dist
     diff_threshold = diff_threshold_fraction*np.median(cap_vs_volt[:,1])
     size_threshold = 5
-    initial_slope, _, _, _, _ = sp.stats.linregress(cap_vs_volt[:10, :])
+    if mode == 'reference':
+        # original linregress-per-window search, O(n^3), kept to check the faster modes against
+        profiling.count('linregress_calls')
+        initial_slope, _, _, _, _ = stats.linregress(cap_vs_volt[:10, 0], cap_vs_volt[:10, 1])
+    else:
+        sums = streak_search.window_sums(cap_vs_volt)
+        initial_slope, _ = streak_search.window_line(sums, 0, min(10, cap_vs_volt.shape[0]))
     longest_streak_slope, longest_streak_dist, longest_streak_x_intercept, longest_streak_y_intercept = 0,0,0,0
     for start_index in range(cap_vs_volt.shape[0]):
-        current_streak_size, current_streak_dist, current_slope, current_x_intercept, current_y_intercept \
-            = find_streak(cap_vs_volt, start_index, diff_threshold)
+        if mode == 'reference':
+            current_streak_size, current_streak_dist, current_slope, current_x_intercept, current_y_intercept \
+                = find_streak(cap_vs_volt, start_index, diff_threshold)
+        else:
+            current_streak_size, current_streak_dist, current_slope, current_x_intercept, current_y_intercept \
+                = streak_search.find_streak(cap_vs_volt, start_index, diff_threshold, sums)
         if (current_slope < min(0, initial_slope)) and \
             (current_x_intercept < energy_bandgap) and \
             (current_streak_dist > longest_streak_dist) and \
@@ -41,7 +75,192 @@ def find_ideal_cv_line(cap_vs_volt, energy_bandgap, diff_threshold_fraction):
             longest_streak_slope, longest_streak_dist, longest_streak_x_intercept, longest_streak_y_intercept \
                 = current_slope,current_streak_dist, current_x_intercept, current_y_intercept
 
-    return longest_streak_slope, longest_streak_x_intercept, longest_streak_y_intercept
+    return longest_streak_slope, longest_streak_x_intercept, longest_streak_y_intercept, longest_streak_dist
+
+
+def direction_fits(direction_segments, energy_bandgap, diff_threshold_fractions):
+    # streak_search.fit_thresholds for one sweep direction of any number of passes: for each fraction the
+    # (pass index, ThresholdFit) of the pass whose line has the longest streak, the first of equally long
+    # ones, or (None, a fit without a line) when no pass has a line
+    segment_fits = [streak_search.fit_thresholds(segment, energy_bandgap, diff_threshold_fractions)
+                    for segment in direction_segments]
+    chosen = []
+    for index, fraction in enumerate(diff_threshold_fractions):
+        found = [(fits[index].streak_dist, -segment_index) for segment_index, fits in enumerate(segment_fits)
+                 if fits[index].start_index is not None]
+        if found:
+            segment_index = -max(found)[1]
+            chosen.append((segment_index, segment_fits[segment_index][index]))
+        else:
+            chosen.append((None, streak_search.ThresholdFit(fraction, 0, 0, 0, None, None, 0, 0)))
+    return chosen
+
+
+def _longest_line(segment_lines):
+    # the (slope, x intercept, y intercept) of the find_ideal_cv_streak results that found a line with the
+    # longest streak, the first of equally long ones, or a line of zeros
+    found = [line for line in segment_lines if line[0] != 0]
+    if not found:
+        return 0, 0, 0
+    return max(found, key=lambda line: line[3])[:3]
+
+
+def find_ideal_cv_lines(forward_segments, reverse_segments, energy_bandgap, diff_threshold_fractions,
+                        mode='vectorized'):
+    # Forward and reverse (slope, x intercept, y intercept) at the first threshold fraction that gives
+    # both directions a line, or at the last fraction if none does. Each direction is a list of passes,
+    # (voltage, 1/C^2) arrays, fitted separately; the pass whose line has the longest streak gives the
+    # direction's line. Also returns the threshold table, one (fraction, forward line, reverse line) row
+    # per fraction evaluated: the vectorized mode fits every fraction in one scan of each pass, the other
+    # modes stop at the first fraction that succeeds.
+    threshold_table = []
+    with profiling.timer('streak_search'):
+        if mode == 'vectorized':
+            forward_fits = [fit for _, fit in direction_fits(forward_segments, energy_bandgap,
+                                                             diff_threshold_fractions)]
+            reverse_fits = [fit for _, fit in direction_fits(reverse_segments, energy_bandgap,
+                                                             diff_threshold_fractions)]
+            for forward_fit, reverse_fit in zip(forward_fits, reverse_fits):
+                threshold_table.append((forward_fit.diff_threshold_fraction,
+                                        forward_fit.slope, forward_fit.x_intercept, forward_fit.y_intercept,
+                                        reverse_fit.slope, reverse_fit.x_intercept, reverse_fit.y_intercept))
+        else:
+            for diff_threshold_fraction in diff_threshold_fractions:
+                threshold_table.append((diff_threshold_fraction,) + tuple(
+                    _longest_line([find_ideal_cv_streak(segment, energy_bandgap, diff_threshold_fraction, mode)
+                                   for segment in forward_segments])) + tuple(
+                    _longest_line([find_ideal_cv_streak(segment, energy_bandgap, diff_threshold_fraction, mode)
+                                   for segment in reverse_segments])))
+                if threshold_table[-1][1] != 0 and threshold_table[-1][4] != 0:
+                    break
+    for index, row in enumerate(threshold_table):
+        if row[1] != 0 and row[4] != 0:
+            # a line only found at a looser threshold than the first goes down the retry path
+            if index > 0:
+                profiling.count('retry_threshold_hits')
+            break
+    else:
+        profiling.count('failed_fits')
+    return row[1:4], row[4:7], threshold_table
+
+
+def fit_sweep(forward_segments, reverse_segments, file_number, energy_bandgap, diff_threshold_fractions,
+              fit_mode='vectorized', fit_cache=None):
+    # Line params row and threshold table rows of one sweep's forward and reverse (voltage, 1/C^2) passes,
+    # as given by cv_char_segments.sweep_directions. With a fit_cache (cv_char_fit_cache.FitCache), a
+    # sweep already fitted with the same settings is not searched again.
+    lines = None
+    if fit_cache is not None:
+        key = fit_key(forward_segments, reverse_segments, energy_bandgap, diff_threshold_fractions, fit_mode)
+        lines = fit_cache.get(key)
+    if lines is None:
+        lines = find_ideal_cv_lines(forward_segments, reverse_segments, energy_bandgap,
+                                    diff_threshold_fractions, fit_mode)
+        if fit_cache is not None:
+            fit_cache.put(key, lines)
+    (ideal_forward_slope, ideal_forward_x_intercept, ideal_forward_y_intercept), \
+        (ideal_reverse_slope, ideal_reverse_x_intercept, ideal_reverse_y_intercept), threshold_table = lines
+
+    line_params = [file_number, ideal_forward_slope, ideal_forward_y_intercept, ideal_forward_x_intercept,
+                   ideal_reverse_slope, ideal_reverse_y_intercept, ideal_reverse_x_intercept]
+    threshold_rows = [(file_number,) + tuple(row) for row in threshold_table]
+    return line_params, threshold_rows
+
+
+def fit_sweep_file(directory_name, device_num, file_number, freq, energy_bandgap, diff_threshold_fractions,
+                   fit_mode='vectorized', use_cache=True, use_store=True, fit_cache=None, segmentation=None):
+    # One (temperature, frequency) file: returns its line params row and threshold table rows, or None
+    # when the file cannot be read.
+    print('Currently Working on Data of Temperature: {0} at Frequency {1}'.format(file_number, freq))
+    with profiling.file_timer('fit', directory_name, file_number, freq):
+        try:
+            cv_raw = store.load_sweep(directory_name, device_num, file_number, freq, use_cache, use_store)
+        except IOError:
+            profiling.count('files_skipped')
+            return None
+        forward_segments, reverse_segments = segments.sweep_directions(cv_raw, segmentation)
+        return fit_sweep(forward_segments, reverse_segments, file_number, energy_bandgap, diff_threshold_fractions,
+                         fit_mode, fit_cache)
+
+
+def fit_settings(config):
+    # (fit mode, diff threshold fractions, energy bandgap) for fit_sweep_file
+    fit_mode = config.get('Fitting', 'mode', fallback='vectorized')
+    diff_threshold_fractions = [float(fraction) for fraction in
+                                config.get('Fitting', 'diff_threshold_fractions', fallback='.0015, .015').split(',')]
+    return fit_mode, diff_threshold_fractions, config.getfloat('Constants', 'energy_bandgap')
+
+
+def fit_devices(devices, config, pool=None):
+    # Fits every (temperature, frequency) file of each (directory_name, device_num) in devices as one
+    # batch and writes each device's {freq}_line_params.csv. Sweeps whose raw file and fit settings are
+    # unchanged since the last run take their fit from the device's manifest, and the others from the fit
+    # cache when the same sweep was fitted before. Returns {device: {freq: line params rows}}.
+    fit_mode, diff_threshold_fractions, energy_bandgap = fit_settings(config)
+    write_threshold_table = config.getboolean('Fitting', 'threshold_table', fallback=False)
+    use_cache = config.getboolean('Loader', 'cache', fallback=True)
+    use_store = config.getboolean('Loader', 'store', fallback=True)
+    manifests = manifest.open_manifests(devices, config)
+    fit_cache = open_fit_cache(config)
+    segmentation = segments.segmentation(config)
+
+    tasks = [(directory_name, device_num, file_number, freq, energy_bandgap, diff_threshold_fractions, fit_mode,
+              use_cache, use_store, fit_cache, segmentation)
+             for directory_name, device_num in devices
+             for freq in batch.frequencies() for file_number in batch.temperatures(config)]
+    results = [None] * len(tasks)
+    fingerprints = [None] * len(tasks)
+    if manifests is not None:
+        for index, task in enumerate(tasks):
+            directory_name, device_num, file_number, freq = task[:4]
+            raw_hash = manifests[directory_name].sweep_hash(directory_name, device_num, file_number, freq,
+                                                            use_store)
+            if raw_hash is not None:
+                fingerprints[index] = manifest.fingerprint(raw_hash, fit_mode, diff_threshold_fractions,
+                                                           energy_bandgap, segmentation)
+            results[index] = manifests[directory_name].lookup('fit', manifest.sweep_key(device_num, file_number,
+                                                                                        freq),
+                                                              fingerprints[index])
+    stale = [index for index, result in enumerate(results) if result is None]
+    for index, result in zip(stale, batch.run_tasks(fit_sweep_file, [tasks[index] for index in stale],
+                                                     batch.get_processes(config), pool)):
+        results[index] = result
+        if manifests is not None and result is not None:
+            directory_name, device_num, file_number, freq = tasks[index][:4]
+            manifests[directory_name].record('fit', manifest.sweep_key(device_num, file_number, freq),
+                                             fingerprints[index], result)
+    manifest.save_manifests(manifests)
+    if fit_cache is not None:
+        fit_cache.prune()
+
+    device_line_params = {}
+    for directory_name, device_num in devices:
+        dir = batch.analysis_dir(directory_name)
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        device_line_params[(directory_name, device_num)] = {}
+        for freq in batch.frequencies():
+            freq_results = [result for task, result in zip(tasks, results)
+                            if task[:2] == (directory_name, device_num) and task[3] == freq and result is not None]
+            device_line_params[(directory_name, device_num)][freq] = [list(line_params)
+                                                                      for line_params, _ in freq_results]
+
+            if write_threshold_table:
+                with profiling.timer('write_tables'), open(os.path.join(dir, '{0}_threshold_fits.csv'.format(freq)), 'w', newline='') as csvfile:
+                    threshold_writer = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+                    threshold_writer.writerow(THRESHOLD_TABLE_HEADER)
+                    for _, threshold_rows in freq_results:
+                        threshold_writer.writerows(threshold_rows)
+        csv_replacer.write_all_line_params(dir, device_line_params[(directory_name, device_num)])
+    return device_line_params
+
+
+def write_manual_params_template(dir):
+    csv_name = 'manual_line_params.csv'
+    with open(os.path.join(dir, csv_name), 'w') as csvfile:
+        writer = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(['Temperature']+['Frequency']+['Forward Left Bound']+['Forward Right Bound']+
+                        ['Reverse Left Bound']+['Reverse Right Bound'])
 
 
 def main():
@@ -49,67 +268,12 @@ def main():
     config.read('config.ini')
     directory_name = config['Paths']['data_dir']
     device_num = config['Paths']['device_num']
-    dir = '{0}\Analysis'.format(directory_name)
-    min_temp = int(config['Temp Bounds']['min_temp'])
-    max_temp = int(config['Temp Bounds']['max_temp'])
-    if not os.path.isdir(dir):
-        os.makedirs(dir)
-
-    for frequency in range(3, 6):
-        freq = 10 ** frequency
-
-        csv_name = '{0}_line_params.csv'.format(freq)
-        with open(os.path.join(dir, csv_name), 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-            writer.writerow(
-                ['Temperature'] + ['Ideal Forward Slope'] + ['Ideal Forward Y Intercept'] +
-                ['Ideal Forward X Intercept'] + ['Ideal Reverse Slope'] + ['Ideal Reverse Y Intercept'] +
-                ['Ideal Reverse X Intercept'])
-
-            for file_number in range(min_temp, max_temp+5, 5):
-
-                print('Currently Working on Data of Temperature: {0} at Frequency {1}'.format(file_number, freq))
-                filename = "{0}dev{1}_T{2}K_F{3}HZ_CV.txt".format(directory_name, device_num, file_number, freq)
-                try:
-                    cv_raw = np.genfromtxt(filename, delimiter=',', skip_header=1, usecols=(0, 1))
-                except IOError:
-                    continue
-                capacitances = cv_raw[:, 1]
-                # voltages = cv_raw[:,0]
-                # voltages_inverse = -1*voltages
-                cap_inverse_square = np.reciprocal(np.square(capacitances))
-                cap_vs_volt = np.column_stack((cv_raw[:, 0], cap_inverse_square))
-                # cap_vs_volt = np.column_stack((voltages_inverse, cap_inverse_square))
-                cap_vs_volt_forward = cap_vs_volt[:int(cap_vs_volt.shape[0]/2), :]
-                cap_vs_volt_reverse = cap_vs_volt[int(cap_vs_volt.shape[0]/2):, :]
-                energy_bandgap = config.getfloat('Constants', 'energy_bandgap')
-
-                diff_threshold_fraction = .0015
-                ideal_forward_slope, ideal_forward_x_intercept, ideal_forward_y_intercept = \
-                    find_ideal_cv_line(cap_vs_volt_forward, energy_bandgap, diff_threshold_fraction)
-
-                ideal_reverse_slope, ideal_reverse_x_intercept, ideal_reverse_y_intercept = \
-                    find_ideal_cv_line(cap_vs_volt_reverse, energy_bandgap, diff_threshold_fraction)
-
-                if ideal_forward_slope is 0 or ideal_reverse_slope is 0:
-                    diff_threshold_fraction = .015
-                    ideal_forward_slope, ideal_forward_x_intercept, ideal_forward_y_intercept = \
-                        find_ideal_cv_line(cap_vs_volt_forward, energy_bandgap, diff_threshold_fraction)
-
-                    ideal_reverse_slope, ideal_reverse_x_intercept, ideal_reverse_y_intercept = \
-                        find_ideal_cv_line(cap_vs_volt_reverse, energy_bandgap, diff_threshold_fraction)
-
-                writer.writerow([file_number]+[ideal_forward_slope]+[ideal_forward_y_intercept]+[ideal_forward_x_intercept]
-                                +[ideal_reverse_slope]+[ideal_reverse_y_intercept]+[ideal_reverse_x_intercept])
-
-            csv_name = 'manual_line_params.csv'
-            with open(os.path.join(dir, csv_name), 'w') as csvfile:
-                writer = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-                writer.writerow(['Temperature']+['Frequency']+['Forward Left Bound']+['Forward Right Bound']+
-                                ['Reverse Left Bound']+['Reverse Right Bound'])
+
+    device_line_params = fit_devices([(directory_name, device_num)], config)
+    write_manual_params_template(batch.analysis_dir(directory_name))
 
     print("Generating Figures...")
-    os.system("cv_char_gen_figures.py")
+    generate_figures([(directory_name, device_num)], config, device_line_params=device_line_params)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,101 @@
+import os
+import json
+import hashlib
+import numpy as np
+import cv_char_manifest as manifest
+import cv_char_profiling as profiling
+
+# part of every key, to be raised whenever the fitting changes what it returns for the same sweep and
+# settings, so entries made by older code are never used
+FIT_CACHE_VERSION = 1
+
+DEFAULT_MAX_ENTRIES = 50000
+
+
+def cache_dir(config):
+    # [Fitting] fit_cache_dir, by default a folder in the user's home shared by every device and data drive
+    return config.get('Fitting', 'fit_cache_dir', fallback='') or \
+        os.path.join(os.path.expanduser('~'), '.cv_char', 'fit_cache')
+
+
+def open_fit_cache(config):
+    # The FitCache of [Fitting] fit_cache_dir, or None when [Fitting] fit_cache is off or the run is not
+    # incremental, since --full means every fit is searched again.
+    if not config.getboolean('Fitting', 'fit_cache', fallback=True) or not manifest.enabled(config):
+        return None
+    return FitCache(cache_dir(config), config.getint('Fitting', 'fit_cache_entries', fallback=DEFAULT_MAX_ENTRIES))
+
+
+def fit_key(forward_segments, reverse_segments, energy_bandgap, diff_threshold_fractions, fit_mode):
+    # sha1 of the forward and reverse (voltage, 1/C^2) passes, how many there are of each, and the settings
+    # the fit depends on
+    key = hashlib.sha1(json.dumps([FIT_CACHE_VERSION, fit_mode, energy_bandgap, list(diff_threshold_fractions),
+                                   len(forward_segments), len(reverse_segments)],
+                                  default=manifest.json_default).encode('utf-8'))
+    for segment in list(forward_segments) + list(reverse_segments):
+        segment = np.ascontiguousarray(segment, dtype=np.float64)
+        key.update(str(segment.shape).encode('utf-8'))
+        key.update(segment.tobytes())
+    return key.hexdigest()
+
+
+class FitCache:
+    # Line fits of sweeps by fit_key, one {key}.json file each, shared between processes and runs. A hit
+    # touches its file, so the least recently used entries are the oldest files, which prune removes once
+    # there are more than max_entries.
+
+    def __init__(self, dir, max_entries=DEFAULT_MAX_ENTRIES):
+        self.dir = dir
+        self.max_entries = max_entries
+
+    def _path(self, key):
+        return os.path.join(self.dir, '{0}.json'.format(key))
+
+    def get(self, key):
+        # the value put under key, or None
+        path = self._path(key)
+        try:
+            with open(path, 'r') as jsonfile:
+                value = json.load(jsonfile)
+            os.utime(path)
+        except (IOError, ValueError):
+            return None
+        profiling.count('fit_cache_hits')
+        return value
+
+    def put(self, key, value):
+        try:
+            if not os.path.isdir(self.dir):
+                os.makedirs(self.dir, exist_ok=True)
+            # written under a temporary name first so a parallel reader never sees a half-written entry
+            temporary = '{0}.{1}.tmp'.format(self._path(key), os.getpid())
+            with open(temporary, 'w') as jsonfile:
+                json.dump(value, jsonfile, default=manifest.json_default)
+            os.replace(temporary, self._path(key))
+        except OSError:
+            # a read-only or full cache drive only loses the reuse
+            pass
+
+    def prune(self):
+        # removes the least recently used entries past max_entries; returns how many were removed
+        try:
+            entries = [entry for entry in os.scandir(self.dir) if entry.name.endswith('.json')]
+        except OSError:
+            return 0
+        if len(entries) <= self.max_entries:
+            return 0
+        used = []
+        for entry in entries:
+            try:
+                used.append((entry.stat().st_mtime_ns, entry.path))
+            except OSError:
+                pass
+        used.sort()
+        removed = 0
+        for _, path in used[:len(used) - self.max_entries]:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        return removed
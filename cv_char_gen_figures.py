@@ -1,38 +1,216 @@
-import numpy as np
-import matplotlib.pyplot as plt
-import sys
-import scipy as sp
-from scipy import stats
 import os
 import configparser
 import csv
-
-
-def calculate_carrier_density(slope, epsilon_o, epsilon_r, elementary_charge, area, built_in_voltage):
-    carrier_density = -2/(elementary_charge*slope*epsilon_o*epsilon_r*area**2)
-    return carrier_density #m^-3
-
-
-def calculate_depletion_width(epsilon_o, epsilon_r, elementary_charge, carrier_density, built_in_voltage):
-    depletion_width = np.sqrt(np.abs((2*epsilon_o*epsilon_r*built_in_voltage))/abs((elementary_charge*carrier_density)))
-    return depletion_width #m^-3
-
-
-def calculate_energy_intrinsic(energy_conduction, energy_valence, boltzmann, eff_mass_hole, eff_mass_elec, temperature):
-    energy_intrinsic = (energy_conduction+energy_valence)/2 + .75*boltzmann*temperature*np.log(eff_mass_hole/eff_mass_elec)
-    return energy_intrinsic
-
-
-def calculate_intrinsic_carrier_concentration(density_of_states_valence, energy_valence, energy_intrinsic,
-                                              boltzmann, temperature):
-    intrinsic_carrier_concentration = density_of_states_valence*np.exp((energy_valence-energy_intrinsic)/(boltzmann*temperature))
-    return intrinsic_carrier_concentration #cm^-3
-
-
-def calculate_energy_fermi(boltzmann, energy_intrinsic, carrier_density, intrinsic_carrier_concentration, temperature):
-    energy_fermi = energy_intrinsic-boltzmann*temperature*np.log(np.abs(carrier_density*(1e-6)/intrinsic_carrier_concentration))
-
-    return energy_fermi
+import cv_char_batch as batch
+import cv_char_store as store
+import cv_char_manifest as manifest
+import cv_char_physics as physics
+import cv_char_plotting as plotting
+import cv_char_tables as tables
+import cv_char_profiling as profiling
+import cv_char_segments as segments
+import csv_replacer
+
+
+def read_device_line_params(devices):
+    return {(directory_name, device_num): {freq: csv_replacer.read_line_params(batch.analysis_dir(directory_name), freq)
+                                           for freq in batch.frequencies()}
+            for directory_name, device_num in devices}
+
+
+def compute_physics(device_line_params, config):
+    # {device: {freq: data table}} for {device: {freq: line params rows}}, computed for the whole grid at once
+    params = physics.load_params(config)
+    keys = [(device, freq) for device in device_line_params for freq in batch.frequencies()]
+    tables = physics.compute_tables([device_line_params[device][freq] for device, freq in keys], params)
+    device_data = {device: {} for device in device_line_params}
+    for (device, freq), table in zip(keys, tables):
+        device_data[device][freq] = table
+    return device_data
+
+
+def write_all_data(dir, freq_data):
+    # {freq}_data.csv for every {freq: data table} in freq_data, then their binary copy in data.npy
+    for freq, table in freq_data.items():
+        output_csv_name = '{0}_data.csv'.format(freq)
+        with profiling.timer('write_tables'), open(os.path.join(dir, output_csv_name), 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+            writer.writerow(physics.DATA_COLUMNS)
+            writer.writerows(physics.table_rows(table))
+    tables.write_tables(dir, tables.DATA, freq_data)
+
+
+def read_data(dir, freq):
+    # the {freq}_data.csv table, from data.npy unless the csv is newer
+    table = tables.read_table(dir, tables.DATA, freq)
+    if table is not None:
+        return table
+    with open(os.path.join(dir, '{0}_data.csv'.format(freq)), 'r') as csvfile:
+        reader = csv.reader(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+        next(reader, None)
+        return physics.table_from_rows([line for line in reader if line])
+
+
+def plot_sweeps(device_line_params, config, pool=None, render=True, use_store=None):
+    # CV plots of every line params row of every device, as one batch. A plot is only redrawn when its
+    # raw file or line has changed since it was last saved, or the PNG is gone. Returns {device: {freq:
+    # line params rows whose raw file could be read}}, which without render is all that is worked out.
+    # use_store overrides [Loader] store.
+    use_cache = config.getboolean('Loader', 'cache', fallback=True)
+    if use_store is None:
+        use_store = config.getboolean('Loader', 'store', fallback=True)
+    segmentation = segments.segmentation(config)
+    if not render:
+        return {(directory_name, device_num): {freq: [line_params for line_params in freq_line_params[freq]
+                                                      if store.has_sweep(directory_name, device_num, line_params[0],
+                                                                         freq, use_store)]
+                                               for freq in batch.frequencies()}
+                for (directory_name, device_num), freq_line_params in device_line_params.items()}
+    manifests = manifest.open_manifests(device_line_params, config)
+    tasks = []
+    for (directory_name, device_num), freq_line_params in device_line_params.items():
+        dir = batch.analysis_dir(directory_name)
+        if not os.path.isdir(dir):
+             os.makedirs(dir)
+        for freq in batch.frequencies():
+            tasks.extend((directory_name, device_num, dir, freq, line_params, use_cache, use_store, segmentation)
+                         for line_params in freq_line_params[freq])
+
+    plotted = [False] * len(tasks)
+    fingerprints = [None] * len(tasks)
+    if manifests is not None:
+        for index, (directory_name, device_num, dir, freq, line_params, _, _, _) in enumerate(tasks):
+            raw_hash = manifests[directory_name].sweep_hash(directory_name, device_num, line_params[0], freq,
+                                                            use_store)
+            if raw_hash is not None:
+                fingerprints[index] = manifest.fingerprint(raw_hash, list(line_params), segmentation)
+            pic_name = 'CV_{0}K_{1}Hz.png'.format(line_params[0], freq)
+            plotted[index] = os.path.isfile(os.path.join(dir, pic_name)) and \
+                manifests[directory_name].lookup('figure', manifest.sweep_key(device_num, line_params[0], freq),
+                                                 fingerprints[index]) is not None
+    stale = [index for index, found in enumerate(plotted) if not found]
+    for index, found in zip(stale, batch.run_tasks(plotting.plot_sweep, [tasks[index] for index in stale],
+                                                    batch.get_processes(config), pool)):
+        plotted[index] = found
+        if manifests is not None and found:
+            directory_name, device_num, _, freq, line_params = tasks[index][:5]
+            manifests[directory_name].record('figure', manifest.sweep_key(device_num, line_params[0], freq),
+                                             fingerprints[index], True)
+    manifest.save_manifests(manifests)
+    return {device: {freq: [task[4] for task, found in zip(tasks, plotted) if task[:2] == device and task[3] == freq
+                            and found]
+                     for freq in batch.frequencies()}
+            for device in device_line_params}
+
+
+def plot_trends(device_data, config, pool=None):
+    # Temperature trend plots of every device and frequency, skipping the ones whose values are unchanged
+    # since they were last saved.
+    manifests = manifest.open_manifests(device_data, config)
+    trend_tasks = []
+    trend_keys = []
+    for (directory_name, device_num), freq_data in device_data.items():
+        dir = batch.analysis_dir(directory_name)
+        for freq in batch.frequencies():
+            for var_name, x_temp, values in trend_series(freq_data[freq]):
+                if manifests is not None:
+                    key = manifest.frequency_key(device_num, freq, var_name)
+                    input_fingerprint = manifest.fingerprint(x_temp, values)
+                    pic_name = 'Temperature vs. {0} at {1}Hz.png'.format(var_name, freq)
+                    if os.path.isfile(os.path.join(dir, pic_name)) and \
+                            manifests[directory_name].lookup('trend', key, input_fingerprint) is not None:
+                        continue
+                    trend_keys.append((directory_name, key, input_fingerprint))
+                trend_tasks.append((dir, freq, var_name, x_temp, values))
+
+    batch.run_tasks(plotting.plot_temperature_trend, trend_tasks, batch.get_processes(config), pool)
+    if manifests is not None:
+        for directory_name, key, input_fingerprint in trend_keys:
+            manifests[directory_name].record('trend', key, input_fingerprint, True)
+        manifest.save_manifests(manifests)
+
+
+def trend_series(table):
+    # [(var_name, temperatures, values)] of the trend plots of one data table, none for an empty table
+    if not physics.table_length(table):
+        return []
+    dependent_vars_list = [table['Carrier Density'], table['Depletion Width'], table['Intrinsic Energy'],
+                           table['Intrinsic Carrier Concentration'], table['Fermi Energy'], table['Averaged Vbi']]
+    return [(var_name, table['Temperature'], values)
+            for var_name, values in zip(plotting.TREND_VAR_NAMES, dependent_vars_list)]
+
+
+def plot_summaries(device_line_params, device_data, config, pool=None, use_store=None):
+    # One grid image pair or PDF per device and frequency, for [Plotting] layout grid or pdf, holding all
+    # of its sweeps and trends. Frequencies whose sweeps and values are unchanged are not redrawn.
+    # use_store overrides [Loader] store.
+    layout = plotting.plot_layout(config)
+    plot_function = plotting.plot_frequency_grid if layout == 'grid' else plotting.plot_frequency_pdf
+    use_cache = config.getboolean('Loader', 'cache', fallback=True)
+    if use_store is None:
+        use_store = config.getboolean('Loader', 'store', fallback=True)
+    segmentation = segments.segmentation(config)
+    manifests = manifest.open_manifests(device_line_params, config)
+    tasks = []
+    summary_keys = []
+    for (directory_name, device_num), freq_line_params in device_line_params.items():
+        dir = batch.analysis_dir(directory_name)
+        for freq in batch.frequencies():
+            trends = trend_series(device_data[(directory_name, device_num)][freq])
+            if not freq_line_params[freq] and not trends:
+                continue
+            if manifests is not None:
+                raw_hashes = [manifests[directory_name].sweep_hash(directory_name, device_num, line_params[0], freq,
+                                                                   use_store)
+                              for line_params in freq_line_params[freq]]
+                input_fingerprint = None
+                if None not in raw_hashes:
+                    input_fingerprint = manifest.fingerprint(raw_hashes, [list(line_params) for line_params
+                                                                          in freq_line_params[freq]], trends,
+                                                             segmentation)
+                key = manifest.frequency_key(device_num, freq, layout)
+                if all(os.path.isfile(os.path.join(dir, filename))
+                       for filename in plotting.summary_filenames(freq, layout)) and \
+                        manifests[directory_name].lookup('summary', key, input_fingerprint) is not None:
+                    continue
+                summary_keys.append((directory_name, key, input_fingerprint))
+            tasks.append((directory_name, device_num, dir, freq, freq_line_params[freq], trends, use_cache,
+                          use_store, segmentation))
+
+    batch.run_tasks(plot_function, tasks, batch.get_processes(config), pool)
+    if manifests is not None:
+        for directory_name, key, input_fingerprint in summary_keys:
+            manifests[directory_name].record('summary', key, input_fingerprint, True)
+        manifest.save_manifests(manifests)
+
+
+def plot_frequency_figures(device_line_params, device_data, config, pool=None, use_store=None):
+    # the figures drawn once the data tables exist: the trend plots, or the grid or pdf summaries, whose
+    # sweeps are read with use_store overriding [Loader] store
+    if plotting.plot_layout(config) == 'png':
+        plot_trends(device_data, config, pool)
+    else:
+        plot_summaries(device_line_params, device_data, config, pool, use_store)
+
+
+def generate_figures(devices, config, pool=None, device_line_params=None, render=None):
+    # Sweep plots, physics and trend plots for each (directory_name, device_num) in devices, from
+    # device_line_params ({device: {freq: line params rows}}) or else from the {freq}_line_params.csv
+    # tables. Writes each device's {freq}_data.csv and returns {device: {freq: data table}}. The plots
+    # are only drawn with render, which defaults to [Plotting] figures being all.
+    if render is None:
+        render = plotting.figures_mode(config) == 'all'
+    if device_line_params is None:
+        device_line_params = read_device_line_params(devices)
+    # as before, rows whose raw file has gone missing are left out of the data tables
+    device_line_params = plot_sweeps({device: device_line_params[device] for device in devices}, config, pool,
+                                     render and plotting.plot_layout(config) == 'png')
+    device_data = compute_physics(device_line_params, config)
+    for (directory_name, device_num), freq_data in device_data.items():
+        write_all_data(batch.analysis_dir(directory_name), freq_data)
+    if render:
+        plot_frequency_figures(device_line_params, device_data, config, pool)
+    return device_data
 
 
 def main():
@@ -40,136 +218,9 @@ def main():
     config.read('config.ini')
     directory_name = config['Paths']['data_dir']
     device_num = config['Paths']['device_num']
-    dir = '{0}\Analysis'.format(directory_name)
-    if not os.path.isdir(dir):
-         os.makedirs(dir)
-
-    for frequency in range(3, 6):
-        freq = 10**frequency
-
-        data = []
-
-        input_csv_name = '{0}_line_params.csv'.format(freq)
-        with open(os.path.join(dir, input_csv_name), 'r') as csvfile:
-            reader = csv.DictReader(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-
-            output_csv_name = '{0}_data.csv'.format(freq)
-            with open(os.path.join(dir, output_csv_name), 'w', newline='') as csvfile:
-                writer = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-                writer.writerow(['Temperature'] + ['Carrier Density'] + ['Depletion Width'] + ['Intrinsic Energy'] +
-                                ['Intrinsic Carrier Concentration'] + ['Fermi Energy'] + ['Forward Vbi'] + [
-                                    'Reverse Vbi'] + ['Averaged Vbi'])
-
-                for row in reader:
-                    temp = int(row['Temperature'])
-                    ideal_forward_slope = float(row['Ideal Forward Slope'])
-                    ideal_forward_y_intercept = float(row['Ideal Forward Y Intercept'])
-                    ideal_forward_x_intercept = float(row['Ideal Forward X Intercept'])
-                    ideal_reverse_slope = float(row['Ideal Reverse Slope'])
-                    ideal_reverse_y_intercept = float(row['Ideal Reverse Y Intercept'])
-                    ideal_reverse_x_intercept = float(row['Ideal Reverse X Intercept'])
-
-                    filename = "{0}dev{1}_T{2}K_F{3}HZ_CV.txt".format(directory_name, device_num, temp, freq)
-                    try:
-                        cv_raw = np.genfromtxt(filename, delimiter=',', skip_header=1, usecols=(0, 1))
-                    except IOError:
-                        continue
-
-                    capacitances = cv_raw[:, 1]
-                    cap_inverse_square = np.reciprocal(np.square(capacitances))
-                    # voltages = cv_raw[:, 0]
-                    # voltages_inverse = -1 * voltages
-                    cap_vs_volt = np.column_stack((cv_raw[:, 0], cap_inverse_square))
-                    # cap_vs_volt = np.column_stack((voltages_inverse, cap_inverse_square))
-                    cap_vs_volt_forward = cap_vs_volt[:int(cap_vs_volt.shape[0]/2), :]
-                    cap_vs_volt_reverse = cap_vs_volt[int(cap_vs_volt.shape[0]/2):, :]
-
-                    # *************Creating and Saving Plots********************************************************
-                    x_forward = cap_vs_volt_forward[:,0]
-                    y_forward = cap_vs_volt_forward[:,1]
-                    x_reverse = cap_vs_volt_reverse[:, 0]
-                    y_reverse = cap_vs_volt_reverse[:, 1]
-                    fig, ax = plt.subplots()
-                    axes = plt.gca()
-                    axes.set_ylim([.99*np.min(cap_vs_volt[:,1]), 1.01*np.max(cap_vs_volt[:,1])])
-                    ax.plot(x_forward, y_forward,'.', markersize = 10, label='Forward Sweep')
-                    ax.plot(x_reverse, y_reverse, '.', markersize=10, label='Reverse Sweep')
-                    ax.plot(x_forward, ideal_forward_slope * x_forward + ideal_forward_y_intercept, '-', label='Forward Sweep Ideal Line')
-                    ax.plot(x_reverse, ideal_reverse_slope * x_reverse + ideal_reverse_y_intercept, '-', label='Reverse Sweep Ideal Line')
-                    fig.suptitle('Inverse Square Capacitance vs. Voltage-{0}K at {1}Hz'.format(temp, freq), fontsize=20)
-                    plt.ylabel(r'Inverse Square Capacitance, $C^{-2}(F^{-2})$',fontsize=15)
-                    plt.xlabel('Voltage, V (Volts)',fontsize=15)
-                    plt.tick_params(axis='both', which='major', labelsize=15)
-                    plt.locator_params(axis='y', nbins=5)
-                    pic_name='CV_{0}K_{1}Hz.png'.format(temp, freq)
-                    fig.savefig(os.path.join(dir,pic_name))
-                    # plt.show()
-                    plt.close('all')
-                    # **********************************************************************************************
-
-                    # ***********************Import Constants From Config*******************************************
-
-                    averaged_slope = np.mean((ideal_forward_slope, ideal_reverse_slope))
-                    averaged_x_intercept = np.mean((ideal_forward_x_intercept, ideal_reverse_x_intercept))
-                    epsilon_o = config.getfloat('Constants', 'epsilon_o')
-                    epsilon_r = config.getfloat('Constants', 'epsilon_r')
-                    elementary_charge = config.getfloat('Constants', 'elementary_charge')
-                    area = config.getfloat('Constants', 'area')
-                    energy_conduction = config.getfloat('Constants', 'energy_conduction')
-                    energy_valence = config.getfloat('Constants', 'energy_valence')
-                    mass_carrier = config.getfloat('Constants', 'mass_carrier')
-                    eff_mass_hole = mass_carrier*config.getfloat('Constants', 'relative_hole_eff_mass')
-                    eff_mass_elec = mass_carrier*config.getfloat('Constants', 'relative_elec_eff_mass')
-                    boltzmann = config.getfloat('Constants', 'boltzmann')
-                    volume_nc = (4/3)*np.pi*config.getfloat('Constants', 'radius_nc')**3
-                    density_of_states_valence = (2/volume_nc)*config.getfloat('Constants', 'packing_fraction')
-
-                    # *********************************************************************************************
-                    carrier_density = calculate_carrier_density(averaged_slope, epsilon_o, epsilon_r,
-                                                                elementary_charge,area,built_in_voltage=averaged_x_intercept)
-
-                    depletion_width = calculate_depletion_width(epsilon_o, epsilon_r, elementary_charge, carrier_density,
-                                                                built_in_voltage=averaged_x_intercept)
-
-                    energy_intrinsic = calculate_energy_intrinsic(energy_conduction, energy_valence, boltzmann, eff_mass_hole,
-                                                                  eff_mass_elec, temp)
-
-                    intrinsic_carrier_concentration = calculate_intrinsic_carrier_concentration(density_of_states_valence,
-                                                                                                energy_valence, energy_intrinsic,
-                                                                                                boltzmann, temp)
-
-                    energy_fermi = calculate_energy_fermi(boltzmann, energy_intrinsic, carrier_density,
-                                                          intrinsic_carrier_concentration, temp)
-
-                    writer.writerow([temp]+[carrier_density]+[depletion_width]+[energy_intrinsic]+
-                                    [intrinsic_carrier_concentration]+[energy_fermi]+[ideal_forward_x_intercept]+
-                                    [ideal_reverse_x_intercept] + [averaged_x_intercept])
-
-                    data.append((temp, carrier_density, depletion_width, energy_intrinsic,
-                                 intrinsic_carrier_concentration, energy_fermi, averaged_x_intercept))
-
-        x_temp, carrier_density, depletion_width, energy_intrinsic, intrinsic_carrier_concentration,\
-        energy_fermi, built_in_voltage = zip(*data)
-
-        dependent_vars_list = [carrier_density, depletion_width, energy_intrinsic, intrinsic_carrier_concentration,
-                     energy_fermi, built_in_voltage]
-
-        var_names = ['Carrier Density, $cm^{-3}$', 'Depletion Width, $nm$', 'Intrinsic Energy, $eV$',
-                     'Intrinsic Carrier Concentration, $cm^{-3}$', 'Fermi Energy, $eV$', 'Vbi, $V$']
-
-        for index, var_name in enumerate(var_names):
-            fig, ax = plt.subplots()
-            fig.suptitle('Temperature, $K$ vs. {0} at {1}Hz'.format(var_name, freq), fontsize=20)
-            plt.ylabel(r'{0}'.format(var_name), fontsize=15)
-            plt.xlabel('Temperature, $K$', fontsize=15)
-            plt.tick_params(axis='both', which='major', labelsize=15)
-            plt.locator_params(axis='y', nbins=5)
-            pic_name = 'Temperature vs. {0} at {1}Hz.png'.format(var_name, freq)
-            ax.plot(x_temp, dependent_vars_list[index], '.', markersize=10)
-            fig.savefig(os.path.join(dir, pic_name))
-            # plt.show()
-            plt.close('all')
+    # an explicit run is the on-request render for [Plotting] figures: lazy
+    generate_figures([(directory_name, device_num)], config, render=plotting.figures_mode(config) != 'none')
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,57 @@
+import os
+import glob
+import numpy as np
+import cv_char_profiling as profiling
+
+
+def parse_cv_text(filename):
+    # Voltage and capacitance columns of an LCR meter export, after its header line.
+    profiling.count('files_parsed')
+    with profiling.timer('parse'):
+        try:
+            return np.loadtxt(filename, delimiter=',', skiprows=1, usecols=(0, 1), ndmin=2)
+        except ValueError:
+            # blank or malformed fields, which genfromtxt reads as nan
+            profiling.count('genfromtxt_fallbacks')
+            return np.genfromtxt(filename, delimiter=',', skip_header=1, usecols=(0, 1))
+
+
+def cache_path(filename, file_stat):
+    # the sidecar name carries the size and mtime of the text file it was parsed from, so an edited or
+    # re-recorded sweep never matches an old cache
+    return '{0}.{1}_{2}.npy'.format(filename, file_stat.st_size, file_stat.st_mtime_ns)
+
+
+def load_cv_file(filename, use_cache=True):
+    # Same array as np.genfromtxt(filename, delimiter=',', skip_header=1, usecols=(0, 1)). With use_cache
+    # the parsed array is saved next to the file as a .npy sidecar and later loads memory-map it. Raises
+    # IOError when the file does not exist, like genfromtxt.
+    file_stat = os.stat(filename)
+    if not use_cache:
+        return parse_cv_text(filename)
+
+    sidecar = cache_path(filename, file_stat)
+    if os.path.isfile(sidecar):
+        try:
+            cv_raw = np.load(sidecar, mmap_mode='r')
+            profiling.count('cache_hits')
+            return cv_raw
+        except (IOError, ValueError):
+            pass
+
+    cv_raw = parse_cv_text(filename)
+    for stale in glob.glob(glob.escape(filename) + '.*_*.npy'):
+        try:
+            os.remove(stale)
+        except OSError:
+            pass
+    try:
+        # written under a temporary name first so a parallel reader never maps a half-written file
+        temporary = '{0}.{1}.tmp'.format(sidecar, os.getpid())
+        with open(temporary, 'wb') as npyfile:
+            np.save(npyfile, cv_raw)
+        os.replace(temporary, sidecar)
+    except OSError:
+        # read-only data drives still get the parsed array, just no cache
+        pass
+    return cv_raw
@@ -0,0 +1,125 @@
+import os
+import json
+import hashlib
+import numpy as np
+import cv_char_batch as batch
+import cv_char_store as store
+import cv_char_profiling as profiling
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def enabled(config):
+    # [Batch] incremental: False recomputes every stage from scratch, as before the manifest
+    return config.getboolean('Batch', 'incremental', fallback=True)
+
+
+def set_incremental(config, incremental):
+    if not config.has_section('Batch'):
+        config.add_section('Batch')
+    config.set('Batch', 'incremental', str(incremental))
+
+
+def json_default(value):
+    # json.dump default for the numpy scalars in the fit rows and numpy columns of the data tables, shared
+    # with the fit cache
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    raise TypeError('{0!r} cannot be written as json'.format(value))
+
+
+def fingerprint(*parts):
+    # sha1 of the parts as json, so equal numbers and strings always give the same fingerprint
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=json_default).encode('utf-8')).hexdigest()
+
+
+def sweep_key(device_num, temp, freq):
+    # keys name the device, since devices can share a data directory and so a manifest
+    return 'dev{0} {1}K_{2}Hz'.format(device_num, temp, freq)
+
+
+def frequency_key(device_num, freq, name):
+    # key of a figure drawn for a whole frequency, such as a trend plot or summary
+    return 'dev{0} {1}Hz {2}'.format(device_num, freq, name)
+
+
+class Manifest:
+    # Fingerprints and results of the work done in one Analysis folder, kept in manifest.json. Each
+    # stage maps a key, such as a device's (temperature, frequency) sweep, to the fingerprint of the inputs it
+    # was computed from and the result; a stage whose inputs fingerprint the same can reuse the result.
+    # Every result is dropped once a sweep store in the folder is packed again, since the results may
+    # have been worked out from the sweeps it held before.
+
+    def __init__(self, dir):
+        self.path = os.path.join(dir, MANIFEST_NAME)
+        self._files = {}
+        self._stages = {}
+        self._stores = store.container_stamps(dir)
+        try:
+            with open(self.path, 'r') as jsonfile:
+                contents = json.load(jsonfile)
+            self._files = contents.get('files', {})
+            if contents.get('stores', {}) == self._stores:
+                self._stages = contents.get('stages', {})
+        except (IOError, ValueError):
+            # no manifest yet, or a damaged one, which just means everything is recomputed
+            pass
+
+    def file_hash(self, filename):
+        # sha1 of the file's contents, or None when it does not exist. The hash is only recomputed when
+        # the file's size or mtime has changed since it was last taken.
+        try:
+            file_stat = os.stat(filename)
+        except OSError:
+            return None
+        known = self._files.get(filename)
+        if known is not None and known[:2] == [file_stat.st_size, file_stat.st_mtime_ns]:
+            return known[2]
+        with open(filename, 'rb') as rawfile:
+            file_hash = hashlib.sha1(rawfile.read()).hexdigest()
+        self._files[filename] = [file_stat.st_size, file_stat.st_mtime_ns, file_hash]
+        return file_hash
+
+    def sweep_hash(self, directory_name, device_num, temp, freq, use_store=True):
+        # sha1 of the raw text store.load_sweep reads the sweep from: that of its packed copy when the
+        # device store serves it, else that of its raw file, or None when there is neither
+        if use_store:
+            sweep_store = store.stored_sweep(directory_name, device_num, temp, freq)
+            if sweep_store is not None and sweep_store.source_hash(temp, freq) is not None:
+                return sweep_store.source_hash(temp, freq)
+        return self.file_hash(store.sweep_filename(directory_name, device_num, temp, freq))
+
+    def lookup(self, stage, key, input_fingerprint):
+        # the result recorded for key if it was computed from the same inputs, else None
+        entry = self._stages.get(stage, {}).get(key)
+        if entry is None or input_fingerprint is None or entry[0] != input_fingerprint:
+            return None
+        return entry[1]
+
+    def record(self, stage, key, input_fingerprint, result):
+        if input_fingerprint is None:
+            self._stages.get(stage, {}).pop(key, None)
+            return
+        self._stages.setdefault(stage, {})[key] = [input_fingerprint, result]
+
+    def save(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        temporary = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with profiling.timer('write_manifest'), open(temporary, 'w') as jsonfile:
+            json.dump({'files': self._files, 'stores': self._stores, 'stages': self._stages}, jsonfile,
+                      default=json_default)
+        os.replace(temporary, self.path)
+
+
+def open_manifests(devices, config):
+    # {directory_name: Manifest} for the devices, or None when incremental runs are switched off
+    if not enabled(config):
+        return None
+    return {directory_name: Manifest(batch.analysis_dir(directory_name)) for directory_name, _ in devices}
+
+
+def save_manifests(manifests):
+    if manifests is not None:
+        for manifest in manifests.values():
+            manifest.save()
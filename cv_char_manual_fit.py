@@ -1,11 +1,154 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import sys
-import scipy as sp
-from scipy import stats
 import os
 import configparser
 import csv
+import cv_char_batch as batch
+import cv_char_store as store
+import cv_char_manifest as manifest
+import cv_char_profiling as profiling
+import cv_char_segments as segments
+import csv_replacer
+from cv_char_gen_figures import generate_figures
+
+MANUAL_BOUNDS = ('Forward Left Bound', 'Forward Right Bound', 'Reverse Left Bound', 'Reverse Right Bound')
+
+
+def manual_points(cv_raw, bounds, segmentation=None):
+    # The forward and reverse (voltage, 1/C^2) points of a parsed sweep that a manual_line_params.csv row
+    # fits, with bounds in the order of MANUAL_BOUNDS. The sweep is cut into passes by
+    # segments.sweep_directions, with segmentation as (segments, min_points), and every pass gives its
+    # direction's points strictly between that direction's voltage bounds, selected with one mask per pass.
+    points = []
+    for direction, direction_segments in enumerate(segments.sweep_directions(cv_raw, segmentation)):
+        left_bound, right_bound = bounds[2*direction:2*direction + 2]
+        points.append(segments.join_segments([segment[(segment[:, 0] > left_bound) & (segment[:, 0] < right_bound), :]
+                                              for segment in direction_segments]))
+    return points
+
+
+def has_lines(points):
+    # whether every direction of manual_points has the two distinct voltages a line needs, without which
+    # a manual_line_params.csv row is not applied
+    return all(np.unique(direction_points[:, 0]).size >= 2 for direction_points in points)
+
+
+def fit_lines(x_values, y_values, groups, count):
+    # (slopes, y intercepts) of the least squares lines through the points of each of count groups, from
+    # the points of every group at once: groups gives each point's group. The sums are taken about each
+    # group's means, like linregress. A group with fewer than two distinct voltages gets nan.
+    sizes = np.bincount(groups, minlength=count)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_means = np.bincount(groups, x_values, count)/sizes
+        y_means = np.bincount(groups, y_values, count)/sizes
+        x_deviations = x_values - x_means[groups]
+        y_deviations = y_values - y_means[groups]
+        slopes = np.bincount(groups, x_deviations*y_deviations, count)/np.bincount(groups, x_deviations**2, count)
+    return slopes, y_means - slopes*x_means
+
+
+def fit_manual_rows(directory_name, device_num, rows, use_cache=True, use_store=True, segmentation=None):
+    # Fits rows of manual_line_params.csv between their voltage bounds, all in one fit_lines call.
+    # Returns a generated_line_params.csv row for each, or None when its raw file cannot be read or its
+    # bounds leave a direction without a line, which is reported.
+    x_values = []
+    y_values = []
+    groups = []
+    keys = []
+    accepted = []
+    for row in rows:
+        temp = int(row['Temperature'])
+        freq = int(row['Frequency'])
+        try:
+            cv_raw = store.load_sweep(directory_name, device_num, temp, freq, use_cache, use_store)
+        except IOError:
+            profiling.count('files_skipped')
+            keys.append(None)
+            accepted.append(False)
+            continue
+        row_points = manual_points(cv_raw, [float(row[name]) for name in MANUAL_BOUNDS], segmentation)
+        for direction, points in enumerate(row_points):
+            x_values.append(points[:, 0])
+            y_values.append(points[:, 1])
+            groups.append(np.full(points.shape[0], 2*len(keys) + direction))
+        keys.append((freq, temp))
+        accepted.append(has_lines(row_points))
+    if not x_values:
+        return [None] * len(keys)
+
+    slopes, y_intercepts = fit_lines(np.concatenate(x_values), np.concatenate(y_values), np.concatenate(groups),
+                                     2*len(keys))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_intercepts = -1*y_intercepts/slopes
+    results = []
+    for index, key in enumerate(keys):
+        if key is None:
+            results.append(None)
+            continue
+        forward, reverse = 2*index, 2*index + 1
+        if not accepted[index] or not np.isfinite(slopes[[forward, reverse]]).all():
+            report_unfitted(directory_name, device_num, key)
+            results.append(None)
+            continue
+        results.append(key + (float(slopes[forward]), float(y_intercepts[forward]), float(x_intercepts[forward]),
+                              float(slopes[reverse]), float(y_intercepts[reverse]), float(x_intercepts[reverse])))
+    return results
+
+
+def report_unfitted(directory_name, device_num, freq_temp):
+    print('Fewer than two distinct voltages between the manual bounds of device {0} at {1}K, {2}Hz in {3}; '
+          'it was not applied'.format(device_num, freq_temp[1], freq_temp[0], directory_name))
+
+
+def fit_manual_overrides(directory_name, device_num, config):
+    # Fits every row of the device's manual_line_params.csv and writes generated_line_params.csv. Rows
+    # whose bounds and raw file are unchanged since the last run take their fit from the manifest, and
+    # the others are fitted together by fit_manual_rows. Returns the generated rows, sorted by
+    # (frequency, temperature).
+    dir = batch.analysis_dir(directory_name)
+    input_csv_name = 'manual_line_params.csv'
+    output_csv_name = 'generated_line_params.csv'
+    use_cache = config.getboolean('Loader', 'cache', fallback=True)
+    use_store = config.getboolean('Loader', 'store', fallback=True)
+    segmentation = segments.segmentation(config)
+
+    with open(os.path.join(dir, input_csv_name), 'r') as csvfile:
+        reader = csv.DictReader(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+        rows = list(reader)
+    manifests = manifest.open_manifests([(directory_name, device_num)], config)
+    results = [None] * len(rows)
+    fingerprints = [None] * len(rows)
+    if manifests is not None:
+        for index, row in enumerate(rows):
+            temp, freq = int(row['Temperature']), int(row['Frequency'])
+            raw_hash = manifests[directory_name].sweep_hash(directory_name, device_num, temp, freq, use_store)
+            if raw_hash is not None:
+                fingerprints[index] = manifest.fingerprint(raw_hash, [float(row[name]) for name in MANUAL_BOUNDS],
+                                                           segmentation)
+            results[index] = manifests[directory_name].lookup('manual', manifest.sweep_key(device_num, temp, freq),
+                                                              fingerprints[index])
+    stale = [index for index, result in enumerate(results) if result is None]
+    stale_results = fit_manual_rows(directory_name, device_num, [rows[index] for index in stale],
+                                    use_cache, use_store, segmentation)
+    for index, result in zip(stale, stale_results):
+        results[index] = result
+        if manifests is not None and result is not None:
+            row = rows[index]
+            manifests[directory_name].record('manual', manifest.sweep_key(device_num, int(row['Temperature']),
+                                                                          int(row['Frequency'])),
+                                             fingerprints[index], result)
+    manifest.save_manifests(manifests)
+    data = [tuple(result) for result in results if result is not None]
+
+    with open(os.path.join(dir, output_csv_name), 'w') as csvfile:
+        writer = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL, lineterminator='\n')
+        writer.writerow(
+            ['Temperature'] + ['Frequency'] + ['Ideal Forward Slope'] + ['Ideal Forward Y Intercept'] +
+            ['Ideal Forward X Intercept'] + ['Ideal Reverse Slope'] + ['Ideal Reverse Y Intercept'] +
+            ['Ideal Reverse X Intercept'])
+
+        data_sorted = sorted(data)
+        writer.writerows(data_sorted)
+    return data_sorted
 
 
 def main():
@@ -13,82 +156,19 @@ def main():
     config.read('config.ini')
     directory_name = config['Paths']['data_dir']
     device_num = config['Paths']['device_num']
-    dir = '{0}\Analysis'.format(directory_name)
-    input_csv_name = 'manual_line_params.csv'
-    output_csv_name = 'generated_line_params.csv'
+    dir = batch.analysis_dir(directory_name)
     print("Generating Linear Fit Parameters...")
-
-    data = []
-
-    with open(os.path.join(dir, input_csv_name), 'r') as csvfile:
-        reader = csv.DictReader(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-
-        with open(os.path.join(dir, output_csv_name), 'w') as csvfile:
-            writer = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL, lineterminator='\n')
-            writer.writerow(
-                ['Temperature'] + ['Frequency'] + ['Ideal Forward Slope'] + ['Ideal Forward Y Intercept'] +
-                ['Ideal Forward X Intercept'] + ['Ideal Reverse Slope'] + ['Ideal Reverse Y Intercept'] +
-                ['Ideal Reverse X Intercept'])
-
-            for row in reader:
-
-                temp = int(row['Temperature'])
-                freq = int(row['Frequency'])
-                forward_left_bound = float(row['Forward Left Bound'])
-                forward_right_bound = float(row['Forward Right Bound'])
-                reverse_left_bound = float(row['Reverse Left Bound'])
-                reverse_right_bound = float(row['Reverse Right Bound'])
-
-                filename = "{0}dev{1}_T{2}K_F{3}HZ_CV.txt".format(directory_name, device_num,temp, freq)
-
-                try:
-                    cv_raw = np.genfromtxt(filename, delimiter=',', skip_header=1, usecols=(0, 1))
-                except IOError:
-                    continue
-
-                capacitances = cv_raw[:, 1]
-                # voltages = cv_raw[:, 0]
-                # voltages_inverse = -1 * voltages
-                cap_inverse_square = np.reciprocal(np.square(capacitances))
-                cap_vs_volt = np.column_stack((cv_raw[:,0], cap_inverse_square))
-                # cap_vs_volt = np.column_stack((voltages_inverse, cap_inverse_square))
-                cap_vs_volt_forward = cap_vs_volt[:int(cap_vs_volt.shape[0]/2), :]
-                cap_vs_volt_reverse = cap_vs_volt[int(cap_vs_volt.shape[0]/2):, :]
-                ideal_forward_x_values = []
-                ideal_forward_y_values = []
-                ideal_reverse_x_values = []
-                ideal_reverse_y_values = []
-
-                for index, voltage in enumerate(cap_vs_volt_forward[:, 0]):
-                    if (voltage > forward_left_bound) and (voltage < forward_right_bound):
-                        ideal_forward_x_values.append(voltage)
-                        ideal_forward_y_values.append(cap_vs_volt_forward[index, 1])
-
-                for index, voltage in enumerate(cap_vs_volt_reverse[:, 0]):
-                    if (voltage > reverse_left_bound) and (voltage < reverse_right_bound):
-                        ideal_reverse_x_values.append(voltage)
-                        ideal_reverse_y_values.append(cap_vs_volt_reverse[index, 1])
-
-                ideal_forward_slope, ideal_forward_y_intercept, _, _, _ = sp.stats.linregress(ideal_forward_x_values,
-                                                                                              ideal_forward_y_values)
-                ideal_reverse_slope, ideal_reverse_y_intercept, _, _, _ = sp.stats.linregress(ideal_reverse_x_values,
-                                                                                              ideal_reverse_y_values)
-
-                ideal_forward_x_intercept = -1*ideal_forward_y_intercept/ideal_forward_slope
-                ideal_reverse_x_intercept = -1*ideal_reverse_y_intercept/ideal_reverse_slope
-
-                data.append((freq, temp, ideal_forward_slope, ideal_forward_y_intercept, ideal_forward_x_intercept,
-                             ideal_reverse_slope, ideal_reverse_y_intercept, ideal_reverse_x_intercept))
-
-            data_sorted = sorted(data)
-            for row in data_sorted:
-                writer.writerow(row)
+    generated_line_params = fit_manual_overrides(directory_name, device_num, config)
 
     print("Integrating CSV Files...")
-    os.system("csv_replacer.py")
-    print("Regenerating Figures...")
-    os.system("cv_char_gen_figures.py")
+    line_params = {freq: csv_replacer.read_line_params(dir, freq) for freq in batch.frequencies()}
+    csv_replacer.report_unmatched(csv_replacer.merge_overrides({(directory_name, device_num): line_params},
+                                                               {(directory_name, device_num): generated_line_params}))
+    csv_replacer.write_all_line_params(dir, line_params)
 
+    print("Regenerating Figures...")
+    generate_figures([(directory_name, device_num)], config,
+                     device_line_params={(directory_name, device_num): line_params})
 
 
 if __name__ == '__main__':
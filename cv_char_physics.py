@@ -0,0 +1,151 @@
+import collections
+import numpy as np
+from numpy.lib import recfunctions
+
+# columns of {freq}_data.csv, in file order
+DATA_COLUMNS = ('Temperature', 'Carrier Density', 'Depletion Width', 'Intrinsic Energy',
+                'Intrinsic Carrier Concentration', 'Fermi Energy', 'Forward Vbi', 'Reverse Vbi', 'Averaged Vbi')
+
+# typed columns of a data table, a structured array with a field for each of DATA_COLUMNS
+DATA_DTYPE = np.dtype([('Temperature', np.int64)] + [(name, np.float64) for name in DATA_COLUMNS[1:]])
+
+# the [Constants] of config.ini that the physics needs, with the effective masses and valence band density
+# of states already derived
+PhysicsParams = collections.namedtuple('PhysicsParams', ['epsilon_o', 'epsilon_r', 'elementary_charge', 'area',
+                                                         'energy_conduction', 'energy_valence', 'eff_mass_hole',
+                                                         'eff_mass_elec', 'boltzmann',
+                                                         'density_of_states_valence'])
+
+
+def calculate_carrier_density(slope, epsilon_o, epsilon_r, elementary_charge, area, built_in_voltage):
+    carrier_density = -2/(elementary_charge*slope*epsilon_o*epsilon_r*area**2)
+    return carrier_density #m^-3
+
+
+def calculate_depletion_width(epsilon_o, epsilon_r, elementary_charge, carrier_density, built_in_voltage):
+    depletion_width = np.sqrt(np.abs((2*epsilon_o*epsilon_r*built_in_voltage))/abs((elementary_charge*carrier_density)))
+    return depletion_width #m^-3
+
+
+def calculate_energy_intrinsic(energy_conduction, energy_valence, boltzmann, eff_mass_hole, eff_mass_elec, temperature):
+    energy_intrinsic = (energy_conduction+energy_valence)/2 + .75*boltzmann*temperature*np.log(eff_mass_hole/eff_mass_elec)
+    return energy_intrinsic
+
+
+def calculate_intrinsic_carrier_concentration(density_of_states_valence, energy_valence, energy_intrinsic,
+                                              boltzmann, temperature):
+    intrinsic_carrier_concentration = density_of_states_valence*np.exp((energy_valence-energy_intrinsic)/(boltzmann*temperature))
+    return intrinsic_carrier_concentration #cm^-3
+
+
+def calculate_energy_fermi(boltzmann, energy_intrinsic, carrier_density, intrinsic_carrier_concentration, temperature):
+    energy_fermi = energy_intrinsic-boltzmann*temperature*np.log(np.abs(carrier_density*(1e-6)/intrinsic_carrier_concentration))
+
+    return energy_fermi
+
+
+# the [Constants] of config.ini that PhysicsParams are derived from
+CONSTANT_NAMES = ('epsilon_o', 'epsilon_r', 'elementary_charge', 'area', 'energy_conduction', 'energy_valence',
+                  'mass_carrier', 'relative_hole_eff_mass', 'relative_elec_eff_mass', 'boltzmann', 'radius_nc',
+                  'packing_fraction')
+
+
+def read_constants(config):
+    return {name: config.getfloat('Constants', name) for name in CONSTANT_NAMES}
+
+
+def derive_params(constants):
+    # PhysicsParams from {name: value} for CONSTANT_NAMES. The values may be arrays, which then broadcast
+    # through compute_table.
+    mass_carrier = constants['mass_carrier']
+    volume_nc = (4/3)*np.pi*constants['radius_nc']**3
+    return PhysicsParams(epsilon_o=constants['epsilon_o'],
+                         epsilon_r=constants['epsilon_r'],
+                         elementary_charge=constants['elementary_charge'],
+                         area=constants['area'],
+                         energy_conduction=constants['energy_conduction'],
+                         energy_valence=constants['energy_valence'],
+                         eff_mass_hole=mass_carrier*constants['relative_hole_eff_mass'],
+                         eff_mass_elec=mass_carrier*constants['relative_elec_eff_mass'],
+                         boltzmann=constants['boltzmann'],
+                         density_of_states_valence=(2/volume_nc)*constants['packing_fraction'])
+
+
+def load_params(config):
+    return derive_params(read_constants(config))
+
+
+def _line_params_array(line_params):
+    # line params rows, or a structured line params table, as a (rows, 7) float array
+    if isinstance(line_params, np.ndarray) and line_params.dtype.names is not None:
+        return recfunctions.structured_to_unstructured(line_params, dtype=float).reshape(-1, 7)
+    return np.asarray(line_params, dtype=float).reshape(-1, 7)
+
+
+def _table(columns):
+    table = np.empty(np.broadcast_shapes(*(np.shape(column) for column in columns)), DATA_DTYPE)
+    for name, column in zip(DATA_COLUMNS, columns):
+        table[name] = column
+    return table
+
+
+def compute_table(line_params, params):
+    # Data table, a DATA_DTYPE array, for the rows of a {freq}_line_params.csv table: [temperature,
+    # forward slope, y intercept, x intercept, reverse slope, y intercept, x intercept]. With array
+    # params, shaped (..., 1), the table has their shape with the rows along its last axis.
+    line_params = _line_params_array(line_params)
+    temperature = line_params[:, 0]
+    ideal_forward_slope = line_params[:, 1]
+    ideal_forward_x_intercept = line_params[:, 3]
+    ideal_reverse_slope = line_params[:, 4]
+    ideal_reverse_x_intercept = line_params[:, 6]
+
+    averaged_slope = (ideal_forward_slope + ideal_reverse_slope)/2
+    averaged_x_intercept = (ideal_forward_x_intercept + ideal_reverse_x_intercept)/2
+
+    carrier_density = calculate_carrier_density(averaged_slope, params.epsilon_o, params.epsilon_r,
+                                                params.elementary_charge, params.area,
+                                                built_in_voltage=averaged_x_intercept)
+
+    depletion_width = calculate_depletion_width(params.epsilon_o, params.epsilon_r, params.elementary_charge,
+                                                carrier_density, built_in_voltage=averaged_x_intercept)
+
+    energy_intrinsic = calculate_energy_intrinsic(params.energy_conduction, params.energy_valence, params.boltzmann,
+                                                  params.eff_mass_hole, params.eff_mass_elec, temperature)
+
+    intrinsic_carrier_concentration = calculate_intrinsic_carrier_concentration(
+        params.density_of_states_valence, params.energy_valence, energy_intrinsic, params.boltzmann, temperature)
+
+    energy_fermi = calculate_energy_fermi(params.boltzmann, energy_intrinsic, carrier_density,
+                                          intrinsic_carrier_concentration, temperature)
+
+    columns = (temperature.astype(int), carrier_density, depletion_width, energy_intrinsic,
+               intrinsic_carrier_concentration, energy_fermi, ideal_forward_x_intercept, ideal_reverse_x_intercept,
+               averaged_x_intercept)
+    return _table(columns)
+
+
+def compute_tables(line_params_tables, params):
+    # compute_table for several line params tables, e.g. every (device, frequency) of a campaign, as one
+    # set of array operations
+    line_params_tables = [_line_params_array(line_params) for line_params in line_params_tables]
+    if not line_params_tables:
+        return []
+    table = compute_table(np.concatenate(line_params_tables), params)
+    split_at = np.cumsum([len(line_params) for line_params in line_params_tables])[:-1]
+    return np.split(table, split_at)
+
+
+def table_from_rows(rows):
+    # data table from {freq}_data.csv rows
+    data = np.asarray(rows, dtype=float).reshape(-1, len(DATA_COLUMNS))
+    return _table([data[:, 0].astype(int)] + [data[:, index] for index in range(1, len(DATA_COLUMNS))])
+
+
+def table_rows(table):
+    # the table's rows, for csv writers
+    return zip(*(table[name] for name in DATA_COLUMNS))
+
+
+def table_length(table):
+    return len(table)
@@ -0,0 +1,122 @@
+import os
+import argparse
+import configparser
+import cv_char_batch as batch
+from cv_char_manifest import set_incremental
+import cv_char_gen_figures as gen_figures
+import cv_char_physics as physics
+import cv_char_plotting as plotting
+import cv_char_profiling as profiling
+import csv_replacer
+import var_temp_param_gen
+from cv_char_find_linear_fits import fit_devices, write_manual_params_template
+from cv_char_manual_fit import fit_manual_overrides
+from cv_char_stream import stream_devices
+
+# in running order; stages that are left out read their inputs from the Analysis tables instead
+STAGES = ('fit', 'manual', 'physics', 'figures', 'average')
+
+
+def run_pipeline(devices, config, stages=STAGES, pool=None):
+    # Runs the chosen stages for each (directory_name, device_num) in devices within this process,
+    # passing the line params and data tables between stages in memory. Every stage still writes its
+    # CSV tables. Returns {device: {freq: data table}}.
+    for stage in stages:
+        if stage not in STAGES:
+            raise ValueError('Unknown stage {0}, expected some of {1}'.format(stage, STAGES))
+    own_pool = pool is None
+    if own_pool:
+        pool = batch.make_pool(batch.get_processes(config))
+    try:
+        if 'fit' in stages:
+            print("Fitting Lines...")
+            profiling.stage('fit')
+            device_line_params = fit_devices(devices, config, pool)
+            for directory_name, _ in devices:
+                # keep the hand-picked bounds of devices that already have some
+                if not os.path.isfile(os.path.join(batch.analysis_dir(directory_name), 'manual_line_params.csv')):
+                    write_manual_params_template(batch.analysis_dir(directory_name))
+        else:
+            device_line_params = gen_figures.read_device_line_params(devices)
+
+        if 'manual' in stages:
+            print("Integrating Manual Fits...")
+            profiling.stage('manual')
+            device_generated_line_params = {
+                (directory_name, device_num): fit_manual_overrides(directory_name, device_num, config)
+                for directory_name, device_num in devices
+                if os.path.isfile(os.path.join(batch.analysis_dir(directory_name), 'manual_line_params.csv'))}
+            csv_replacer.report_unmatched(csv_replacer.merge_overrides(device_line_params,
+                                                                       device_generated_line_params))
+            for directory_name, device_num in device_generated_line_params:
+                csv_replacer.write_all_line_params(batch.analysis_dir(directory_name),
+                                                   device_line_params[(directory_name, device_num)])
+
+        render = plotting.figures_mode(config) == 'all'
+        if 'figures' in stages:
+            print("Generating Figures...")
+            profiling.stage('figures')
+            # as in gen_figures, rows whose raw file has gone missing are left out of the data tables
+            device_line_params = gen_figures.plot_sweeps(device_line_params, config, pool,
+                                                         render and plotting.plot_layout(config) == 'png')
+
+        if 'physics' in stages:
+            print("Calculating Physical Parameters...")
+            profiling.stage('physics')
+            device_data = gen_figures.compute_physics(device_line_params, config)
+            for (directory_name, device_num), freq_data in device_data.items():
+                gen_figures.write_all_data(batch.analysis_dir(directory_name), freq_data)
+        else:
+            device_data = {(directory_name, device_num): {
+                freq: gen_figures.read_data(batch.analysis_dir(directory_name), freq) for freq in batch.frequencies()}
+                for directory_name, device_num in devices}
+
+        if 'figures' in stages and render:
+            profiling.stage('figures')
+            gen_figures.plot_frequency_figures(device_line_params, device_data, config, pool)
+    finally:
+        if own_pool and pool is not None:
+            pool.close()
+            pool.join()
+        profiling.stage(None)
+
+    if 'average' in stages:
+        print("Averaging Parameters...")
+        profiling.stage('average')
+        for (directory_name, device_num), freq_data in device_data.items():
+            for freq in batch.frequencies():
+                if physics.table_length(freq_data[freq]):
+                    var_temp_param_gen.average_data(batch.analysis_dir(directory_name), freq, freq_data[freq], config)
+        profiling.stage(None)
+    return device_data
+
+
+def main():
+    config = configparser.RawConfigParser()
+    config.read('config.ini')
+
+    parser = argparse.ArgumentParser(description='Run the analysis stages for the [Paths] device in one process.')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES),
+                        help='stages to run, by default all of them in order')
+    parser.add_argument('--full', action='store_true',
+                        help='recompute every sweep, ignoring the Analysis manifest')
+    parser.add_argument('--stream', action='store_true',
+                        help='run every stage one sweep at a time with cv_char_stream, for very large sweep sets')
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    if args.full:
+        set_incremental(config, False)
+    profiling.apply_arguments(config, args)
+
+    directory_name = config['Paths']['data_dir']
+    device_num = config['Paths']['device_num']
+    profiling.start(config)
+    if args.stream:
+        stream_devices([(directory_name, device_num)], config)
+    else:
+        run_pipeline([(directory_name, device_num)], config, [stage for stage in STAGES if stage in args.stages])
+    profiling.finish([batch.analysis_dir(directory_name)])
+
+
+if __name__ == '__main__':
+    main()
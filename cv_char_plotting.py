@@ -0,0 +1,273 @@
+import os
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+import cv_char_store as store
+import cv_char_profiling as profiling
+import cv_char_segments as segments
+
+# [Plotting] figures: all draws every figure in the pipeline; lazy leaves them to an explicit
+# cv_char_gen_figures.py run; none never draws them
+FIGURE_MODES = ('all', 'lazy', 'none')
+
+# [Plotting] layout: png writes a file per sweep and per trend; grid tiles every sweep of a frequency into
+# one CV_{F}Hz_grid.png and its six trends into Trends_{F}Hz_grid.png; pdf puts both into pages of CV_{F}Hz.pdf
+PLOT_LAYOUTS = ('png', 'grid', 'pdf')
+
+TREND_VAR_NAMES = ['Carrier Density, $cm^{-3}$', 'Depletion Width, $nm$', 'Intrinsic Energy, $eV$',
+                   'Intrinsic Carrier Concentration, $cm^{-3}$', 'Fermi Energy, $eV$', 'Vbi, $V$']
+
+# figure templates of this process, built on first use and redrawn with new line data for every plot
+_templates = {}
+
+
+def figures_mode(config):
+    mode = config.get('Plotting', 'figures', fallback='all')
+    if mode not in FIGURE_MODES:
+        raise ValueError('Unknown figures mode {0}, expected one of {1}'.format(mode, FIGURE_MODES))
+    return mode
+
+
+def plot_layout(config):
+    layout = config.get('Plotting', 'layout', fallback='png')
+    if layout not in PLOT_LAYOUTS:
+        raise ValueError('Unknown plot layout {0}, expected one of {1}'.format(layout, PLOT_LAYOUTS))
+    return layout
+
+
+def summary_filenames(freq, layout):
+    # the files one frequency's plots go into for the grid and pdf layouts
+    if layout == 'grid':
+        return ['CV_{0}Hz_grid.png'.format(freq), 'Trends_{0}Hz_grid.png'.format(freq)]
+    return ['CV_{0}Hz.pdf'.format(freq)]
+
+
+class SweepFigure:
+    # CV_{T}K_{F}Hz.png layout: forward and reverse 1/C^2 points with their ideal lines
+
+    def __init__(self):
+        # drawn straight onto an Agg canvas, whatever backend pyplot is using
+        self.fig = Figure()
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.subplots()
+        self.forward_points, = self.ax.plot([], [], '.', markersize=10, label='Forward Sweep')
+        self.reverse_points, = self.ax.plot([], [], '.', markersize=10, label='Reverse Sweep')
+        self.forward_line, = self.ax.plot([], [], '-', label='Forward Sweep Ideal Line')
+        self.reverse_line, = self.ax.plot([], [], '-', label='Reverse Sweep Ideal Line')
+        self.title = self.fig.suptitle('', fontsize=20)
+        self.ax.set_ylabel(r'Inverse Square Capacitance, $C^{-2}(F^{-2})$', fontsize=15)
+        self.ax.set_xlabel('Voltage, V (Volts)', fontsize=15)
+        self.ax.tick_params(axis='both', which='major', labelsize=15)
+        self.ax.locator_params(axis='y', nbins=5)
+
+    def draw(self, cap_vs_volt_forward, cap_vs_volt_reverse, forward_line, reverse_line, temp, freq):
+        # forward_line and reverse_line are (slope, y intercept)
+        x_forward = cap_vs_volt_forward[:, 0]
+        x_reverse = cap_vs_volt_reverse[:, 0]
+        self.forward_points.set_data(x_forward, cap_vs_volt_forward[:, 1])
+        self.reverse_points.set_data(x_reverse, cap_vs_volt_reverse[:, 1])
+        self.forward_line.set_data(x_forward, forward_line[0] * x_forward + forward_line[1])
+        self.reverse_line.set_data(x_reverse, reverse_line[0] * x_reverse + reverse_line[1])
+        self.ax.relim()
+        self.ax.autoscale_view(scaley=False)
+        y_values = np.concatenate((cap_vs_volt_forward[:, 1], cap_vs_volt_reverse[:, 1]))
+        y_values = y_values[np.isfinite(y_values)]
+        if len(y_values):
+            self.ax.set_ylim([.99*np.min(y_values), 1.01*np.max(y_values)])
+        self.title.set_text('Inverse Square Capacitance vs. Voltage-{0}K at {1}Hz'.format(temp, freq))
+
+    def save(self, path):
+        with profiling.timer('savefig'):
+            self.fig.savefig(path)
+
+
+class TrendFigure:
+    # 'Temperature vs. {variable} at {F}Hz.png' layout: one variable against temperature
+
+    def __init__(self):
+        self.fig = Figure()
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.subplots()
+        self.title = self.fig.suptitle('', fontsize=20)
+        self.ax.set_xlabel('Temperature, $K$', fontsize=15)
+        self.ax.tick_params(axis='both', which='major', labelsize=15)
+        self.ax.locator_params(axis='y', nbins=5)
+        self.points, = self.ax.plot([], [], '.', markersize=10)
+
+    def draw(self, freq, var_name, x_temp, values):
+        self.points.set_data(x_temp, values)
+        self.ax.relim()
+        self.ax.autoscale_view()
+        self.ax.set_ylabel(r'{0}'.format(var_name), fontsize=15)
+        self.title.set_text('Temperature, $K$ vs. {0} at {1}Hz'.format(var_name, freq))
+
+    def save(self, path):
+        with profiling.timer('savefig'):
+            self.fig.savefig(path)
+
+
+def _template(figure_class):
+    if figure_class not in _templates:
+        _templates[figure_class] = figure_class()
+    return _templates[figure_class]
+
+
+def load_sweep_directions(directory_name, device_num, temp, freq, use_cache=True, use_store=True,
+                          segmentation=None):
+    # forward and reverse (voltage, 1/C^2) passes of a sweep, as cv_char_segments.sweep_directions, or None
+    # when the raw file cannot be read
+    try:
+        cv_raw = store.load_sweep(directory_name, device_num, temp, freq, use_cache, use_store)
+    except IOError:
+        profiling.count('files_skipped')
+        return None
+    return segments.sweep_directions(cv_raw, segmentation)
+
+
+def load_sweep_halves(directory_name, device_num, temp, freq, use_cache=True, use_store=True, segmentation=None):
+    # forward and reverse (voltage, 1/C^2) points of a sweep, each direction's passes joined, or None when
+    # the raw file cannot be read
+    directions = load_sweep_directions(directory_name, device_num, temp, freq, use_cache, use_store, segmentation)
+    if directions is None:
+        return None
+    return tuple(segments.join_segments(direction_segments) for direction_segments in directions)
+
+
+def plot_sweep(directory_name, device_num, dir, freq, line_params, use_cache=True, use_store=True,
+               segmentation=None):
+    # Saves CV_{T}K_{F}Hz.png for one line params row; returns False when the raw file cannot be read.
+    with profiling.file_timer('plot', directory_name, line_params[0], freq):
+        halves = load_sweep_halves(directory_name, device_num, line_params[0], freq, use_cache, use_store,
+                                   segmentation)
+        if halves is None:
+            return False
+        plot_sweep_halves(dir, freq, line_params, halves)
+        return True
+
+
+def plot_sweep_halves(dir, freq, line_params, halves):
+    # plot_sweep for a sweep whose forward and reverse points are already loaded
+    figure = _template(SweepFigure)
+    figure.draw(halves[0], halves[1], (line_params[1], line_params[2]), (line_params[4], line_params[5]),
+                line_params[0], freq)
+    figure.save(os.path.join(dir, 'CV_{0}K_{1}Hz.png'.format(line_params[0], freq)))
+
+
+def plot_temperature_trend(dir, freq, var_name, x_temp, values):
+    figure = _template(TrendFigure)
+    figure.draw(freq, var_name, x_temp, values)
+    figure.save(os.path.join(dir, 'Temperature vs. {0} at {1}Hz.png'.format(var_name, freq)))
+
+
+def _grid_shape(count):
+    columns = int(np.ceil(np.sqrt(count)))
+    return int(np.ceil(count / columns)), columns
+
+
+def _hide_unused(axes, used, columns):
+    # blanks the grid cells past the last panel, giving the panels above them back their voltage labels
+    for index in range(used, len(axes)):
+        axes[index].set_visible(False)
+        if index >= columns:
+            axes[index - columns].xaxis.set_tick_params(labelbottom=True)
+
+
+def plot_frequency_grid(directory_name, device_num, dir, freq, freq_line_params, trends, use_cache=True,
+                        use_store=True, segmentation=None):
+    # Tiles the sweeps of every line params row of one frequency into CV_{F}Hz_grid.png, one panel per
+    # temperature with a shared voltage axis, and trends, [(var_name, x_temp, values)], into
+    # Trends_{F}Hz_grid.png.
+    sweeps = []
+    for line_params in freq_line_params:
+        halves = load_sweep_halves(directory_name, device_num, line_params[0], freq, use_cache, use_store,
+                                   segmentation)
+        if halves is not None:
+            sweeps.append((line_params, halves))
+
+    if sweeps:
+        rows, columns = _grid_shape(len(sweeps))
+        fig = Figure(figsize=(4*columns, 3*rows))
+        FigureCanvasAgg(fig)
+        axes = fig.subplots(rows, columns, sharex=True, squeeze=False).ravel()
+        for ax, (line_params, (cap_vs_volt_forward, cap_vs_volt_reverse)) in zip(axes, sweeps):
+            x_forward = cap_vs_volt_forward[:, 0]
+            x_reverse = cap_vs_volt_reverse[:, 0]
+            ax.plot(x_forward, cap_vs_volt_forward[:, 1], '.', markersize=4, label='Forward Sweep')
+            ax.plot(x_reverse, cap_vs_volt_reverse[:, 1], '.', markersize=4, label='Reverse Sweep')
+            ax.plot(x_forward, line_params[1] * x_forward + line_params[2], '-', label='Forward Sweep Ideal Line')
+            ax.plot(x_reverse, line_params[4] * x_reverse + line_params[5], '-', label='Reverse Sweep Ideal Line')
+            y_values = np.concatenate((cap_vs_volt_forward[:, 1], cap_vs_volt_reverse[:, 1]))
+            y_values = y_values[np.isfinite(y_values)]
+            if len(y_values):
+                ax.set_ylim([.99*np.min(y_values), 1.01*np.max(y_values)])
+            ax.set_title('{0}K'.format(line_params[0]), fontsize=12)
+            ax.locator_params(axis='y', nbins=5)
+        _hide_unused(axes, len(sweeps), columns)
+        fig.suptitle('Inverse Square Capacitance vs. Voltage at {0}Hz'.format(freq), fontsize=20)
+        fig.supylabel(r'Inverse Square Capacitance, $C^{-2}(F^{-2})$', fontsize=15)
+        fig.supxlabel('Voltage, V (Volts)', fontsize=15)
+        fig.tight_layout()
+        with profiling.timer('savefig'):
+            fig.savefig(os.path.join(dir, 'CV_{0}Hz_grid.png'.format(freq)))
+
+    if trends:
+        rows, columns = _grid_shape(len(trends))
+        fig = Figure(figsize=(5*columns, 4*rows))
+        FigureCanvasAgg(fig)
+        axes = fig.subplots(rows, columns, sharex=True, squeeze=False).ravel()
+        for ax, (var_name, x_temp, values) in zip(axes, trends):
+            ax.plot(x_temp, values, '.', markersize=10)
+            ax.set_ylabel(r'{0}'.format(var_name), fontsize=12)
+            ax.locator_params(axis='y', nbins=5)
+        _hide_unused(axes, len(trends), columns)
+        fig.suptitle('Temperature Trends at {0}Hz'.format(freq), fontsize=20)
+        fig.supxlabel('Temperature, $K$', fontsize=15)
+        fig.tight_layout()
+        with profiling.timer('savefig'):
+            fig.savefig(os.path.join(dir, 'Trends_{0}Hz_grid.png'.format(freq)))
+    return [line_params for line_params, _ in sweeps]
+
+
+def plot_frequency_pdf(directory_name, device_num, dir, freq, freq_line_params, trends, use_cache=True,
+                       use_store=True, segmentation=None):
+    # Writes CV_{F}Hz.pdf: a page per sweep, drawn like CV_{T}K_{F}Hz.png, then a page per trend, drawn
+    # like the trend PNGs.
+    plotted = []
+    with PdfPages(os.path.join(dir, 'CV_{0}Hz.pdf'.format(freq))) as pdf:
+        sweep_figure = _template(SweepFigure)
+        for line_params in freq_line_params:
+            halves = load_sweep_halves(directory_name, device_num, line_params[0], freq, use_cache, use_store,
+                                       segmentation)
+            if halves is None:
+                continue
+            sweep_figure.draw(halves[0], halves[1], (line_params[1], line_params[2]),
+                              (line_params[4], line_params[5]), line_params[0], freq)
+            with profiling.timer('savefig'):
+                pdf.savefig(sweep_figure.fig)
+            plotted.append(line_params)
+        trend_figure = _template(TrendFigure)
+        for var_name, x_temp, values in trends:
+            trend_figure.draw(freq, var_name, x_temp, values)
+            with profiling.timer('savefig'):
+                pdf.savefig(trend_figure.fig)
+    return plotted
+
+
+def plot_sensitivity(dir, freq, name, values, outputs):
+    # 'Sensitivity to {name} at {F}Hz.png': a panel per (var_name, middle, low, high) of outputs, where
+    # middle holds the output at each of the values of the constant name, with the other varied
+    # constants at their middle values, and low and high bound it over every value of the others
+    fig = Figure(figsize=(5*len(outputs), 4))
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(1, len(outputs), squeeze=False).ravel()
+    for ax, (var_name, middle, low, high) in zip(axes, outputs):
+        ax.fill_between(values, low, high, alpha=.3)
+        ax.plot(values, middle, '.-', markersize=10)
+        ax.set_ylabel(r'{0}'.format(var_name), fontsize=12)
+        ax.locator_params(axis='y', nbins=5)
+    fig.suptitle('Sensitivity to {0} at {1}Hz'.format(name, freq), fontsize=20)
+    fig.supxlabel(name, fontsize=15)
+    fig.tight_layout()
+    with profiling.timer('savefig'):
+        fig.savefig(os.path.join(dir, 'Sensitivity to {0} at {1}Hz.png'.format(name, freq)))
@@ -0,0 +1,246 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import contextlib
+import collections
+
+# written into each device's Analysis folder by finish
+REPORT_NAME = 'run_report.json'
+PROFILE_NAME = 'run_profile.prof'
+
+# functions listed in the report from the cProfile capture, by cumulative time
+PROFILE_TOP = 25
+
+
+class _Collector:
+    # What this process has measured since the collector was made: {name: [calls, wall, cpu]} timers,
+    # counters, per-file timings and, with cprofile, a cProfile capture. Pool workers get a fresh one
+    # for every task and send it back with the task's result.
+
+    def __init__(self, enabled=False, cprofile=False):
+        self.enabled = enabled
+        self.cprofile = cprofile
+        self.timers = {}
+        self.counters = collections.Counter()
+        self.files = []
+        self.profiler = None
+        self.worker_stats = None
+        self.stage = None
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+
+    def add_time(self, name, wall, cpu, calls=1):
+        timer = self.timers.setdefault(name, [0, 0., 0.])
+        timer[0] += calls
+        timer[1] += wall
+        timer[2] += cpu
+
+
+_collector = _Collector()
+
+
+class _ProfileStats:
+    # pstats.Stats input for the stats dict of a pool worker's cProfile capture
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def enabled(config):
+    # [Profiling] enabled: True times every stage and file and writes run_report.json
+    return config.getboolean('Profiling', 'enabled', fallback=False)
+
+
+def cprofile_enabled(config):
+    # [Profiling] cprofile: True also captures a cProfile of the run into run_profile.prof
+    return config.getboolean('Profiling', 'cprofile', fallback=False)
+
+
+def set_profiling(config, enabled, cprofile=False):
+    if not config.has_section('Profiling'):
+        config.add_section('Profiling')
+    config.set('Profiling', 'enabled', str(enabled or cprofile))
+    config.set('Profiling', 'cprofile', str(cprofile))
+
+
+def add_arguments(parser):
+    parser.add_argument('--profile', action='store_true',
+                        help='time every stage and file and write run_report.json into the Analysis folder')
+    parser.add_argument('--cprofile', action='store_true',
+                        help='like --profile, also capturing a cProfile of the run into run_profile.prof')
+
+
+def apply_arguments(config, args):
+    if args.profile or args.cprofile:
+        set_profiling(config, True, args.cprofile or cprofile_enabled(config))
+
+
+def start(config):
+    # Starts measuring this run when [Profiling] enabled is set; measurements from before are dropped.
+    global _collector
+    _collector = _Collector(enabled(config) or cprofile_enabled(config), cprofile_enabled(config))
+    if _collector.cprofile:
+        _collector.profiler = cProfile.Profile()
+        _collector.profiler.enable()
+
+
+@contextlib.contextmanager
+def timer(name):
+    # adds the wall clock and CPU time of the with block to the timer name
+    if not _collector.enabled:
+        yield
+        return
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    try:
+        yield
+    finally:
+        _collector.add_time(name, time.perf_counter() - start_wall, time.process_time() - start_cpu)
+
+
+@contextlib.contextmanager
+def file_timer(stage, directory_name, temp, freq):
+    # timer(stage) that also keeps the time of this one (temperature, frequency) file
+    if not _collector.enabled:
+        yield
+        return
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start_wall
+        cpu = time.process_time() - start_cpu
+        _collector.add_time(stage, wall, cpu)
+        _collector.files.append({'stage': stage, 'directory': directory_name, 'temperature': int(temp),
+                                 'frequency': int(freq), 'wall_seconds': wall, 'cpu_seconds': cpu})
+
+
+def stage(name):
+    # Ends the running stage, if any, adding its time to the timer 'stage:<name>', and starts stage name;
+    # stage(None) just ends it. A stage can be started again later, e.g. figures before and after physics.
+    if not _collector.enabled:
+        return
+    if _collector.stage is not None:
+        stage_name, start_wall, start_cpu = _collector.stage
+        _collector.add_time('stage:{0}'.format(stage_name), time.perf_counter() - start_wall,
+                            time.process_time() - start_cpu)
+    _collector.stage = None if name is None else (name, time.perf_counter(), time.process_time())
+
+
+def count(name, amount=1):
+    if _collector.enabled:
+        _collector.counters[name] += amount
+
+
+def _snapshot(collector):
+    stats = None
+    if collector.profiler is not None:
+        collector.profiler.disable()
+        collector.profiler.create_stats()
+        stats = collector.profiler.stats
+    return {'timers': collector.timers, 'counters': dict(collector.counters), 'files': collector.files,
+            'profile': stats}
+
+
+def _merge(snapshot):
+    for name, (calls, wall, cpu) in snapshot['timers'].items():
+        _collector.add_time(name, wall, cpu, calls)
+    _collector.counters.update(snapshot['counters'])
+    _collector.files.extend(snapshot['files'])
+    if snapshot['profile'] is not None:
+        if _collector.worker_stats is None:
+            _collector.worker_stats = pstats.Stats(_ProfileStats(snapshot['profile']))
+        else:
+            _collector.worker_stats.add(_ProfileStats(snapshot['profile']))
+
+
+class PoolTask:
+    # Runs function in a pool worker with a collector of its own and returns (result, its measurements)
+    # for pool_result to merge into the parent's.
+
+    def __init__(self, function, cprofile=False):
+        self.function = function
+        self.cprofile = cprofile
+
+    def __call__(self, *args):
+        global _collector
+        if _collector.profiler is not None:
+            # a capture left running, from the parent this worker was forked from or a task that raised
+            _collector.profiler.disable()
+        _collector = _Collector(True, self.cprofile)
+        if self.cprofile:
+            _collector.profiler = cProfile.Profile()
+            _collector.profiler.enable()
+        result = self.function(*args)
+        return result, _snapshot(_collector)
+
+
+def pool_function(function):
+    # function as it should be handed to pool workers, so their measurements are not lost
+    if not _collector.enabled:
+        return function
+    return PoolTask(function, _collector.cprofile)
+
+
+def pool_result(result):
+    # the result of a pool_function task, merging its measurements into this process's
+    if not _collector.enabled:
+        return result
+    result, snapshot = result
+    _merge(snapshot)
+    return result
+
+
+def _profile_top(stats):
+    stats.sort_stats('cumulative')
+    top = []
+    for function in stats.fcn_list[:PROFILE_TOP]:
+        _, calls, total_seconds, cumulative_seconds, _ = stats.stats[function]
+        top.append({'function': pstats.func_std_string(function), 'calls': calls, 'total_seconds': total_seconds,
+                    'cumulative_seconds': cumulative_seconds})
+    return top
+
+
+def finish(dirs):
+    # Stops measuring and writes the run report, and the cProfile capture if there is one, into each of
+    # dirs. Returns the report, or None when profiling is off.
+    if not _collector.enabled:
+        return None
+    stage(None)
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'command': sys.argv,
+              'wall_seconds': time.perf_counter() - _collector.start_wall,
+              'cpu_seconds': time.process_time() - _collector.start_cpu,
+              'timers': {name: {'calls': calls, 'wall_seconds': wall, 'cpu_seconds': cpu}
+                         for name, (calls, wall, cpu) in sorted(_collector.timers.items())},
+              'counters': dict(sorted(_collector.counters.items())),
+              'files': _collector.files,
+              'profile': None}
+
+    stats = None
+    if _collector.profiler is not None:
+        _collector.profiler.disable()
+        stats = pstats.Stats(_collector.profiler)
+        if _collector.worker_stats is not None:
+            stats.add(_collector.worker_stats)
+    elif _collector.worker_stats is not None:
+        stats = _collector.worker_stats
+    if stats is not None:
+        report['profile'] = PROFILE_NAME
+        report['profile_top'] = _profile_top(stats)
+
+    for dir in dirs:
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        with open(os.path.join(dir, REPORT_NAME), 'w') as jsonfile:
+            json.dump(report, jsonfile, indent=2)
+        if stats is not None:
+            stats.dump_stats(os.path.join(dir, PROFILE_NAME))
+    _collector.enabled = False
+    return report
@@ -3,6 +3,7 @@ import matplotlib.pyplot as plt
 import sys
 import scipy as sp
 from scipy import stats
+import cv_char_segments as segments
 
 
 def find_streak(cap_vs_volt, start_index, p_threshold):
@@ -64,8 +65,7 @@ def main(argv):
         cap_inverse_square = np.reciprocal(np.square(capacitances))
         cap_vs_volt = np.column_stack((cv_raw[:,0], cap_inverse_square))
         print(cap_vs_volt)
-        cap_vs_volt_forward = cap_vs_volt[:101, :]
-        cap_vs_volt_reverse = cap_vs_volt[101:,:]
+        cap_vs_volt_forward, cap_vs_volt_reverse = segments.sweep_halves(cv_raw)
         x = cap_vs_volt_forward[:, 0]
         y = cap_vs_volt_forward[:,1]
         fig, ax = plt.subplots()
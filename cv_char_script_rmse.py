@@ -6,42 +6,8 @@ from scipy import stats
 import os
 import configparser
 import csv
-
-
-def find_streak(cap_vs_volt, start_index, diff_threshold):
-    slope, y_intercept, r_value, streak_size = 0,0,0,0
-    for end_index in range(start_index+3, cap_vs_volt.shape[0]):
-        slope, y_intercept, r_value, _, _ = sp.stats.linregress(cap_vs_volt[start_index:end_index, :])
-        pred = slope * cap_vs_volt[start_index:end_index, 0] + y_intercept
-        diff = np.max(np.abs(pred - cap_vs_volt[start_index:end_index, 1]))
-        if diff > diff_threshold:
-            streak_size = end_index - start_index - 1
-            break
-    streak_dist = np.linalg.norm(cap_vs_volt[start_index, :] - cap_vs_volt[start_index+streak_size, :])
-    if slope != 0:
-        x_intercept = -1*y_intercept/slope
-    else:
-        x_intercept = None
-    return streak_size, streak_dist, slope, x_intercept, y_intercept
-
-
-def find_ideal_cv_line(cap_vs_volt, energy_bandgap, diff_threshold_fraction):
-    diff_threshold = diff_threshold_fraction*np.median(cap_vs_volt[:,1])
-    size_threshold = 5
-    initial_slope, _, _, _, _ = sp.stats.linregress(cap_vs_volt[:10, :])
-    longest_streak_slope, longest_streak_dist, longest_streak_x_intercept, longest_streak_y_intercept = 0,0,0,0
-    for start_index in range(cap_vs_volt.shape[0]):
-        current_streak_size, current_streak_dist, current_slope, current_x_intercept, current_y_intercept \
-            = find_streak(cap_vs_volt, start_index, diff_threshold)
-        if (current_slope < min(0, initial_slope)) and \
-            (current_x_intercept < energy_bandgap) and \
-            (current_streak_dist > longest_streak_dist) and \
-            (current_streak_size > size_threshold):
-
-            longest_streak_slope, longest_streak_dist, longest_streak_x_intercept, longest_streak_y_intercept \
-                = current_slope,current_streak_dist, current_x_intercept, current_y_intercept
-
-    return longest_streak_slope, longest_streak_x_intercept, longest_streak_y_intercept
+import cv_char_segments as segments
+from cv_char_find_linear_fits import direction_fits
 
 
 def calculate_carrier_density(slope, epsilon_o, epsilon_r, elementary_charge, area, built_in_voltage):
@@ -100,24 +66,23 @@ def main():
                 capacitances = cv_raw[:,1]
                 cap_inverse_square = np.reciprocal(np.square(capacitances))
                 cap_vs_volt = np.column_stack((cv_raw[:,0], cap_inverse_square))
-                cap_vs_volt_forward = cap_vs_volt[:101, :]
-                cap_vs_volt_reverse = cap_vs_volt[101:,:]
+                # each pass is fitted on its own, so no streak runs across the turn between two passes
+                forward_segments, reverse_segments = segments.sweep_directions(cv_raw)
+                cap_vs_volt_forward = segments.join_segments(forward_segments)
+                cap_vs_volt_reverse = segments.join_segments(reverse_segments)
                 energy_bandgap = config.getfloat('Constants', 'energy_bandgap')
 
-                diff_threshold_fraction = .0015
+                diff_threshold_fractions = [.0015, .015]
+                forward_fits = direction_fits(forward_segments, energy_bandgap, diff_threshold_fractions)
+                reverse_fits = direction_fits(reverse_segments, energy_bandgap, diff_threshold_fractions)
+                for (_, forward_fit), (_, reverse_fit) in zip(forward_fits, reverse_fits):
+                    if forward_fit.slope != 0 and reverse_fit.slope != 0:
+                        break
                 ideal_forward_slope, ideal_forward_x_intercept, ideal_forward_y_intercept = \
-                    find_ideal_cv_line(cap_vs_volt_forward, energy_bandgap, diff_threshold_fraction)
+                    forward_fit.slope, forward_fit.x_intercept, forward_fit.y_intercept
 
                 ideal_reverse_slope, ideal_reverse_x_intercept, ideal_reverse_y_intercept = \
-                    find_ideal_cv_line(cap_vs_volt_reverse, energy_bandgap, diff_threshold_fraction)
-
-                if ideal_forward_slope is 0 or ideal_reverse_slope is 0:
-                    diff_threshold_fraction = .015
-                    ideal_forward_slope, ideal_forward_x_intercept, ideal_forward_y_intercept = \
-                        find_ideal_cv_line(cap_vs_volt_forward, energy_bandgap, diff_threshold_fraction)
-
-                    ideal_reverse_slope, ideal_reverse_x_intercept, ideal_reverse_y_intercept = \
-                        find_ideal_cv_line(cap_vs_volt_reverse, energy_bandgap, diff_threshold_fraction)
+                    reverse_fit.slope, reverse_fit.x_intercept, reverse_fit.y_intercept
 
                 # print("Ideal Forward Slope = ", ideal_forward_slope)
                 # print("Ideal Forward X_Intercept = ", ideal_forward_x_intercept)
@@ -0,0 +1,96 @@
+import numpy as np
+import cv_char_profiling as profiling
+
+# Passes shorter than this are taken as jitter in the voltage readback and merged with the passes either
+# side of them. Ten points is also the window fit_thresholds takes a pass's initial slope from.
+DEFAULT_MIN_SEGMENT_POINTS = 10
+
+# [Fitting] sweep_segments: auto cuts sweeps at their turning points, a number cuts them into that many
+# equal passes
+AUTO = 'auto'
+
+
+def segmentation(config):
+    # (sweep_segments, min_segment_points) from [Fitting], the settings sweep_segments takes
+    segments = config.get('Fitting', 'sweep_segments', fallback=AUTO).strip().lower()
+    return (segments if segments == AUTO else int(segments),
+            config.getint('Fitting', 'min_segment_points', fallback=DEFAULT_MIN_SEGMENT_POINTS))
+
+
+def turning_points(voltages):
+    # Indices at which a new monotonic pass of the voltage column starts, found from the signs of all
+    # voltage steps at once. Steps that do not change the voltage are left out, so a pass turns where the
+    # direction of the moves either side of it differs, and a hold at the turn is shared between the two
+    # passes, the earlier pass taking the middle point of an odd one. A sweep going up through n points and
+    # back down through n more, repeating or not its end voltage, turns at n.
+    voltages = np.asarray(voltages)
+    moves = np.flatnonzero(np.diff(voltages))
+    directions = np.sign(voltages[moves + 1] - voltages[moves])
+    turns = np.flatnonzero(directions[1:] != directions[:-1]) + 1
+    # the hold at a turn runs from the point the last move of the old direction reached to the point the
+    # first move of the new one leaves from
+    return (moves[turns - 1] + 1 + moves[turns])//2 + 1
+
+
+def segment_cuts(voltages, segments=AUTO, min_points=DEFAULT_MIN_SEGMENT_POINTS):
+    # Start indices of every pass after the first: the turning points, or with a number of segments the
+    # starts of that many equal passes. A pass of fewer than min_points is dropped together with the
+    # turns either side of it, shortest first, so the passes around it join up and the passes still
+    # alternate in direction. A sweep left without any turn, one that only goes one way or whose turn
+    # was lost, is cut into equal halves as it was before turning points were looked for, so that both
+    # directions still get points to fit rather than the reverse one none.
+    count = len(voltages)
+    if segments != AUTO:
+        return [int(count*index/segments) for index in range(1, segments)]
+    bounds = [0] + [int(cut) for cut in turning_points(voltages)] + [count]
+    while len(bounds) > 2:
+        lengths = np.diff(bounds)
+        shortest = int(np.argmin(lengths))
+        if lengths[shortest] >= min_points:
+            break
+        if shortest == 0:
+            del bounds[1]
+        elif shortest == len(lengths) - 1:
+            del bounds[-2]
+        else:
+            del bounds[shortest:shortest + 2]
+    if len(bounds) == 2 and count > 1:
+        profiling.count('half_split_fallbacks')
+        return [count//2]
+    return bounds[1:-1]
+
+
+def cap_vs_volt(cv_raw):
+    # (voltage, 1/C^2) array of a parsed (voltage, capacitance) sweep
+    capacitances = cv_raw[:, 1]
+    cap_inverse_square = np.reciprocal(np.square(capacitances))
+    return np.column_stack((cv_raw[:, 0], cap_inverse_square))
+
+
+def sweep_segments(cv_raw, segments=AUTO, min_points=DEFAULT_MIN_SEGMENT_POINTS):
+    # The sweep's (voltage, 1/C^2) passes, in file order, as views into the one (voltage, 1/C^2) array
+    # made for the sweep, so passes are never copied.
+    sweep = cap_vs_volt(cv_raw)
+    return np.split(sweep, segment_cuts(sweep[:, 0], segments, min_points))
+
+
+def sweep_directions(cv_raw, segmentation=None):
+    # (forward passes, reverse passes) of a sweep: its segments alternately, starting with forward, the
+    # direction of the first pass. segmentation is (segments, min_points) for sweep_segments.
+    segments = sweep_segments(cv_raw, *(segmentation or (AUTO, DEFAULT_MIN_SEGMENT_POINTS)))
+    return segments[0::2], segments[1::2]
+
+
+def join_segments(segments):
+    # one direction's passes as one (voltage, 1/C^2) array, for drawing; a single pass is returned as is
+    if len(segments) == 1:
+        return segments[0]
+    if not segments:
+        return np.empty((0, 2))
+    return np.concatenate(segments)
+
+
+def sweep_halves(cv_raw, segmentation=None):
+    # forward and reverse (voltage, 1/C^2) points of a sweep, each direction's passes joined
+    forward_segments, reverse_segments = sweep_directions(cv_raw, segmentation)
+    return join_segments(forward_segments), join_segments(reverse_segments)
@@ -0,0 +1,129 @@
+import os
+import argparse
+import configparser
+import collections
+import numpy as np
+import cv_char_batch as batch
+import cv_char_physics as physics
+import cv_char_plotting as plotting
+import csv_replacer
+import var_temp_param_gen
+
+# data columns summarised in the sensitivity plots, with their axis labels
+SENSITIVITY_OUTPUTS = (('Carrier Density', 'Carrier Density, $cm^{-3}$'),
+                       ('Depletion Width', 'Depletion Width, $nm$'),
+                       ('Fermi Energy', 'Fermi Energy, $eV$'))
+
+
+def parse_values(spec):
+    # 'start:stop:count' for count evenly spaced values, or the values themselves separated by commas or
+    # spaces
+    if ':' in spec:
+        start, stop, count = spec.split(':')
+        return np.linspace(float(start), float(stop), int(count))
+    return np.array([float(value) for value in spec.replace(',', ' ').split()])
+
+
+def sensitivity_grid(config, varied=None):
+    # {constant name: values} to vary, in grid axis order, from the [Sensitivity] section and then any
+    # 'name=values' strings of varied, which take precedence
+    specs = collections.OrderedDict()
+    if config.has_section('Sensitivity'):
+        for name, spec in config.items('Sensitivity'):
+            if spec.strip():
+                specs[name] = spec
+    for item in varied or []:
+        name, _, spec = item.partition('=')
+        specs.pop(name.strip(), None)
+        specs[name.strip()] = spec
+    grid = collections.OrderedDict()
+    for name, spec in specs.items():
+        if name not in physics.CONSTANT_NAMES:
+            raise ValueError('Unknown constant {0}, expected one of {1}'.format(name, physics.CONSTANT_NAMES))
+        grid[name] = parse_values(spec)
+    return grid
+
+
+def grid_params(constants, grid):
+    # PhysicsParams with each constant of grid along its own axis, and one more axis for the table rows
+    constants = dict(constants)
+    for axis, (name, values) in enumerate(grid.items()):
+        shape = [1] * (len(grid) + 1)
+        shape[axis] = len(values)
+        constants[name] = np.asarray(values, dtype=float).reshape(shape)
+    return physics.derive_params(constants)
+
+
+def window_means(table, window):
+    # {column: grid array} of each SENSITIVITY_OUTPUTS column averaged over the rows in the (lower, upper)
+    # temperature window, or over every row when none fall in it
+    temperatures = table['Temperature'].reshape(-1, table.shape[-1])[0]
+    in_bounds = (temperatures >= window[0]) & (temperatures <= window[1])
+    if not in_bounds.any():
+        in_bounds[:] = True
+    return {name: table[name][..., in_bounds].mean(axis=-1) for name, _ in SENSITIVITY_OUTPUTS}
+
+
+def constant_summary(means, axis):
+    # (middle, low, high) along grid axis: the other axes at their middle index, and the least and
+    # greatest over all of them
+    middle_index = tuple(slice(None) if other == axis else length // 2 for other, length in enumerate(means.shape))
+    by_value = np.moveaxis(means, axis, 0).reshape(means.shape[axis], -1)
+    return means[middle_index], by_value.min(axis=1), by_value.max(axis=1)
+
+
+def write_sensitivity(dir, freq, grid, table):
+    # sensitivity_{F}Hz.npz: the data table over the whole grid, shape (len(values) of each constant...,
+    # rows), the grid's constant names in axis order and each constant's values under its name
+    with open(os.path.join(dir, 'sensitivity_{0}Hz.npz'.format(freq)), 'wb') as npzfile:
+        np.savez(npzfile, table=table, names=np.array(list(grid)), **grid)
+
+
+def run_sensitivity(dir, freq_line_params, config, grid, plots=True):
+    # Computes the physics of every frequency's fitted lines for every combination of the grid's constant
+    # values in one broadcast pass, writes it and, with plots, draws a summary plot per constant. The
+    # plots average over the temperature window {freq}_averaged_data.csv uses, found from the physics at
+    # the configured constants. Returns {freq: table}.
+    params = grid_params(physics.read_constants(config), grid)
+    freq_tables = {}
+    for freq, rows in freq_line_params.items():
+        if not len(rows):
+            continue
+        table = physics.compute_table(rows, params)
+        write_sensitivity(dir, freq, grid, table)
+        freq_tables[freq] = table
+        if plots:
+            window = var_temp_param_gen.temperature_window(
+                physics.compute_table(rows, physics.load_params(config)), freq, config)
+            means = window_means(table, window)
+            for axis, (name, values) in enumerate(grid.items()):
+                outputs = [(label,) + constant_summary(means[column], axis) for column, label in SENSITIVITY_OUTPUTS]
+                plotting.plot_sensitivity(dir, freq, name, values, outputs)
+    return freq_tables
+
+
+def main():
+    config = configparser.RawConfigParser()
+    config.read('config.ini')
+
+    parser = argparse.ArgumentParser(description='Recompute the [Paths] device\'s physics from its fitted lines '
+                                                 'over a grid of [Constants] values.')
+    parser.add_argument('--vary', action='append', metavar='NAME=VALUES',
+                        help='a constant and its values, start:stop:count or a list; overrides [Sensitivity]')
+    parser.add_argument('--no-plots', action='store_true', help='only write the sensitivity_{F}Hz.npz arrays')
+    args = parser.parse_args()
+
+    grid = sensitivity_grid(config, args.vary)
+    if not grid:
+        parser.error('nothing to vary, give --vary or a [Sensitivity] section')
+    directory_name = config['Paths']['data_dir']
+    dir = batch.analysis_dir(directory_name)
+    freq_line_params = {freq: csv_replacer.read_line_params(dir, freq) for freq in batch.frequencies()}
+    freq_tables = run_sensitivity(dir, freq_line_params, config, grid, not args.no_plots)
+    for freq, table in freq_tables.items():
+        print('{0}Hz: {1} combinations of {2} for {3} temperatures'.format(
+            freq, int(np.prod(table.shape[:-1])), ', '.join(grid), table.shape[-1]))
+
+
+if __name__ == '__main__':
+    main()
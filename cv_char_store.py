@@ -0,0 +1,242 @@
+import os
+import sys
+import glob
+import hashlib
+import struct
+import zipfile
+import configparser
+import numpy as np
+import cv_char_batch as batch
+import cv_char_loader as loader
+import cv_char_profiling as profiling
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+STORE_FORMATS = ('npz', 'hdf5')
+
+# index arrays of a container, the last three describing the raw file each sweep was packed from
+INDEX_COLUMNS = ('temperature', 'frequency', 'offset', 'length', 'size', 'mtime', 'sha1')
+
+# stores opened by this process, {path: (mtime_ns, SweepStore)}
+_open_stores = {}
+
+
+def sweep_filename(directory_name, device_num, temp, freq):
+    return "{0}dev{1}_T{2}K_F{3}HZ_CV.txt".format(directory_name, device_num, temp, freq)
+
+
+def store_path(directory_name, device_num, store_format='npz'):
+    extension = 'h5' if store_format == 'hdf5' else 'npz'
+    return os.path.join(batch.analysis_dir(directory_name), 'dev{0}_sweeps.{1}'.format(device_num, extension))
+
+
+def ingest_device(directory_name, device_num, temperatures, frequencies, store_format='npz'):
+    # Packs every readable (temperature, frequency) sweep of a device into one container in its Analysis
+    # folder: the sweeps end to end in a (points, 2) 'cv' array plus temperature, frequency, offset and
+    # length index arrays, and the size, mtime and sha1 of each sweep's raw file, by which load_sweep
+    # tells a packed sweep whose raw file has changed since. Returns the container path and the number of
+    # sweeps packed.
+    if store_format not in STORE_FORMATS:
+        raise ValueError('Unknown store format {0}, expected one of {1}'.format(store_format, STORE_FORMATS))
+    if store_format == 'hdf5' and h5py is None:
+        raise ImportError('h5py is needed for the hdf5 store format')
+
+    index = []
+    hashes = []
+    sweeps = []
+    offset = 0
+    for freq in frequencies:
+        for temp in temperatures:
+            filename = sweep_filename(directory_name, device_num, temp, freq)
+            try:
+                # stat first, so a file changed while it is packed never matches its stamp
+                file_stat = os.stat(filename)
+                with open(filename, 'rb') as rawfile:
+                    file_hash = hashlib.sha1(rawfile.read()).hexdigest()
+                cv_raw = loader.parse_cv_text(filename)
+            except IOError:
+                continue
+            index.append((temp, freq, offset, cv_raw.shape[0], file_stat.st_size, file_stat.st_mtime_ns))
+            hashes.append(file_hash)
+            sweeps.append(cv_raw)
+            offset += cv_raw.shape[0]
+    columns = dict(zip(INDEX_COLUMNS, np.array(index, dtype=np.int64).reshape(-1, 6).T))
+    columns['sha1'] = np.array(hashes, dtype='S40')
+    cv = np.concatenate(sweeps) if sweeps else np.zeros((0, 2))
+
+    path = store_path(directory_name, device_num, store_format)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    temporary = '{0}.{1}.tmp'.format(path, os.getpid())
+    if store_format == 'hdf5':
+        with h5py.File(temporary, 'w') as h5file:
+            h5file.create_dataset('cv', data=cv)
+            for name, column in columns.items():
+                h5file.create_dataset(name, data=column)
+    else:
+        # uncompressed, so that the cv member can be memory-mapped straight out of the archive
+        with open(temporary, 'wb') as npzfile:
+            np.savez(npzfile, cv=cv, **columns)
+    os.replace(temporary, path)
+    return path, len(index)
+
+
+def _npz_member_memmap(path, member):
+    # Memory-maps an array stored uncompressed in an npz archive, or returns None if it is compressed.
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo(member)
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(path, 'rb') as npzfile:
+        npzfile.seek(info.header_offset)
+        local_header = npzfile.read(30)
+        name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+        npzfile.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(npzfile)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(npzfile)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(npzfile)
+        data_offset = npzfile.tell()
+    if 0 in shape:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=data_offset, shape=shape,
+                     order='F' if fortran_order else 'C')
+
+
+class SweepStore:
+    # Read side of a container written by ingest_device. Sweeps come back as slices of the memory-mapped
+    # (npz) or lazily read (hdf5) cv array. Containers packed before the raw file stamps were kept hold
+    # only the first four index arrays.
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime_ns
+        if path.endswith('.h5'):
+            if h5py is None:
+                raise ImportError('h5py is needed to read {0}'.format(path))
+            self._h5file = h5py.File(path, 'r')
+            columns = {name: self._h5file[name][()] for name in INDEX_COLUMNS if name in self._h5file}
+            self._cv = self._h5file['cv']
+        else:
+            with np.load(path) as npzfile:
+                columns = {name: npzfile[name] for name in INDEX_COLUMNS if name in npzfile.files}
+                cv = _npz_member_memmap(path, 'cv.npy')
+                self._cv = cv if cv is not None else npzfile['cv']
+        self._index = {(int(temp), int(freq)): (int(offset), int(length)) for temp, freq, offset, length
+                       in zip(columns['temperature'], columns['frequency'], columns['offset'], columns['length'])}
+        # {(temperature, frequency): (size, mtime_ns, sha1)} of the raw files, empty for an old container
+        self._sources = {}
+        if 'sha1' in columns:
+            self._sources = {(int(temp), int(freq)): (int(size), int(mtime), sha1.decode('ascii'))
+                             for temp, freq, size, mtime, sha1 in zip(columns['temperature'], columns['frequency'],
+                                                                      columns['size'], columns['mtime'],
+                                                                      columns['sha1'])}
+
+    def __contains__(self, temp_freq):
+        return temp_freq in self._index
+
+    def keys(self):
+        return sorted(self._index)
+
+    def is_current(self, temp, freq, filename):
+        # Whether the packed sweep still holds what its raw file does: the raw file is gone, or has the
+        # size and mtime it was packed with. An old container without stamps only trusts raw files no
+        # newer than itself.
+        try:
+            file_stat = os.stat(filename)
+        except OSError:
+            return True
+        source = self._sources.get((int(temp), int(freq)))
+        if source is None:
+            return file_stat.st_mtime_ns <= self.mtime
+        return source[:2] == (file_stat.st_size, file_stat.st_mtime_ns)
+
+    def source_hash(self, temp, freq):
+        # sha1 of the raw file the sweep was packed from, or None when the container did not keep it
+        source = self._sources.get((int(temp), int(freq)))
+        return source[2] if source is not None else None
+
+    def get(self, temp, freq):
+        # raises IOError for a sweep that is not in the store, like a missing raw file
+        try:
+            offset, length = self._index[(int(temp), int(freq))]
+        except KeyError:
+            raise IOError('No {0}K {1}Hz sweep in {2}'.format(temp, freq, self.path))
+        return self._cv[offset:offset + length]
+
+
+def open_device_store(directory_name, device_num):
+    # The device's store if it has been ingested, reopened only when the container changes, else None.
+    for store_format in STORE_FORMATS:
+        path = store_path(directory_name, device_num, store_format)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+        if store_format == 'hdf5' and h5py is None:
+            continue
+        if path not in _open_stores or _open_stores[path][0] != mtime:
+            _open_stores[path] = (mtime, SweepStore(path))
+        return _open_stores[path][1]
+    return None
+
+
+def container_stamps(dir):
+    # {container name: [size, mtime_ns]} of the sweep stores in an Analysis folder, so a manifest can
+    # tell when one has been packed again
+    stamps = {}
+    for path in glob.glob(os.path.join(glob.escape(dir), 'dev*_sweeps.*')):
+        if path.endswith(('.npz', '.h5')):
+            file_stat = os.stat(path)
+            stamps[os.path.basename(path)] = [file_stat.st_size, file_stat.st_mtime_ns]
+    return stamps
+
+
+def stored_sweep(directory_name, device_num, temp, freq):
+    # The device store holding an up to date copy of the sweep, or None when the sweep is to be read
+    # from its raw file: there is no store, the store lacks the sweep, or the raw file changed after it
+    # was packed.
+    sweep_store = open_device_store(directory_name, device_num)
+    if sweep_store is None or (int(temp), int(freq)) not in sweep_store:
+        return None
+    if not sweep_store.is_current(temp, freq, sweep_filename(directory_name, device_num, temp, freq)):
+        profiling.count('store_stale')
+        return None
+    return sweep_store
+
+
+def has_sweep(directory_name, device_num, temp, freq, use_store=True):
+    # whether load_sweep would find the sweep, without reading it
+    if use_store and stored_sweep(directory_name, device_num, temp, freq) is not None:
+        return True
+    return os.path.isfile(sweep_filename(directory_name, device_num, temp, freq))
+
+
+def load_sweep(directory_name, device_num, temp, freq, use_cache=True, use_store=True):
+    # (voltage, capacitance) array of one sweep, from the device store when it holds an up to date copy
+    # and from the raw text file otherwise. Raises IOError when neither has it.
+    if use_store:
+        sweep_store = stored_sweep(directory_name, device_num, temp, freq)
+        if sweep_store is not None:
+            profiling.count('store_hits')
+            return sweep_store.get(temp, freq)
+    return loader.load_cv_file(sweep_filename(directory_name, device_num, temp, freq), use_cache)
+
+
+def main(argv):
+    config = configparser.RawConfigParser()
+    config.read('config.ini')
+    directory_name = argv[0] if len(argv) > 0 else config['Paths']['data_dir']
+    device_num = argv[1] if len(argv) > 1 else config['Paths']['device_num']
+    store_format = config.get('Loader', 'store_format', fallback='npz')
+    path, sweep_count = ingest_device(directory_name, device_num, batch.temperatures(config), batch.frequencies(),
+                                      store_format)
+    print('Packed {0} sweeps into {1}'.format(sweep_count, path))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
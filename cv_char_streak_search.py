@@ -0,0 +1,202 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from collections import namedtuple
+
+# upper bound on the residual values held at once by iter_window_statistics (~16MB of float64)
+DEFAULT_TILE_ELEMENTS = 2**21
+
+# best line of a sweep at one threshold fraction; the line is fitted to cap_vs_volt[start_index:end_index]
+ThresholdFit = namedtuple('ThresholdFit', ['diff_threshold_fraction', 'slope', 'x_intercept', 'y_intercept',
+                                           'start_index', 'end_index', 'streak_size', 'streak_dist'])
+
+
+def window_sums(cap_vs_volt):
+    # Running sums are taken about the sweep means so that the differences used for
+    # short windows do not lose precision against the ~1e18 scale of 1/C^2.
+    x_mean = np.mean(cap_vs_volt[:, 0])
+    y_mean = np.mean(cap_vs_volt[:, 1])
+    x = cap_vs_volt[:, 0] - x_mean
+    y = cap_vs_volt[:, 1] - y_mean
+    sum_x = np.concatenate(([0.], np.cumsum(x)))
+    sum_y = np.concatenate(([0.], np.cumsum(y)))
+    sum_xy = np.concatenate(([0.], np.cumsum(x*y)))
+    sum_xx = np.concatenate(([0.], np.cumsum(x*x)))
+    return sum_x, sum_y, sum_xy, sum_xx, x_mean, y_mean
+
+
+def window_line(sums, start_index, end_index):
+    # Least squares line through the points [start_index:end_index], same as linregress on that slice.
+    # Works elementwise when start_index/end_index are index arrays.
+    sum_x, sum_y, sum_xy, sum_xx, x_mean, y_mean = sums
+    n = end_index - start_index
+    s_x = sum_x[end_index] - sum_x[start_index]
+    s_y = sum_y[end_index] - sum_y[start_index]
+    s_xy = sum_xy[end_index] - sum_xy[start_index]
+    s_xx = sum_xx[end_index] - sum_xx[start_index]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (s_xy - s_x*s_y/n)/(s_xx - s_x*s_x/n)
+        y_intercept = (s_y - slope*s_x)/n + y_mean - slope*x_mean
+    return slope, y_intercept
+
+
+def find_streak(cap_vs_volt, start_index, diff_threshold, sums=None):
+    if sums is None:
+        sums = window_sums(cap_vs_volt)
+    slope, y_intercept, streak_size = 0, 0, 0
+    for end_index in range(start_index+3, cap_vs_volt.shape[0]):
+        slope, y_intercept = window_line(sums, start_index, end_index)
+        pred = slope * cap_vs_volt[start_index:end_index, 0] + y_intercept
+        diff = np.max(np.abs(pred - cap_vs_volt[start_index:end_index, 1]))
+        if diff > diff_threshold:
+            streak_size = end_index - start_index - 1
+            break
+    streak_dist = np.linalg.norm(cap_vs_volt[start_index, :] - cap_vs_volt[start_index+streak_size, :])
+    if slope != 0:
+        x_intercept = -1*y_intercept/slope
+    else:
+        x_intercept = None
+    return streak_size, streak_dist, slope, x_intercept, y_intercept
+
+
+def iter_window_statistics(cap_vs_volt, stop_threshold=None, tile_elements=DEFAULT_TILE_ELEMENTS):
+    # Fit and max-abs residual of the windows [start:start+length] that find_streak visits, one window
+    # length at a time, yielded as (length, starts, slopes, y intercepts, max residuals). Each length is
+    # evaluated for all starts at once on sliding-window views of the sweep, in tiles of at most
+    # tile_elements residuals. With stop_threshold, a start is dropped after its first window whose
+    # residual exceeds it, just like the break in find_streak.
+    n = cap_vs_volt.shape[0]
+    x = cap_vs_volt[:, 0]
+    y = cap_vs_volt[:, 1]
+    sums = window_sums(cap_vs_volt)
+    starts = np.arange(n)
+    for length in range(3, n):
+        # find_streak stops at end index n-1, so the last point is never part of a window
+        starts = starts[starts + length <= n - 1]
+        if starts.shape[0] == 0:
+            break
+        x_windows = sliding_window_view(x, length)
+        y_windows = sliding_window_view(y, length)
+        tile_size = max(1, tile_elements // length)
+        broken = []
+        for tile_start in range(0, starts.shape[0], tile_size):
+            tile = starts[tile_start:tile_start + tile_size]
+            slopes, y_intercepts = window_line(sums, tile, tile + length)
+            max_residuals = np.max(np.abs(slopes[:, None]*x_windows[tile] + y_intercepts[:, None] - y_windows[tile]),
+                                   axis=1)
+            if stop_threshold is not None:
+                broken.append(max_residuals > stop_threshold)
+            yield length, tile, slopes, y_intercepts, max_residuals
+        if stop_threshold is not None:
+            starts = starts[~np.concatenate(broken)]
+
+
+def window_statistics(cap_vs_volt, stop_threshold=None, tile_elements=DEFAULT_TILE_ELEMENTS):
+    # iter_window_statistics gathered into (n, n) arrays indexed [start, end]; windows that were not
+    # evaluated are nan.
+    n = cap_vs_volt.shape[0]
+    slopes = np.full((n, n), np.nan)
+    y_intercepts = np.full((n, n), np.nan)
+    max_residuals = np.full((n, n), np.nan)
+    for length, starts, tile_slopes, tile_y_intercepts, tile_max_residuals \
+            in iter_window_statistics(cap_vs_volt, stop_threshold, tile_elements):
+        slopes[starts, starts + length] = tile_slopes
+        y_intercepts[starts, starts + length] = tile_y_intercepts
+        max_residuals[starts, starts + length] = tile_max_residuals
+    return slopes, y_intercepts, max_residuals
+
+
+def streak_table(cap_vs_volt, diff_threshold, statistics):
+    # Vectorized find_streak for every start index, from the arrays of window_statistics.
+    slopes, y_intercepts, max_residuals = statistics
+    n = cap_vs_volt.shape[0]
+    start_indices = np.arange(n)
+    with np.errstate(invalid='ignore'):
+        exceeded = max_residuals > diff_threshold
+    broke = np.any(exceeded, axis=1)
+    end_indices = np.where(broke, np.argmax(exceeded, axis=1), n - 1)
+    return _streaks_from_breaks(cap_vs_volt, broke, end_indices,
+                                slopes[start_indices, end_indices], y_intercepts[start_indices, end_indices])
+
+
+def find_streaks(cap_vs_volt, diff_thresholds, tile_elements=DEFAULT_TILE_ELEMENTS):
+    # Same as streak_table(cap_vs_volt, diff_threshold, window_statistics(...)) for each of
+    # diff_thresholds, from a single scan and without holding the (n, n) arrays: only each start's
+    # first break per threshold is kept. A start is scanned until it breaks the largest threshold,
+    # which it can only do at or after breaking the smaller ones.
+    n = cap_vs_volt.shape[0]
+    diff_thresholds = np.asarray(diff_thresholds, dtype=float).reshape(-1, 1)
+    broke = np.zeros((diff_thresholds.shape[0], n), dtype=bool)
+    end_indices = np.full(broke.shape, n - 1)
+    slopes = np.zeros(broke.shape)
+    y_intercepts = np.zeros(broke.shape)
+    for length, starts, tile_slopes, tile_y_intercepts, tile_max_residuals \
+            in iter_window_statistics(cap_vs_volt, np.max(diff_thresholds), tile_elements):
+        breaking = (tile_max_residuals[None, :] > diff_thresholds) & ~broke[:, starts]
+        threshold_indices, tile_indices = np.nonzero(breaking)
+        start_indices = starts[tile_indices]
+        broke[threshold_indices, start_indices] = True
+        end_indices[threshold_indices, start_indices] = start_indices + length
+        slopes[threshold_indices, start_indices] = tile_slopes[tile_indices]
+        y_intercepts[threshold_indices, start_indices] = tile_y_intercepts[tile_indices]
+    return [_streaks_from_breaks(cap_vs_volt, broke[k], end_indices[k], slopes[k], y_intercepts[k])
+            for k in range(diff_thresholds.shape[0])]
+
+
+def _streaks_from_breaks(cap_vs_volt, broke, end_indices, slopes, y_intercepts):
+    # Returns find_streak's (size, dist, slope, x intercept, y intercept) plus the end index, as arrays
+    # over all start indices.
+    n = cap_vs_volt.shape[0]
+    start_indices = np.arange(n)
+    # without a break find_streak is left holding the last window it fitted, [start:n-1]
+    unbroken = ~broke & (start_indices + 3 <= n - 1)
+    if np.any(unbroken):
+        slopes = slopes.copy()
+        y_intercepts = y_intercepts.copy()
+        slopes[unbroken], y_intercepts[unbroken] = window_line(window_sums(cap_vs_volt), start_indices[unbroken], n - 1)
+    fitted = broke | unbroken
+    streak_slopes = np.where(fitted, slopes, 0)
+    streak_y_intercepts = np.where(fitted, y_intercepts, 0)
+    streak_sizes = np.where(broke, end_indices - start_indices - 1, 0)
+    streak_dists = np.linalg.norm(cap_vs_volt[start_indices + streak_sizes, :] - cap_vs_volt, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        streak_x_intercepts = np.where(streak_slopes != 0, -1*streak_y_intercepts/streak_slopes, np.nan)
+    return streak_sizes, streak_dists, streak_slopes, streak_x_intercepts, streak_y_intercepts, end_indices
+
+
+def select_longest_streak(streaks, initial_slope, energy_bandgap, size_threshold=5):
+    # Same acceptance rules as the loop in find_ideal_cv_line; the first of several equally long
+    # streaks wins, as it does there. Returns the start index, or None when no streak qualifies.
+    streak_sizes, streak_dists, streak_slopes, streak_x_intercepts, _, _ = streaks
+    with np.errstate(invalid='ignore'):
+        accepted = (streak_slopes < min(0, initial_slope)) & \
+                   (streak_x_intercepts < energy_bandgap) & \
+                   (streak_dists > 0) & \
+                   (streak_sizes > size_threshold)
+    if not np.any(accepted):
+        return None
+    return int(np.argmax(np.where(accepted, streak_dists, -np.inf)))
+
+
+def fit_thresholds(cap_vs_volt, energy_bandgap, diff_threshold_fractions, tile_elements=DEFAULT_TILE_ELEMENTS):
+    # find_ideal_cv_line for several threshold fractions from one scan of the window statistics.
+    # Returns one ThresholdFit per fraction, in the order given; a fraction without an acceptable
+    # streak gets slope, x intercept and y intercept 0 and no window.
+    median = np.median(cap_vs_volt[:, 1])
+    initial_slope, _ = window_line(window_sums(cap_vs_volt), 0, min(10, cap_vs_volt.shape[0]))
+    streak_tables = find_streaks(cap_vs_volt, [fraction*median for fraction in diff_threshold_fractions],
+                                 tile_elements)
+    fits = []
+    for fraction, streaks in zip(diff_threshold_fractions, streak_tables):
+        best = select_longest_streak(streaks, initial_slope, energy_bandgap)
+        if best is None:
+            fits.append(ThresholdFit(fraction, 0, 0, 0, None, None, 0, 0))
+            continue
+        streak_sizes, streak_dists, streak_slopes, streak_x_intercepts, streak_y_intercepts, end_indices = streaks
+        fits.append(ThresholdFit(fraction, streak_slopes[best], streak_x_intercepts[best], streak_y_intercepts[best],
+                                 best, int(end_indices[best]), int(streak_sizes[best]), streak_dists[best]))
+    return fits
+
+
+def find_ideal_cv_line(cap_vs_volt, energy_bandgap, diff_threshold_fraction, tile_elements=DEFAULT_TILE_ELEMENTS):
+    fit = fit_thresholds(cap_vs_volt, energy_bandgap, [diff_threshold_fraction], tile_elements)[0]
+    return fit.slope, fit.x_intercept, fit.y_intercept
@@ -0,0 +1,243 @@
+import os
+import csv
+import argparse
+import configparser
+import collections
+import cv_char_batch as batch
+import cv_char_manifest as manifest
+import cv_char_physics as physics
+import cv_char_plotting as plotting
+import cv_char_profiling as profiling
+import cv_char_segments as segments
+import cv_char_tables as tables
+import cv_char_gen_figures as gen_figures
+import csv_replacer
+import var_temp_param_gen
+from cv_char_find_linear_fits import THRESHOLD_TABLE_HEADER, fit_settings, fit_sweep, write_manual_params_template
+from cv_char_fit_cache import open_fit_cache
+from cv_char_manual_fit import fit_manual_overrides
+
+
+def process_sweep(directory_name, device_num, temp, freq, energy_bandgap, diff_threshold_fractions, fit_mode,
+                  cached_fit, override, plot_dir, use_cache=True, use_store=True, fit_cache=None, segmentation=None):
+    # Worker for one sweep: loads it once, fits it unless cached_fit (a fit_sweep result) is given, takes
+    # the line from override (a generated_line_params row) when there is one, and draws CV_{T}K_{F}Hz.png
+    # into plot_dir unless that is None. Returns (fit, line params row, plotted), or None when the raw file
+    # cannot be read.
+    directions = None
+    if cached_fit is None or plot_dir is not None:
+        directions = plotting.load_sweep_directions(directory_name, device_num, temp, freq, use_cache, use_store,
+                                                    segmentation)
+        if directions is None:
+            return None
+    if cached_fit is None:
+        print('Currently Working on Data of Temperature: {0} at Frequency {1}'.format(temp, freq))
+        with profiling.file_timer('fit', directory_name, temp, freq):
+            fit = fit_sweep(directions[0], directions[1], temp, energy_bandgap, diff_threshold_fractions, fit_mode,
+                            fit_cache)
+    else:
+        fit = cached_fit
+    line_params = list(override[1:]) if override is not None else list(fit[0])
+    if plot_dir is not None:
+        with profiling.file_timer('plot', directory_name, temp, freq):
+            halves = [segments.join_segments(direction_segments) for direction_segments in directions]
+            plotting.plot_sweep_halves(plot_dir, freq, line_params, halves)
+    return fit, line_params, plot_dir is not None
+
+
+class DeviceTables:
+    # The {freq}_line_params.csv, {freq}_data.csv and optional {freq}_threshold_fits.csv tables of one
+    # device, written a row at a time under temporary names and moved into place by close, which also
+    # writes the binary line_params.npy and data.npy. Only the line params and data rows, a few per
+    # temperature, are kept for them and for the trends and averages.
+
+    def __init__(self, dir, write_threshold_table=False):
+        self.dir = dir
+        self.line_params = {freq: [] for freq in batch.frequencies()}
+        self.data = {freq: [] for freq in batch.frequencies()}
+        self._files = []
+        self._writers = {}
+        for freq in batch.frequencies():
+            tables = [('line_params', csv_replacer.LINE_PARAMS_HEADER), ('data', physics.DATA_COLUMNS)]
+            if write_threshold_table:
+                tables.append(('threshold_fits', THRESHOLD_TABLE_HEADER))
+            for name, header in tables:
+                path = os.path.join(dir, '{0}_{1}.csv'.format(freq, name))
+                temporary = '{0}.{1}.tmp'.format(path, os.getpid())
+                csvfile = open(temporary, 'w', newline='')
+                self._files.append((csvfile, temporary, path))
+                writer = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+                writer.writerow(header)
+                self._writers[(freq, name)] = writer
+
+    def add(self, freq, line_params, data_row, threshold_rows):
+        self._writers[(freq, 'line_params')].writerow(line_params)
+        self._writers[(freq, 'data')].writerow(data_row)
+        if (freq, 'threshold_fits') in self._writers:
+            self._writers[(freq, 'threshold_fits')].writerows(threshold_rows)
+        self.line_params[freq].append(line_params)
+        self.data[freq].append(data_row)
+
+    def close(self, keep=True):
+        # moves the finished tables into place, or with keep False throws them away
+        for csvfile, temporary, path in self._files:
+            csvfile.close()
+            if keep:
+                os.replace(temporary, path)
+            elif os.path.exists(temporary):
+                os.remove(temporary)
+        freq_data = {freq: physics.table_from_rows(rows) for freq, rows in self.data.items()}
+        if keep:
+            tables.write_tables(self.dir, tables.LINE_PARAMS, {freq: tables.line_params_table(rows)
+                                                               for freq, rows in self.line_params.items()})
+            tables.write_tables(self.dir, tables.DATA, freq_data)
+        return freq_data
+
+
+def _device_sweeps(device, config, fit_args, device_manifest, overrides, render, use_cache, use_store,
+                   fit_cache=None, segmentation=None):
+    # (process_sweep task, (freq, temp, raw hash, whether the fit is new)) for each sweep of device, in
+    # table order. Fits whose raw file and settings are unchanged come from the manifest, and so do
+    # plots whose line is unchanged too, which are then not redrawn.
+    directory_name, device_num = device
+    fit_mode, diff_threshold_fractions, energy_bandgap = fit_args
+    dir = batch.analysis_dir(directory_name)
+    for freq in batch.frequencies():
+        for temp in batch.temperatures(config):
+            raw_hash, cached_fit = None, None
+            override = overrides.get((freq, temp))
+            plot_dir = dir if render else None
+            if device_manifest is not None:
+                raw_hash = device_manifest.sweep_hash(directory_name, device_num, temp, freq, use_store)
+                if raw_hash is not None:
+                    cached_fit = device_manifest.lookup('fit', manifest.sweep_key(device_num, temp, freq),
+                                                        _fit_fingerprint(raw_hash, fit_args, segmentation))
+                if cached_fit is not None and plot_dir is not None:
+                    line_params = list(override[1:]) if override is not None else list(cached_fit[0])
+                    figure_fingerprint = manifest.fingerprint(raw_hash, line_params, segmentation)
+                    if os.path.isfile(os.path.join(dir, 'CV_{0}K_{1}Hz.png'.format(temp, freq))) and \
+                            device_manifest.lookup('figure', manifest.sweep_key(device_num, temp, freq),
+                                                   figure_fingerprint) is not None:
+                        plot_dir = None
+            task = (directory_name, device_num, temp, freq, energy_bandgap, diff_threshold_fractions, fit_mode,
+                    cached_fit, override, plot_dir, use_cache, use_store, fit_cache, segmentation)
+            yield task, (freq, temp, raw_hash, cached_fit is None)
+
+
+def _fit_fingerprint(raw_hash, fit_args, segmentation):
+    # the fit stage's manifest fingerprint, as in fit_devices
+    fit_mode, diff_threshold_fractions, energy_bandgap = fit_args
+    return manifest.fingerprint(raw_hash, fit_mode, diff_threshold_fractions, energy_bandgap, segmentation)
+
+
+def stream_device(device, config, pool=None):
+    # The whole analysis of one device, fit, manual overrides, physics, figures and averages, with each
+    # sweep streamed through one worker task that loads it once. Rows are written as they arrive and only
+    # the device's small per-frequency tables are held, for its trends and averages. Returns {freq: data
+    # table}.
+    directory_name, device_num = device
+    fit_args = fit_settings(config)
+    use_cache = config.getboolean('Loader', 'cache', fallback=True)
+    use_store = config.getboolean('Loader', 'store', fallback=True)
+    render = plotting.figures_mode(config) == 'all'
+    params = physics.load_params(config)
+    dir = batch.analysis_dir(directory_name)
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+
+    if os.path.isfile(os.path.join(dir, 'manual_line_params.csv')):
+        overrides = {(int(row[0]), int(row[1])): row
+                     for row in fit_manual_overrides(directory_name, device_num, config)}
+    else:
+        write_manual_params_template(dir)
+        overrides = {}
+    manifests = manifest.open_manifests([device], config)
+    device_manifest = manifests[directory_name] if manifests is not None else None
+    fit_cache = open_fit_cache(config)
+    segmentation = segments.segmentation(config)
+
+    keys = collections.deque()
+
+    def tasks():
+        for task, key in _device_sweeps(device, config, fit_args, device_manifest, overrides,
+                                        render and plotting.plot_layout(config) == 'png', use_cache, use_store,
+                                        fit_cache, segmentation):
+            keys.append(key)
+            yield task
+
+    profiling.stage('sweeps')
+    tables = DeviceTables(dir, config.getboolean('Fitting', 'threshold_table', fallback=False))
+    try:
+        for result in batch.iter_tasks(process_sweep, tasks(), batch.get_processes(config), pool):
+            freq, temp, raw_hash, new_fit = keys.popleft()
+            if result is None:
+                continue
+            fit, line_params, plotted = result
+            if device_manifest is not None and raw_hash is not None:
+                if new_fit:
+                    device_manifest.record('fit', manifest.sweep_key(device_num, temp, freq),
+                                           _fit_fingerprint(raw_hash, fit_args, segmentation), fit)
+                if plotted:
+                    device_manifest.record('figure', manifest.sweep_key(device_num, temp, freq),
+                                           manifest.fingerprint(raw_hash, line_params, segmentation), True)
+            overrides.pop((freq, temp), None)
+            data_row = next(physics.table_rows(physics.compute_table([line_params], params)))
+            tables.add(freq, line_params, data_row, fit[1])
+    except BaseException:
+        tables.close(keep=False)
+        raise
+    freq_data = tables.close()
+    manifest.save_manifests(manifests)
+    if fit_cache is not None:
+        fit_cache.prune()
+    # overrides left over had no sweep to replace
+    csv_replacer.report_unmatched([(device, row) for _, row in sorted(overrides.items())])
+
+    if render:
+        profiling.stage('figures')
+        gen_figures.plot_frequency_figures({device: tables.line_params}, {device: freq_data}, config, pool)
+    profiling.stage('average')
+    for freq in batch.frequencies():
+        if physics.table_length(freq_data[freq]):
+            var_temp_param_gen.average_data(dir, freq, freq_data[freq], config)
+    profiling.stage(None)
+    return freq_data
+
+
+def stream_devices(devices, config, pool=None):
+    # stream_device for each (directory_name, device_num) in devices, one device after the other on a
+    # shared pool. Returns {device: {freq: data table}}.
+    own_pool = pool is None
+    if own_pool:
+        pool = batch.make_pool(batch.get_processes(config))
+    try:
+        return {device: stream_device(device, config, pool) for device in devices}
+    finally:
+        if own_pool and pool is not None:
+            pool.close()
+            pool.join()
+
+
+def main():
+    config = configparser.RawConfigParser()
+    config.read('config.ini')
+
+    parser = argparse.ArgumentParser(description='Stream every sweep of the [Paths] device through the whole '
+                                                 'analysis, one sweep at a time.')
+    parser.add_argument('--full', action='store_true',
+                        help='recompute every sweep, ignoring the Analysis manifest')
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    if args.full:
+        manifest.set_incremental(config, False)
+    profiling.apply_arguments(config, args)
+
+    directory_name = config['Paths']['data_dir']
+    device_num = config['Paths']['device_num']
+    profiling.start(config)
+    stream_devices([(directory_name, device_num)], config)
+    profiling.finish([batch.analysis_dir(directory_name)])
+
+
+if __name__ == '__main__':
+    main()
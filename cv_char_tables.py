@@ -0,0 +1,113 @@
+import os
+import numpy as np
+from numpy.lib import recfunctions
+import cv_char_physics as physics
+import cv_char_profiling as profiling
+
+# typed columns of a {freq}_line_params.csv table, named as its header
+LINE_PARAMS_DTYPE = np.dtype([('Temperature', np.int64), ('Ideal Forward Slope', np.float64),
+                              ('Ideal Forward Y Intercept', np.float64), ('Ideal Forward X Intercept', np.float64),
+                              ('Ideal Reverse Slope', np.float64), ('Ideal Reverse Y Intercept', np.float64),
+                              ('Ideal Reverse X Intercept', np.float64)])
+
+# The tables kept in binary form. Each device's Analysis folder has a {name}.npy holding every frequency's
+# table as one structured array with leading Frequency, CSV Size and CSV Mtime columns, written alongside
+# the {freq}_{name}.csv tables. The size and mtime each frequency's csv had when its table was written
+# are kept with it, and the csv is read instead whenever it no longer has them, e.g. after being edited
+# by hand.
+LINE_PARAMS = 'line_params'
+DATA = 'data'
+TABLE_DTYPES = {LINE_PARAMS: LINE_PARAMS_DTYPE, DATA: physics.DATA_DTYPE}
+
+
+def line_params_table(rows):
+    # line params rows, [temperature, forward slope, y intercept, x intercept, reverse slope, y intercept,
+    # x intercept], as a LINE_PARAMS_DTYPE array
+    values = np.asarray(rows, dtype=float).reshape(-1, len(LINE_PARAMS_DTYPE))
+    table = np.empty(len(values), LINE_PARAMS_DTYPE)
+    for index, name in enumerate(LINE_PARAMS_DTYPE.names):
+        table[name] = values[:, index]
+    return table
+
+
+def line_params_rows(table):
+    # a line params table back as the rows the fitting and manual stages pass around
+    return [list(row) for row in table.tolist()]
+
+
+def binary_path(dir, name):
+    return os.path.join(dir, '{0}.npy'.format(name))
+
+
+def _csv_stamp(dir, name, freq):
+    # (size, mtime_ns) of {freq}_{name}.csv, or (-1, -1) when there is none
+    try:
+        csv_stat = os.stat(os.path.join(dir, '{0}_{1}.csv'.format(freq, name)))
+    except OSError:
+        return -1, -1
+    return csv_stat.st_size, csv_stat.st_mtime_ns
+
+
+def _records(freq_tables, dtype, stamps=None):
+    # {freq: table} as one array with a Frequency column and the {freq: (size, mtime_ns)} stamps of the
+    # tables' csv files
+    records = np.empty(sum(len(table) for table in freq_tables.values()),
+                       [('Frequency', np.int64), ('CSV Size', np.int64), ('CSV Mtime', np.int64)] + dtype.descr)
+    start = 0
+    for freq, table in freq_tables.items():
+        records['Frequency'][start:start + len(table)] = freq
+        records['CSV Size'][start:start + len(table)], records['CSV Mtime'][start:start + len(table)] = \
+            stamps[freq] if stamps is not None else (-1, -1)
+        for name in dtype.names:
+            records[name][start:start + len(table)] = table[name]
+        start += len(table)
+    return records
+
+
+def load_records(dir, name):
+    # the {name}.npy array, or None when there is none or it is not in the current format
+    try:
+        records = np.load(binary_path(dir, name))
+    except (IOError, ValueError):
+        return None
+    if records.dtype != _records({}, TABLE_DTYPES[name]).dtype:
+        return None
+    return records
+
+
+def save_records(dir, name, records):
+    path = binary_path(dir, name)
+    temporary = '{0}.{1}.tmp'.format(path, os.getpid())
+    with profiling.timer('write_tables'), open(temporary, 'wb') as npyfile:
+        np.save(npyfile, records)
+    os.replace(temporary, path)
+
+
+def write_tables(dir, name, freq_tables):
+    # Puts the {freq: table} of freq_tables into {name}.npy in place of those frequencies' old tables,
+    # keeping the other frequencies' tables, and the csv stamps they were written with, as they are. The
+    # frequencies' {freq}_{name}.csv files are written first, so their stamps are taken here.
+    if not freq_tables:
+        return
+    records = _records(freq_tables, TABLE_DTYPES[name], {freq: _csv_stamp(dir, name, freq) for freq in freq_tables})
+    old_records = load_records(dir, name)
+    if old_records is not None:
+        kept = old_records[~np.isin(old_records['Frequency'], list(freq_tables))]
+        records = np.concatenate((kept, records))
+    save_records(dir, name, records[np.argsort(records['Frequency'], kind='stable')])
+
+
+def read_table(dir, name, freq):
+    # One frequency's table from {name}.npy, or None when that has no table for it or {freq}_{name}.csv
+    # has changed since the table was written, in which case the csv is the one to read.
+    records = load_records(dir, name)
+    if records is None:
+        return None
+    selected = records['Frequency'] == freq
+    if not selected.any():
+        return None
+    csv_stamp = _csv_stamp(dir, name, freq)
+    first = records[np.flatnonzero(selected)[0]]
+    if csv_stamp != (-1, -1) and csv_stamp != (first['CSV Size'], first['CSV Mtime']):
+        return None
+    return recfunctions.repack_fields(records[selected][list(TABLE_DTYPES[name].names)])
@@ -0,0 +1,183 @@
+import os
+import re
+import csv
+import time
+import argparse
+import traceback
+import configparser
+import cv_char_batch as batch
+import cv_char_physics as physics
+import cv_char_plotting as plotting
+import cv_char_segments as segments
+import cv_char_store as store
+import cv_char_gen_figures as gen_figures
+import csv_replacer
+from cv_char_find_linear_fits import fit_settings, fit_sweep_file
+from cv_char_fit_cache import open_fit_cache
+from cv_char_manual_fit import fit_manual_rows
+from cv_char_pipeline import run_pipeline
+
+
+def scan_sweeps(directory_name, device_num):
+    # {(temperature, frequency): (size, mtime_ns)} of the device's sweep files in directory_name
+    pattern = re.compile(r'^dev{0}_T(\d+)K_F(\d+)HZ_CV\.txt$'.format(re.escape(str(device_num))))
+    sweeps = {}
+    try:
+        entries = list(os.scandir(directory_name))
+    except OSError:
+        return sweeps
+    for entry in entries:
+        match = pattern.match(entry.name)
+        if match is None or int(match.group(2)) not in batch.frequencies():
+            continue
+        try:
+            entry_stat = entry.stat()
+        except OSError:
+            continue
+        sweeps[(int(match.group(1)), int(match.group(2)))] = (entry_stat.st_size, entry_stat.st_mtime_ns)
+    return sweeps
+
+
+def _manual_rows(dir, temps_freqs):
+    # the manual_line_params.csv rows for any of temps_freqs
+    try:
+        with open(os.path.join(dir, 'manual_line_params.csv'), 'r') as csvfile:
+            reader = csv.DictReader(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+            return [row for row in reader if (int(row['Temperature']), int(row['Frequency'])) in temps_freqs]
+    except IOError:
+        return []
+
+
+def update_sweeps(directory_name, device_num, temps_freqs, config, pool=None):
+    # Fits the (temperature, frequency) sweeps in temps_freqs, re-applies any manual bounds they have and
+    # updates their rows of the line params and data tables, the sweeps' plots and their frequencies'
+    # trends. The rest of each table is left as it is. Sweeps are fitted and drawn from their raw files,
+    # and a sweep with fewer points than a pass of min_segment_points each way is reported and left out.
+    dir = batch.analysis_dir(directory_name)
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+    fit_mode, diff_threshold_fractions, energy_bandgap = fit_settings(config)
+    use_cache = config.getboolean('Loader', 'cache', fallback=True)
+    fit_cache = open_fit_cache(config)
+    segmentation = segments.segmentation(config)
+    device = (directory_name, device_num)
+
+    freq_line_params = {}
+    for temp, freq in sorted(temps_freqs):
+        # the sweep store only holds what was ingested, so the file just written is always read directly
+        try:
+            point_count = store.load_sweep(directory_name, device_num, temp, freq, use_cache, False).shape[0]
+        except IOError:
+            continue
+        if point_count < 2*segmentation[1]:
+            print('Skipped {0}K {1}Hz of device {2}: {3} points is too few to fit'.format(temp, freq, device_num,
+                                                                                         point_count))
+            continue
+        result = fit_sweep_file(directory_name, device_num, temp, freq, energy_bandgap, diff_threshold_fractions,
+                                fit_mode, use_cache, False, fit_cache, segmentation)
+        if result is None:
+            continue
+        if freq not in freq_line_params:
+            try:
+                freq_line_params[freq] = csv_replacer.read_line_params(dir, freq)
+            except IOError:
+                freq_line_params[freq] = []
+        rows = {row[0]: row for row in freq_line_params[freq]}
+        rows[temp] = list(result[0])
+        freq_line_params[freq] = [rows[row_temp] for row_temp in sorted(rows)]
+    if not freq_line_params:
+        return
+
+    generated_line_params = [generated for generated in
+                             fit_manual_rows(directory_name, device_num, _manual_rows(dir, temps_freqs), use_cache,
+                                             False, segmentation)
+                             if generated is not None]
+    csv_replacer.report_unmatched([(device, data_tuple) for data_tuple in
+                                   csv_replacer.apply_overrides(freq_line_params, generated_line_params)])
+    csv_replacer.write_all_line_params(dir, freq_line_params)
+
+    params = physics.load_params(config)
+    freq_data = {freq: physics.compute_table(rows, params) for freq, rows in freq_line_params.items()}
+    gen_figures.write_all_data(dir, freq_data)
+
+    if plotting.figures_mode(config) == 'all':
+        # only the touched frequencies, with no sweeps or values for the others
+        updated_sweeps = {freq: [row for row in freq_line_params.get(freq, []) if (row[0], freq) in temps_freqs]
+                          for freq in batch.frequencies()}
+        if plotting.plot_layout(config) == 'png':
+            gen_figures.plot_sweeps({device: updated_sweeps}, config, pool, use_store=False)
+        gen_figures.plot_frequency_figures(
+            {device: {freq: freq_line_params.get(freq, []) for freq in batch.frequencies()}},
+            {device: {freq: freq_data.get(freq, physics.compute_table([], params)) for freq in batch.frequencies()}},
+            config, pool, use_store=False)
+
+
+def watch(directory_name, device_num, config, poll_interval=.25, max_polls=None):
+    # Polls directory_name for new or rewritten sweep files of the device and updates the tables and plots
+    # for each one once its size and mtime have stayed the same for a whole poll, so half-written files
+    # are not read. The files already there when watching starts are taken as processed. One pool draws
+    # the plots of every update, and an update that fails is reported without stopping the watch; its
+    # files are tried again once they change. Runs until interrupted, or for max_polls polls.
+    processed = scan_sweeps(directory_name, device_num)
+    pending = {}
+    polls = 0
+    pool = batch.make_pool(batch.get_processes(config))
+    print('Watching {0} for device {1} sweeps'.format(directory_name, device_num))
+    try:
+        while max_polls is None or polls < max_polls:
+            time.sleep(poll_interval)
+            polls += 1
+            current = scan_sweeps(directory_name, device_num)
+            ready = set()
+            for temp_freq, file_stat in current.items():
+                if processed.get(temp_freq) == file_stat:
+                    continue
+                if pending.get(temp_freq) == file_stat:
+                    ready.add(temp_freq)
+                else:
+                    pending[temp_freq] = file_stat
+            if not ready:
+                continue
+            start = time.time()
+            try:
+                update_sweeps(directory_name, device_num, ready, config, pool)
+            except Exception:
+                print('Failed to update {0}:'.format(', '.join('{0}K {1}Hz'.format(temp, freq)
+                                                               for temp, freq in sorted(ready))))
+                traceback.print_exc()
+                continue
+            finally:
+                for temp_freq in ready:
+                    processed[temp_freq] = pending.pop(temp_freq)
+            print('Updated {0} in {1:.2f}s'.format(', '.join('{0}K {1}Hz'.format(temp, freq)
+                                                             for temp, freq in sorted(ready)), time.time() - start))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def main():
+    config = configparser.RawConfigParser()
+    config.read('config.ini')
+
+    parser = argparse.ArgumentParser(description='Fit the [Paths] device\'s sweeps as the LCR meter writes them.')
+    parser.add_argument('--poll-interval', type=float,
+                        help='seconds between directory scans, overrides [Watch] poll_interval')
+    parser.add_argument('--catch-up', action='store_true',
+                        help='run the pipeline over the files already there before watching')
+    args = parser.parse_args()
+
+    directory_name = config['Paths']['data_dir']
+    device_num = config['Paths']['device_num']
+    poll_interval = args.poll_interval or config.getfloat('Watch', 'poll_interval', fallback=.25)
+    if args.catch_up:
+        run_pipeline([(directory_name, device_num)], config)
+    try:
+        watch(directory_name, device_num, config, poll_interval)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -6,56 +6,113 @@ from scipy import stats
 import os
 import configparser
 import csv
+from cv_char_gen_figures import read_data
 
 
-def main():
-    config = configparser.RawConfigParser()
-    config.read('config.ini')
-    directory_name = config['Paths']['data_dir']
-    dir = '{0}\Analysis'.format(directory_name)
+# columns of a data table whose plateau the automatic temperature window looks for, with their names in
+# {freq}_averaged_data.csv
+PLATEAU_VARIABLES = (('Carrier Density', 'Carrier Density'), ('Depletion Width', 'Depletion Width'),
+                     ('Averaged Vbi', 'Built in Voltage'))
 
-    for frequency in range(3, 6):
-        freq = 10 ** frequency
+DEFAULT_MIN_WINDOW_POINTS = 4
+
+
+def window_scores(temperatures, columns, min_points=DEFAULT_MIN_WINDOW_POINTS):
+    # Flatness score of every contiguous range of rows, as an (n + 1, n + 1) array indexed [start, end]
+    # for the rows [start:end]: the sum over columns of the squared standard error of the range's mean
+    # and of its fitted drift across the range, both relative to the mean, so a range grows along a
+    # plateau until its ends start to drift. Each range's sums come from differences of
+    # cumulative sums, so scoring every range costs O(1) each. Ranges of fewer than min_points rows, or
+    # holding a row with a non-finite value in any column, such as a sweep without a fitted line, score
+    # inf.
+    n = len(temperatures)
+    starts, ends = np.meshgrid(np.arange(n + 1), np.arange(n + 1), indexing='ij')
+    counts = ends - starts
+
+    def range_sums(values):
+        cumulative = np.concatenate(([0], np.cumsum(values)))
+        return cumulative[ends] - cumulative[starts]
 
-        data = []
+    columns = [np.asarray(values, dtype=float) for values in columns]
+    finite = np.all([np.isfinite(values) for values in columns], axis=0) if columns else np.ones(n, dtype=bool)
+    non_finite_counts = range_sums(~finite)
+    # about the mean temperature, and each column in units of its mean size over the finite rows, to keep
+    # the differences of cumulative sums precise; the other rows are zeroed so the sums stay finite
+    t = np.asarray(temperatures, dtype=float)
+    t = t - t.mean()
+    sum_t = range_sums(t)
+    sum_tt = range_sums(t*t)
+    span = t[np.clip(ends - 1, 0, n - 1)] - t[np.clip(starts, 0, n - 1)]
+    scores = np.zeros(counts.shape)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for values in columns:
+            y = np.where(finite, values, 0)/np.mean(np.abs(values[finite]))
+            mean = range_sums(y)/counts
+            variance = range_sums(y*y)/counts - mean**2
+            t_mean = sum_t/counts
+            slope = (range_sums(t*y)/counts - t_mean*mean)/(sum_tt/counts - t_mean**2)
+            scores += variance/(counts*mean**2) + (slope*span/mean)**2
+    scores[~np.isfinite(scores) | (counts < min(min_points, n)) | (non_finite_counts > 0)] = np.inf
+    return scores
 
-        input_csv_name = '{0}_data.csv'.format(freq)
 
-        with open(os.path.join(dir, input_csv_name), 'r') as csvfile:
-            reader = csv.reader(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-            next(reader, None)
-            for row in reader:
-                data.append(row)
+def find_plateau(temperatures, columns, min_points=DEFAULT_MIN_WINDOW_POINTS):
+    # (lower, upper) temperature of the range of rows with the lowest window_scores, the longest of equally
+    # flat ones, or of every row when none can be scored
+    scores = window_scores(temperatures, columns, min_points)
+    if not np.isfinite(scores).any():
+        return temperatures[0], temperatures[-1]
+    counts = np.arange(scores.shape[1])[None, :] - np.arange(scores.shape[0])[:, None]
+    start, end = np.unravel_index(np.lexsort((-counts.ravel(), scores.ravel()))[0], scores.shape)
+    return temperatures[start], temperatures[end - 1]
 
-        x_temp, carrier_density, depletion_width, energy_intrinsic, intrinsic_carrier_concentration, \
-            energy_fermi, _, _, built_in_voltage = zip(*data)
 
-        output_csv_name = '{0}_averaged_data.csv'.format(freq)
-        with open(os.path.join(dir, output_csv_name), 'w') as csvfile:
-            writer = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-            writer.writerow(['Variable']+ ['Average Value'] + ['Uncertainty'])
+def temperature_window(table, freq, config):
+    # (lower, upper) bounds to average a frequency's data table over. [Temp Bounds] window: auto finds the
+    # flattest plateau of PLATEAU_VARIABLES, window: config takes the lower_bound_{freq} and
+    # upper_bound_{freq} settings. Without a window setting, a frequency's settings are used when it has
+    # them and the plateau otherwise.
+    window = config.get('Temp Bounds', 'window', fallback=None)
+    has_bounds = config.has_option('Temp Bounds', 'lower_bound_{0}'.format(freq))
+    if window == 'config' or (window is None and has_bounds):
+        return (config.getfloat('Temp Bounds', 'lower_bound_{0}'.format(freq)),
+                config.getfloat('Temp Bounds', 'upper_bound_{0}'.format(freq)))
+    if window not in (None, 'auto', 'config'):
+        raise ValueError('Unknown temperature window {0}, expected auto or config'.format(window))
+    order = np.argsort(table['Temperature'], kind='stable')
+    return find_plateau(table['Temperature'][order], [table[name][order] for name, _ in PLATEAU_VARIABLES],
+                        config.getint('Temp Bounds', 'min_window_points', fallback=DEFAULT_MIN_WINDOW_POINTS))
 
-            temp_left_bound = config['Temp Bounds']['lower_bound_{0}'.format(freq)]
-            temp_right_bound = config['Temp Bounds']['upper_bound_{0}'.format(freq)]
 
-            temperatures = []
-            carrier_densities = []
-            depletion_widths = []
-            built_in_voltages = []
+def average_data(dir, freq, table, config):
+    # Writes {freq}_averaged_data.csv from the rows of a {freq}_data.csv table that fall in the
+    # frequency's temperature_window, and returns the window.
+    output_csv_name = '{0}_averaged_data.csv'.format(freq)
+    temp_left_bound, temp_right_bound = temperature_window(table, freq, config)
+    with open(os.path.join(dir, output_csv_name), 'w') as csvfile:
+        writer = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(['Variable'] + ['Average Value'] + ['Uncertainty'] + ['Lower Bound'] + ['Upper Bound'])
 
-            list_vars_names = ['Carrier Density', 'Depletion Width', 'Built in Voltage']
-            list_vars = [carrier_densities, depletion_widths, built_in_voltages]
+        in_bounds = (table['Temperature'] >= temp_left_bound) & (table['Temperature'] <= temp_right_bound)
+        temperatures = table['Temperature'][in_bounds].astype(float)
 
-            for index, temp in enumerate(x_temp):
-                if (temp >= temp_left_bound) and (temp <= temp_right_bound):
-                    temperatures.append(float(temp))
-                    carrier_densities.append(float(carrier_density[index]))
-                    depletion_widths.append(float(depletion_width[index]))
-                    built_in_voltages.append(float(built_in_voltage[index]))
+        for name, variable in PLATEAU_VARIABLES:
+            data_var = table[name][in_bounds]
+            _, _, _, _, stderr = sp.stats.linregress(temperatures, data_var)
+            writer.writerow([variable] + [np.mean(data_var)] + [stderr] + [temp_left_bound] + [temp_right_bound])
+    return temp_left_bound, temp_right_bound
 
-            for index, data_var in enumerate(list_vars):
-                _, _, _, _, stderr = sp.stats.linregress(temperatures, data_var)
-                writer.writerow([list_vars_names[index]] + [np.mean(data_var)] + [stderr])
+
+def main():
+    config = configparser.RawConfigParser()
+    config.read('config.ini')
+    directory_name = config['Paths']['data_dir']
+    dir = '{0}\\Analysis'.format(directory_name)
+
+    for frequency in range(3, 6):
+        freq = 10 ** frequency
+        lower_bound, upper_bound = average_data(dir, freq, read_data(dir, freq), config)
+        print('{0}Hz: averaged from {1}K to {2}K'.format(freq, lower_bound, upper_bound))
 
 
 if __name__ == '__main__':